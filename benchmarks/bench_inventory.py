@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+
+# Copyright 2018-2020 CRS4 (http://www.crs4.it/)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Benchmarks create_inventory.py on synthetic terraform states.
+
+For every state size and format it reports, as one JSON object per line:
+the state size, the time to parse the state (TerraformState.load), the time
+to generate the inventory, the peak memory of the process and the size of
+the inventory.  Each case runs in a fresh process, so that peak memory isn't
+inherited from the previous one.
+
+With --baseline, the results are compared with a previous run and the
+command exits with status 1 if any case got slower or bigger than the
+tolerance allows.
+"""
+
+import argparse
+import io
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+ThisDir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(ThisDir, '..', 'docker'))
+
+DefaultSizes = (10, 1000, 10000, 100000)
+# metrics compared with the baseline
+Metrics = ('parse_seconds', 'generate_seconds', 'peak_rss_mb')
+
+
+def _peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def run_case(state_file, repeat):
+    """
+    Measure one state in the current process.
+    """
+    import create_inventory
+
+    base_rss = _peak_rss_mb()
+    parse_times, generate_times = [], []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        state = create_inventory.TerraformState.load(state_file)
+        parse_times.append(time.perf_counter() - start)
+
+        output = io.StringIO()
+        start = time.perf_counter()
+        create_inventory.Inventory.generate(state, output)
+        generate_times.append(time.perf_counter() - start)
+        del state
+    return {
+        'state_bytes': os.path.getsize(state_file),
+        'parse_seconds': round(min(parse_times), 4),
+        'generate_seconds': round(min(generate_times), 4),
+        'peak_rss_mb': round(_peak_rss_mb(), 1),
+        'peak_rss_delta_mb': round(_peak_rss_mb() - base_rss, 1),
+        'inventory_bytes': len(output.getvalue().encode()),
+    }
+
+
+def run_benchmarks(options):
+    results = []
+    with tempfile.TemporaryDirectory(prefix='bench-inventory-') as tmp:
+        for state_version in options.state_versions:
+            for size in options.sizes:
+                state_file = os.path.join(tmp, 'v{}-{}.tfstate'.format(state_version, size))
+                # the peak RSS of a process survives fork and exec:  keep the
+                # generator's memory out of this process and thus of the cases
+                cmd = [ sys.executable, os.path.join(ThisDir, 'tfstate_generator.py'), str(size),
+                        '--fip-ratio', str(options.fip_ratio), '--state-version', str(state_version),
+                        '--filler', str(options.filler), '--output', state_file ]
+                if options.no_bastion:
+                    cmd.append('--no-bastion')
+                subprocess.check_call(cmd)
+                cmd = [ sys.executable, os.path.abspath(__file__), '--run-case', state_file,
+                        '--repeat', str(options.repeat) ]
+                result = json.loads(subprocess.check_output(cmd, universal_newlines=True))
+                os.remove(state_file)
+                result.update(instances=size, state_version=state_version, fip_ratio=options.fip_ratio,
+                              bastion=not options.no_bastion, filler=options.filler,
+                              python=platform.python_version())
+                print(json.dumps(result, sort_keys=True), flush=True)
+                results.append(result)
+    return results
+
+
+def _case_key(result):
+    return result['state_version'], result['instances']
+
+
+def compare(results, baseline_file, tolerance):
+    """
+    Return the list of regressions with respect to the baseline.
+    """
+    with open(baseline_file) as f:
+        baseline = { _case_key(r): r for r in map(json.loads, filter(str.strip, f)) }
+    regressions = []
+    for result in results:
+        previous = baseline.get(_case_key(result))
+        if previous is None:
+            continue
+        for metric in Metrics:
+            # ignore differences too small to be measured reliably
+            if previous[metric] < 0.01:
+                continue
+            ratio = result[metric] / previous[metric]
+            if ratio > 1 + tolerance:
+                regressions.append("v{} state, {} instances: {} {} -> {} (+{:.0%})".format(
+                    result['state_version'], result['instances'], metric, previous[metric], result[metric], ratio - 1))
+    return regressions
+
+
+def _build_parser():
+    parser = argparse.ArgumentParser(description="Benchmark inventory generation on synthetic terraform states")
+    parser.add_argument('--sizes', type=int, nargs='+', default=DefaultSizes, metavar='N',
+                        help="Numbers of instances to benchmark")
+    parser.add_argument('--state-versions', type=int, nargs='+', choices=(3, 4), default=(3, 4))
+    parser.add_argument('--fip-ratio', type=float, default=0.1)
+    parser.add_argument('--no-bastion', action='store_true')
+    parser.add_argument('--filler', type=int, default=2, help="Unrelated resources per instance")
+    parser.add_argument('--repeat', type=int, default=3, help="Runs per case (the fastest is reported)")
+    parser.add_argument('--baseline', metavar='FILE', help="Results of a previous run to compare with")
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help="Max relative slowdown or memory growth over the baseline")
+    parser.add_argument('--run-case', metavar='STATE_FILE', help=argparse.SUPPRESS)
+    return parser
+
+
+def main(args=None):
+    options = _build_parser().parse_args(args)
+    if options.run_case:
+        print(json.dumps(run_case(options.run_case, options.repeat)))
+        return
+
+    results = run_benchmarks(options)
+    if options.baseline:
+        regressions = compare(results, options.baseline, options.tolerance)
+        for r in regressions:
+            print("REGRESSION: " + r, file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+
+# Copyright 2018-2020 CRS4 (http://www.crs4.it/)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Benchmarks the start-up of the manage-cluster-ks images built by
+docker/build.sh.
+
+For every KubeSpray version it reports, as one JSON object per line: the
+size of the image, the size of its layers on top of the manage-cluster-tf
+image (i.e., what the version adds to the shared base), the time to start
+a container and the time from `docker run` to the first task of a playbook,
+after switching to the version as manage-cluster does.  With
+--default-image, the version is switched at run time in the image of the
+default version instead, which is what running without the per-version
+images costs.
+
+With --baseline, the results are compared with a previous run; with
+--max-size-mb and --max-first-task-seconds they are checked against a
+budget.  The command exits with status 1 if any check fails.
+"""
+
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+import time
+
+ThisDir = os.path.dirname(os.path.abspath(__file__))
+
+# metrics compared with the baseline
+Metrics = ('size_mb', 'version_layers_mb', 'start_seconds', 'first_task_seconds')
+
+# A one-task playbook, run on the container itself
+Playbook = '- hosts: localhost\n  gather_facts: no\n  tasks:\n  - debug: msg=started\n'
+
+
+def manage_cluster_version():
+    """
+    The version of manage-cluster, which tags the images built by docker/build.sh.
+    """
+    with open(os.path.join(ThisDir, '..', 'k8s-tools', 'manage-cluster')) as f:
+        return re.search(r'^VERSION="\$\{VERSION:-(.+)\}"', f.read(), re.MULTILINE).group(1)
+
+
+def _docker(*args):
+    return subprocess.check_output(('docker',) + args, universal_newlines=True).strip()
+
+
+def image_size_mb(image):
+    return int(_docker('image', 'inspect', '--format', '{{.Size}}', image)) / 2**20
+
+
+def image_layers(image):
+    return json.loads(_docker('image', 'inspect', '--format', '{{json .RootFS.Layers}}', image))
+
+
+def version_layers_mb(image, base_image):
+    """
+    Size of the layers that image adds to base_image, or None if it isn't built on it.
+    """
+    base_layers = image_layers(base_image)
+    if image_layers(image)[:len(base_layers)] != base_layers:
+        return None
+    return image_size_mb(image) - image_size_mb(base_image)
+
+
+def start_seconds(image, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.check_call([ 'docker', 'run', '--rm', image, 'true' ], stdout=subprocess.DEVNULL)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def first_task_seconds(image, ks_version, repeat):
+    """
+    Time from `docker run` to the first task of a playbook run with the
+    ansible of ks_version, which is checked out first (with its requirements
+    installed), as manage-cluster.py does.
+    """
+    script = ('manage-cluster.py "${{KUBESPRAY_DIR}}" --target-version {} checkout >/dev/null 2>&1 '
+              '&& printf "{}" > /tmp/bench.yml '
+              '&& ansible-playbook -i localhost, -c local /tmp/bench.yml').format(
+                  ks_version, Playbook.replace('\n', '\\n'))
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        proc = subprocess.Popen([ 'docker', 'run', '--rm', '--user', 'root', image, '/bin/sh', '-c', script ],
+                                stdout=subprocess.PIPE, universal_newlines=True)
+        elapsed = None
+        for line in proc.stdout:
+            if elapsed is None and line.startswith('TASK ['):
+                elapsed = time.perf_counter() - start
+        if proc.wait() != 0 or elapsed is None:
+            raise RuntimeError("The playbook didn't run in {} (exit status {})".format(image, proc.returncode))
+        times.append(elapsed)
+    return min(times)
+
+
+def run_benchmarks(options):
+    results = []
+    base_image = '{}/manage-cluster-tf:{}'.format(options.owner, options.tag)
+    default_image = '{}/manage-cluster-ks:{}'.format(options.owner, options.tag)
+    for ks_version in options.ks_versions:
+        image = default_image if options.default_image else '{}-ks{}'.format(default_image, ks_version)
+        size = version_layers_mb(image, base_image)
+        result = {
+            'ks_version': ks_version,
+            'image': image,
+            'size_mb': round(image_size_mb(image), 1),
+            'version_layers_mb': None if size is None else round(size, 1),
+            'start_seconds': round(start_seconds(image, options.repeat), 2),
+            'first_task_seconds': round(first_task_seconds(image, ks_version, options.repeat), 2),
+        }
+        print(json.dumps(result, sort_keys=True), flush=True)
+        results.append(result)
+    return results
+
+
+def compare(results, baseline_file, tolerance):
+    """
+    Return the list of regressions with respect to the baseline.
+    """
+    with open(baseline_file) as f:
+        baseline = { r['ks_version']: r for r in map(json.loads, filter(str.strip, f)) }
+    regressions = []
+    for result in results:
+        previous = baseline.get(result['ks_version'])
+        if previous is None:
+            continue
+        for metric in Metrics:
+            # ignore differences too small to be measured reliably
+            if not previous.get(metric) or result.get(metric) is None or previous[metric] < 0.1:
+                continue
+            ratio = result[metric] / previous[metric]
+            if ratio > 1 + tolerance:
+                regressions.append("KubeSpray {}: {} {} -> {} (+{:.0%})".format(
+                    result['ks_version'], metric, previous[metric], result[metric], ratio - 1))
+    return regressions
+
+
+def over_budget(results, max_size_mb, max_first_task_seconds):
+    """
+    Return the list of the results that exceed the start-up budget.
+    """
+    failures = []
+    for result in results:
+        if max_size_mb and result['size_mb'] > max_size_mb:
+            failures.append("KubeSpray {}: image size {} MB > {} MB".format(
+                result['ks_version'], result['size_mb'], max_size_mb))
+        if max_first_task_seconds and result['first_task_seconds'] > max_first_task_seconds:
+            failures.append("KubeSpray {}: first task after {}s > {}s".format(
+                result['ks_version'], result['first_task_seconds'], max_first_task_seconds))
+    return failures
+
+
+def _build_parser():
+    parser = argparse.ArgumentParser(description="Benchmark the start-up of the manage-cluster-ks images")
+    parser.add_argument('ks_versions', metavar='KS_VERSION', nargs='+', help="KubeSpray versions to benchmark")
+    parser.add_argument('--tag', default=manage_cluster_version(),
+                        help="Tag of the images (default: the manage-cluster version)")
+    parser.add_argument('--owner', default='tdmproject', help="Owner of the images")
+    parser.add_argument('--default-image', action='store_true',
+                        help="Switch to the versions at run time in the image of the default version")
+    parser.add_argument('--repeat', type=int, default=3, help="Runs per measure (the fastest is reported)")
+    parser.add_argument('--baseline', metavar='FILE', help="Results of a previous run to compare with")
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help="Max relative growth over the baseline")
+    parser.add_argument('--max-size-mb', type=float, help="Budget for the size of the images")
+    parser.add_argument('--max-first-task-seconds', type=float, help="Budget for the time to the first task")
+    return parser
+
+
+def main(args=None):
+    options = _build_parser().parse_args(args)
+    results = run_benchmarks(options)
+    failures = over_budget(results, options.max_size_mb, options.max_first_task_seconds)
+    if options.baseline:
+        failures += [ "REGRESSION: " + r for r in compare(results, options.baseline, options.tolerance) ]
+    for f in failures:
+        print(f, file=sys.stderr)
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,335 @@
+#!/usr/bin/env python3
+
+# Copyright 2018-2020 CRS4 (http://www.crs4.it/)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+A local fake OpenStack endpoint (Keystone v3, Nova, Neutron, Cinder and
+Glance) to exercise terraform_runner.py without a real cloud.
+
+Resources are kept in memory with a generic create/list/show/update/delete
+model:  it is faithful enough for the calls of the terraform OpenStack
+provider, not an emulation of OpenStack.  The server can throttle requests
+like a rate-limited API does:  with probability --throttle-rate, and
+whenever more than --max-concurrency requests are in flight, it answers
+429 with a Retry-After header.  Tokens expire after --token-ttl seconds.
+GET /_stats returns the request counts and the number of tokens issued.
+
+    ./fake_openstack.py --port 5000 --throttle-rate 0.05 &
+    export OS_AUTH_URL=http://127.0.0.1:5000/v3 OS_USERNAME=demo OS_PASSWORD=demo \\
+           OS_PROJECT_NAME=demo OS_USER_DOMAIN_NAME=Default OS_PROJECT_DOMAIN_NAME=Default
+"""
+
+import argparse
+import collections
+import http.server
+import json
+import random
+import socketserver
+import threading
+import time
+import urllib.parse
+import uuid
+
+ProjectId = 'f00df00df00df00df00df00df00df00d'
+# service type -> URL prefix (the catalog adds the host)
+Services = collections.OrderedDict((
+    ('identity', '/v3'),
+    ('compute', '/compute/v2.1'),
+    ('network', '/network'),
+    ('volumev2', '/volume/v2/' + ProjectId),
+    ('volumev3', '/volume/v3/' + ProjectId),
+    ('image', '/image'),
+))
+# resources that exist before terraform runs
+Seeds = {
+    ('network', 'networks'): [ { 'name': 'public', 'router:external': True, 'status': 'ACTIVE', 'subnets': [] } ],
+    ('compute', 'flavors'): [ { 'name': name, 'vcpus': vcpus, 'ram': ram, 'disk': 20 }
+                              for name, vcpus, ram in (('m1.small', 1, 2048), ('m1.medium', 2, 4096),
+                                                       ('m1.large', 4, 8192)) ],
+    ('image', 'images'): [ { 'name': 'Ubuntu-18.04', 'status': 'active', 'min_disk': 0, 'min_ram': 0 } ],
+}
+# status of new resources, by collection
+InitialStatus = { 'servers': 'ACTIVE', 'volumes': 'available', 'floatingips': 'DOWN' }
+
+
+def _collection_key(collection):
+    # 'os-keypairs' -> 'keypairs', 'security-group-rules' -> 'security_group_rules'
+    if collection.startswith('os-'):
+        collection = collection[3:]
+    return collection.replace('-', '_')
+
+
+class Cloud(object):
+    """
+    In-memory resources:  {(service, collection): {id: resource}}.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._resources = collections.defaultdict(collections.OrderedDict)
+        self._singular = {}
+        self._next_ip = 10
+        for (service, collection), resources in Seeds.items():
+            for resource in resources:
+                self.create(service, collection, collection[:-1], dict(resource))
+
+    def create(self, service, collection, singular, resource):
+        with self._lock:
+            self._singular[service, collection] = singular
+            if collection == 'os-keypairs':
+                resource['id'] = resource['name']
+                resource.setdefault('fingerprint', 'fa:ke')
+            else:
+                resource.setdefault('id', str(uuid.uuid4()))
+            resource.setdefault('status', InitialStatus.get(collection, 'ACTIVE'))
+            resource.setdefault('tenant_id', ProjectId)
+            resource.setdefault('project_id', ProjectId)
+            if collection == 'servers':
+                self._next_ip += 1
+                address = '10.0.{}.{}'.format(self._next_ip >> 8 & 255, self._next_ip & 255)
+                resource['addresses'] = { 'private': [ { 'addr': address, 'version': 4, 'OS-EXT-IPS:type': 'fixed' } ] }
+                resource['accessIPv4'] = address
+            elif collection == 'floatingips':
+                self._next_ip += 1
+                resource['floating_ip_address'] = '172.16.{}.{}'.format(self._next_ip >> 8 & 255, self._next_ip & 255)
+            self._resources[service, collection][resource['id']] = resource
+            return resource
+
+    def singular(self, service, collection):
+        return self._singular.get((service, collection), collection[:-1])
+
+    def list(self, service, collection, filters):
+        with self._lock:
+            resources = list(self._resources[service, collection].values())
+        return [ r for r in resources if all(str(r.get(k)) == v for k, v in filters.items() if k in r) ]
+
+    def get(self, service, collection, resource_id):
+        with self._lock:
+            return self._resources[service, collection].get(resource_id)
+
+    def update(self, service, collection, resource_id, changes):
+        with self._lock:
+            resource = self._resources[service, collection].get(resource_id)
+            if resource is not None:
+                resource.update(changes)
+            return resource
+
+    def delete(self, service, collection, resource_id):
+        with self._lock:
+            return self._resources[service, collection].pop(resource_id, None) is not None
+
+
+def _timestamp(seconds):
+    return time.strftime('%Y-%m-%dT%H:%M:%S.000000Z', time.gmtime(seconds))
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super(Handler, self).log_message(format, *args)
+
+    def _send(self, status, body=None, headers=()):
+        data = json.dumps(body).encode() if body is not None else b''
+        self.send_response(status)
+        for name, value in headers:
+            self.send_header(name, value)
+        if body is not None:
+            self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return json.loads(self.rfile.read(length).decode()) if length else {}
+
+    def _endpoint(self, service):
+        return 'http://{}:{}{}'.format(self.server.server_address[0], self.server.server_address[1], Services[service])
+
+    def _catalog(self):
+        return [ { 'type': service, 'name': service, 'id': service,
+                   'endpoints': [ { 'interface': interface, 'region': 'RegionOne', 'region_id': 'RegionOne',
+                                    'url': self._endpoint(service), 'id': '{}-{}'.format(service, interface) }
+                                  for interface in ('public', 'internal', 'admin') ] }
+                 for service in Services ]
+
+    def _identity(self, method, path):
+        if method == 'POST' and path == '/auth/tokens':
+            methods = self._body().get('auth', {}).get('identity', {}).get('methods', [ 'password' ])
+            now = time.time()
+            with self.server.lock:
+                self.server.stats['tokens'] += 1
+            token = { 'methods': methods, 'expires_at': _timestamp(now + self.server.token_ttl),
+                      'issued_at': _timestamp(now),
+                      'user': { 'id': 'demo', 'name': 'demo', 'domain': { 'id': 'default', 'name': 'Default' } },
+                      'project': { 'id': ProjectId, 'name': 'demo', 'domain': { 'id': 'default', 'name': 'Default' } },
+                      'roles': [ { 'id': 'member', 'name': 'member' } ], 'catalog': self._catalog() }
+            return self._send(201, { 'token': token }, [ ('X-Subject-Token', uuid.uuid4().hex) ])
+        if method == 'GET' and path in ('', '/'):
+            return self._send(200, { 'version': { 'id': 'v3.10', 'status': 'stable',
+                                                  'links': [ { 'rel': 'self', 'href': self._endpoint('identity') + '/' } ] } })
+        return self._send(404, { 'error': { 'message': 'not found', 'code': 404 } })
+
+    def _route(self, method):
+        url = urllib.parse.urlsplit(self.path)
+        path = url.path.rstrip('/')
+        if path == '' and method == 'GET':
+            return self._send(300, { 'versions': { 'values': [ {
+                'id': 'v3.10', 'status': 'stable', 'links': [ { 'rel': 'self', 'href': self._endpoint('identity') + '/' } ] } ] } })
+        if path == '/_stats':
+            return self._send(200, self.server.stats)
+        for service, prefix in Services.items():
+            if path == prefix or path.startswith(prefix + '/'):
+                break
+        else:
+            return self._send(404, { 'error': 'unknown service' })
+        rest = path[len(prefix):]
+        if service == 'identity':
+            return self._identity(method, rest)
+        # neutron and glance have version prefixes under the service endpoint
+        for version in ('/v2.0', '/v2'):
+            if service in ('network', 'image') and rest.startswith(version):
+                rest = rest[len(version):]
+        parts = [ p for p in rest.split('/') if p ]
+        if not parts:
+            return self._send(200, { 'versions': [ { 'id': 'v2.0', 'status': 'CURRENT' } ] })
+        return self._resource(method, service, parts, dict(urllib.parse.parse_qsl(url.query)))
+
+    def _resource(self, method, service, parts, query):
+        cloud = self.server.cloud
+        collection = parts[0]
+        if len(parts) >= 3 or (len(parts) == 2 and parts[1] != 'detail' and method == 'POST'):
+            # actions and sub-resources:  server actions, router interfaces, volume attachments...
+            owner = cloud.get(service, collection, parts[1])
+            if owner is None:
+                return self._send(404, { 'itemNotFound': { 'message': 'not found', 'code': 404 } })
+            body = self._body() if method in ('POST', 'PUT') else {}
+            if len(parts) == 4 or method == 'DELETE':
+                return self._send(202 if method == 'DELETE' else 200)
+            if method == 'GET':
+                return self._send(200, { _collection_key(parts[2]): [] })
+            key, value = next(iter(body.items()), ('result', {}))
+            result = dict(value) if isinstance(value, dict) else {}
+            result.setdefault('id', str(uuid.uuid4()))
+            result.setdefault('port_id', str(uuid.uuid4()))
+            return self._send(200, result if service == 'network' else { key: result })
+        if len(parts) == 1 or parts[1] == 'detail':
+            if method == 'POST':
+                singular, resource = next(iter(self._body().items()))
+                return self._send(201 if service == 'network' else 202,
+                                  { singular: cloud.create(service, collection, singular, dict(resource)) })
+            items = cloud.list(service, collection, query)
+            if collection == 'os-keypairs':
+                items = [ { 'keypair': k } for k in items ]
+            return self._send(200, { _collection_key(collection): items })
+        resource_id = parts[1]
+        singular = cloud.singular(service, collection)
+        if method == 'GET':
+            resource = cloud.get(service, collection, resource_id)
+        elif method == 'PUT':
+            resource = cloud.update(service, collection, resource_id, next(iter(self._body().values()), {}))
+        elif method == 'DELETE':
+            if cloud.delete(service, collection, resource_id):
+                return self._send(204)
+            resource = None
+        else:
+            return self._send(405)
+        if resource is None:
+            return self._send(404, { 'itemNotFound': { 'message': 'not found', 'code': 404 },
+                                     'NeutronError': { 'type': 'NotFound', 'message': 'not found' } })
+        return self._send(200, { singular: resource })
+
+    def _handle(self, method):
+        server = self.server
+        with server.lock:
+            server.in_flight += 1
+            server.stats['requests'] += 1
+            throttle = not self.path.startswith('/v3') and self.path != '/_stats' and \
+                (server.in_flight > server.max_concurrency or random.random() < server.throttle_rate)
+            if throttle:
+                server.stats['throttled'] += 1
+        try:
+            if throttle:
+                if method in ('POST', 'PUT'):
+                    self._body()
+                return self._send(429, { 'overLimit': { 'message': 'Rate limit exceeded', 'code': 429,
+                                                        'retryAfter': str(server.retry_after) } },
+                                  [ ('Retry-After', str(server.retry_after)) ])
+            return self._route(method)
+        finally:
+            with server.lock:
+                server.in_flight -= 1
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_POST(self):
+        self._handle('POST')
+
+    def do_PUT(self):
+        self._handle('PUT')
+
+    def do_DELETE(self):
+        self._handle('DELETE')
+
+
+class FakeOpenStack(socketserver.ThreadingMixIn, http.server.HTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, address, throttle_rate=0.0, max_concurrency=1000, retry_after=1, verbose=False,
+                 token_ttl=3600):
+        http.server.HTTPServer.__init__(self, address, Handler)
+        self.cloud = Cloud()
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.stats = { 'requests': 0, 'throttled': 0, 'tokens': 0 }
+        self.throttle_rate = throttle_rate
+        self.max_concurrency = max_concurrency
+        self.retry_after = retry_after
+        self.verbose = verbose
+        self.token_ttl = token_ttl
+
+
+def _build_parser():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--address', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--throttle-rate', type=float, default=0.0,
+                        help="Fraction of the requests answered with 429")
+    parser.add_argument('--max-concurrency', type=int, default=1000,
+                        help="Requests in flight above which the others are answered with 429")
+    parser.add_argument('--retry-after', type=int, default=1, help="Retry-After of the 429 answers")
+    parser.add_argument('--token-ttl', type=int, default=3600, help="Lifetime of the tokens in seconds")
+    parser.add_argument('--verbose', action='store_true', help="Log every request")
+    return parser
+
+
+def main(args=None):
+    options = _build_parser().parse_args(args)
+    server = FakeOpenStack((options.address, options.port), options.throttle_rate, options.max_concurrency,
+                           options.retry_after, options.verbose, options.token_ttl)
+    print("Fake OpenStack listening on http://{}:{}/v3".format(options.address, options.port), flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+
+# Copyright 2018-2020 CRS4 (http://www.crs4.it/)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Generates synthetic terraform states shaped like the ones produced by the
+manage-cluster OpenStack templates, to benchmark the inventory pipeline.
+
+The state is written one resource at a time, so arbitrarily large states can
+be generated in constant memory.
+"""
+
+import argparse
+import json
+import random
+import sys
+
+MasterGroups = 'etcd,kube-master,k8s-cluster,vault'
+EtcdGroups = 'etcd,vault,no-floating'
+NodeGroups = 'kube-node,k8s-cluster'
+PrivateNodeGroups = 'kube-node,k8s-cluster,no-floating'
+
+
+class StateGenerator(object):
+    """
+    :param instances: total number of compute instances (bastion included)
+    :param masters: number of master nodes (they are also etcd members)
+    :param etcd: number of dedicated etcd nodes
+    :param bastion: whether to create a bastion
+    :param fip_ratio: fraction of the worker nodes with a floating IP
+    :param state_version: 3 (terraform 0.11 'modules' layout) or 4 ('resources' list)
+    :param filler: number of unrelated resources (security group rules,
+                   volumes) per instance, which the parser must skip
+    """
+
+    def __init__(self, instances, masters=3, etcd=0, bastion=True, fip_ratio=0.1,
+                 state_version=3, filler=2, cluster='bench', seed=0):
+        if state_version not in (3, 4):
+            raise ValueError("Unsupported state version {}".format(state_version))
+        self.instances = instances
+        self.masters = min(masters, instances)
+        self.etcd = min(etcd, instances - self.masters)
+        self.bastion = bastion and instances > self.masters + self.etcd
+        self.fip_ratio = fip_ratio
+        self.state_version = state_version
+        self.filler = filler
+        self.cluster = cluster
+        self._random = random.Random(seed)
+
+
+    def _nodes(self):
+        """
+        Yields (resource name, index, kubespray groups, has floating ip) for every instance.
+        """
+        for i in range(self.masters):
+            yield 'k8s_master', i, MasterGroups, True
+        for i in range(self.etcd):
+            yield 'etcd', i, EtcdGroups, False
+        if self.bastion:
+            yield 'bastion', 0, 'bastion', True
+        workers = self.instances - self.masters - self.etcd - (1 if self.bastion else 0)
+        fip, nf = 0, 0
+        for _ in range(workers):
+            if self._random.random() < self.fip_ratio:
+                yield 'k8s_node', fip, NodeGroups, True
+                fip += 1
+            else:
+                yield 'k8s_node_no_floating_ip', nf, PrivateNodeGroups, False
+                nf += 1
+
+
+    def _instance_attributes(self, rname, index, groups, serial):
+        name = '{}-{}-{}'.format(self.cluster, rname.replace('_', '-'), index + 1)
+        private_ip = '10.{}.{}.{}'.format(serial >> 16 & 255, serial >> 8 & 255, serial & 255)
+        return {
+            'id': '{:08x}-0000-4000-8000-{:012x}'.format(serial, serial),
+            'name': name,
+            'access_ip_v4': private_ip,
+            'flavor_name': 'm1.large',
+            'image_name': 'Ubuntu-18.04',
+            'network': [ { 'name': '{}-net'.format(self.cluster), 'fixed_ip_v4': private_ip, 'floating_ip': '' } ],
+            'metadata': { 'ssh_user': 'ubuntu', 'kubespray_groups': groups, 'depends_on': '' },
+            'all_metadata': { 'ssh_user': 'ubuntu', 'kubespray_groups': groups, 'depends_on': '' },
+            'security_groups': [ '{}-k8s'.format(self.cluster), '{}-k8s-worker'.format(self.cluster) ],
+        }
+
+
+    @staticmethod
+    def _filler_attributes(serial, j):
+        return {
+            'id': '{:08x}-{:04x}-4000-8000-000000000000'.format(serial, j),
+            'direction': 'ingress',
+            'ethertype': 'IPv4',
+            'port_range_min': 30000 + j,
+            'port_range_max': 32767,
+            'protocol': 'tcp',
+            'remote_ip_prefix': '0.0.0.0/0',
+            'description': 'synthetic rule {} of instance {}'.format(j, serial),
+        }
+
+
+    @staticmethod
+    def _floating_ip(serial):
+        return '172.{}.{}.{}'.format(16 + (serial >> 16 & 15), serial >> 8 & 255, serial & 255)
+
+
+    def _master_fips(self):
+        # the masters come first, so their serials are 1..masters
+        return [ self._floating_ip(serial) for serial in range(1, self.masters + 1) ]
+
+
+    @staticmethod
+    def _flatmap(attributes):
+        # terraform 0.11 stores attributes as flat strings
+        flat = {}
+        for k, v in attributes.items():
+            if isinstance(v, dict):
+                flat['{}.%'.format(k)] = str(len(v))
+                flat.update(('{}.{}'.format(k, kk), str(vv)) for kk, vv in v.items())
+            elif isinstance(v, list):
+                flat['{}.#'.format(k)] = str(len(v))
+                for i, item in enumerate(v):
+                    if isinstance(item, dict):
+                        flat.update(('{}.{}.{}'.format(k, i, kk), str(vv)) for kk, vv in item.items())
+                    else:
+                        flat['{}.{}'.format(k, i)] = str(item)
+            else:
+                flat[k] = str(v)
+        return flat
+
+
+    def _resources(self):
+        """
+        Yields (module, type, name, index, attributes) tuples.
+        """
+        for serial, (rname, index, groups, has_fip) in enumerate(self._nodes(), 1):
+            attributes = self._instance_attributes(rname, index, groups, serial)
+            yield 'compute', 'openstack_compute_instance_v2', rname, index, attributes
+            if has_fip:
+                yield 'compute', 'openstack_compute_floatingip_associate_v2', rname, index, {
+                    'id': 'fip-{}'.format(serial),
+                    'instance_id': attributes['id'],
+                    'floating_ip': self._floating_ip(serial) }
+            for j in range(self.filler):
+                yield 'compute', 'openstack_networking_secgroup_rule_v2', 'filler_{}'.format(j), serial, \
+                      self._filler_attributes(serial, j)
+
+
+    def _write_v3(self, out):
+        out.write('{"version": 3, "terraform_version": "0.11.11", "serial": 1, "lineage": "synthetic",\n')
+        outputs = { 'k8s_master_fips': { 'sensitive': False, 'type': 'list', 'value': self._master_fips() } }
+        out.write(' "modules": [{{"path": ["root"], "outputs": {}, "resources": {{}}, "depends_on": []}},\n'.format(
+            json.dumps(outputs)))
+        out.write('  {"path": ["root", "compute"], "outputs": {}, "resources": {')
+        sep = '\n'
+        for _, rtype, rname, index, attributes in self._resources():
+            key = '{}.{}.{}'.format(rtype, rname, index)
+            resource = { 'type': rtype, 'depends_on': [], 'provider': 'provider.openstack',
+                         'primary': { 'id': attributes['id'], 'attributes': self._flatmap(attributes),
+                                      'meta': {}, 'tainted': False }, 'deposed': [] }
+            out.write('{}    {}: {}'.format(sep, json.dumps(key), json.dumps(resource)))
+            sep = ',\n'
+        out.write('\n  }, "depends_on": []}]}\n')
+
+
+    def _write_v4(self, out):
+        # v4 groups all the instances of a resource; sort the resources to group them
+        # (at the cost of holding their attributes in memory)
+        grouped = {}
+        for module, rtype, rname, index, attributes in self._resources():
+            grouped.setdefault((module, rtype, rname), []).append({
+                'index_key': index, 'schema_version': 0, 'attributes': attributes, 'private': 'bnVsbA==' })
+        out.write('{"version": 4, "terraform_version": "0.12.29", "serial": 1, "lineage": "synthetic",\n')
+        outputs = { 'k8s_master_fips': { 'value': self._master_fips(), 'type': [ 'list', 'string' ] } }
+        out.write(' "outputs": {},\n "resources": ['.format(json.dumps(outputs)))
+        sep = '\n'
+        for (module, rtype, rname), instances in grouped.items():
+            resource = { 'module': 'module.{}'.format(module), 'mode': 'managed', 'type': rtype, 'name': rname,
+                         'provider': 'provider.openstack', 'instances': instances }
+            out.write('{}  {}'.format(sep, json.dumps(resource)))
+            sep = ',\n'
+        out.write('\n ]}\n')
+
+
+    def write(self, out):
+        if self.state_version == 3:
+            self._write_v3(out)
+        else:
+            self._write_v4(out)
+
+
+def _build_parser():
+    parser = argparse.ArgumentParser(description="Write a synthetic terraform state")
+    parser.add_argument('instances', type=int, help="Number of compute instances")
+    parser.add_argument('--masters', type=int, default=3)
+    parser.add_argument('--etcd', type=int, default=0, help="Number of dedicated etcd nodes")
+    parser.add_argument('--no-bastion', action='store_true')
+    parser.add_argument('--fip-ratio', type=float, default=0.1, help="Fraction of workers with a floating IP")
+    parser.add_argument('--state-version', type=int, choices=(3, 4), default=3)
+    parser.add_argument('--filler', type=int, default=2, help="Unrelated resources per instance")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('-o', '--output', help="Output file (default: stdout)")
+    return parser
+
+
+def main(args=None):
+    options = _build_parser().parse_args(args)
+    generator = StateGenerator(options.instances, options.masters, options.etcd, not options.no_bastion,
+                               options.fip_ratio, options.state_version, options.filler, seed=options.seed)
+    if options.output:
+        with open(options.output, 'w') as f:
+            generator.write(f)
+    else:
+        generator.write(sys.stdout)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,139 @@
+# Copyright 2018-2020 CRS4 (http://www.crs4.it/)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+DOCUMENTATION = '''
+    callback: manage_cluster_journal
+    type: aggregate
+    short_description: Records task results and timings in the manage-cluster operation journal
+    description:
+      - Appends one JSON line per task result per host, with its duration, to the
+        file named by the MANAGE_CLUSTER_JOURNAL environment variable.  The end of
+        every task and play is recorded with its duration and, for tasks, the number
+        of hosts per result status.  Plays run in batches (serial) are recorded once
+        per batch, with the batch number and its hosts.  The JSON object in
+        MANAGE_CLUSTER_JOURNAL_CONTEXT is merged into every line.
+    requirements:
+      - whitelist in configuration
+'''
+
+import json
+import os
+import time
+
+from ansible.plugins.callback import CallbackBase
+
+
+class CallbackModule(CallbackBase):
+    CALLBACK_VERSION = 2.0
+    CALLBACK_TYPE = 'aggregate'
+    CALLBACK_NAME = 'manage_cluster_journal'
+    CALLBACK_NEEDS_WHITELIST = True
+    CALLBACK_NEEDS_ENABLED = True
+
+    def __init__(self):
+        super(CallbackModule, self).__init__()
+        self._context = json.loads(os.environ.get('MANAGE_CLUSTER_JOURNAL_CONTEXT', '{}'))
+        self._play = None
+        self._play_start = None
+        self._play_uuid = None
+        self._batch = 0
+        self._play_hosts = set()
+        self._task = None
+        self._task_start = None
+        self._host_start = {}
+        self._task_hosts = {}
+        path = os.environ.get('MANAGE_CLUSTER_JOURNAL')
+        self._journal = open(path, 'a') if path else None
+
+    def _write(self, **event):
+        if not self._journal:
+            return
+        event.update(self._context)
+        event['time'] = round(time.time(), 3)
+        self._journal.write(json.dumps(event, sort_keys=True) + '\n')
+        # flush every event so that the journal survives a crash
+        self._journal.flush()
+
+    def _task_result(self, result, status):
+        host = result._host.get_name()
+        now = time.time()
+        start = self._host_start.get(host, self._task_start or now)
+        self._task_hosts[status] = self._task_hosts.get(status, 0) + 1
+        self._play_hosts.add(host)
+        self._write(event='task', play=self._play, task=result._task.get_name(),
+                    host=host, status=status, duration=round(now - start, 3))
+
+    def _end_task(self):
+        if self._task is None:
+            return
+        self._write(event='task-end', play=self._play, task=self._task,
+                    duration=round(time.time() - self._task_start, 3), hosts=self._task_hosts)
+        self._task = None
+
+    def _end_play(self):
+        if self._play_start is None:
+            return
+        self._write(event='play-end', play=self._play, batch=self._batch,
+                    hosts=sorted(self._play_hosts), duration=round(time.time() - self._play_start, 3))
+        self._play_start = None
+
+    def v2_playbook_on_play_start(self, play):
+        self._end_task()
+        self._end_play()
+        self._play = play.get_name()
+        self._play_start = time.time()
+        self._play_hosts = set()
+        # with serial, ansible starts a copy of the play (same uuid) for every batch of hosts
+        uuid = getattr(play, '_uuid', None)
+        self._batch = self._batch + 1 if uuid is not None and uuid == self._play_uuid else 1
+        self._play_uuid = uuid
+        self._write(event='play', play=self._play, batch=self._batch)
+
+    def v2_playbook_on_task_start(self, task, is_conditional):
+        self._end_task()
+        self._task = task.get_name()
+        self._task_start = time.time()
+        self._host_start = {}
+        self._task_hosts = {}
+
+    def v2_playbook_on_handler_task_start(self, task):
+        self.v2_playbook_on_task_start(task, False)
+
+    def v2_runner_on_start(self, host, task):
+        # only called by ansible >= 2.8
+        self._host_start[host.get_name()] = time.time()
+
+    def v2_runner_on_ok(self, result):
+        self._task_result(result, 'changed' if result._result.get('changed') else 'ok')
+
+    def v2_runner_on_failed(self, result, ignore_errors=False):
+        self._task_result(result, 'ignored' if ignore_errors else 'failed')
+
+    def v2_runner_on_unreachable(self, result):
+        self._task_result(result, 'unreachable')
+
+    def v2_runner_on_skipped(self, result):
+        self._task_result(result, 'skipped')
+
+    def v2_playbook_on_stats(self, stats):
+        self._end_task()
+        self._end_play()
+        for host in sorted(stats.processed):
+            self._write(event='host-stats', host=host, **stats.summarize(host))
+        if self._journal:
+            self._journal.close()
+            self._journal = None
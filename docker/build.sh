@@ -21,12 +21,34 @@ set -o pipefail
 ThisDir=$( cd "$( dirname "${0}" )" >/dev/null && pwd )
 
 function usage_error() {
-  echo "Usage: $0 [tag]" >&2
+  echo "Usage: $0 [--ks-version x.y.z]... [tag]" >&2
+  echo "  Builds manage-cluster-tf and a manage-cluster-ks image per KubeSpray version," >&2
+  echo "  tagged <tag>-ks<version> (all the versions in the VersionTable of" >&2
+  echo "  manage-cluster.py unless some are given)." >&2
   exit 2
 }
 
+# The KubeSpray versions supported by manage-cluster.py
+function supported_ks_versions() {
+  sed -n -e 's/^ *("\([0-9.]*\)", *"[0-9.]*"),\{0,1\}$/\1/p' manage-cluster.py
+}
+
 #### main ####
 cd "${ThisDir}"
+KsVersions=()
+while [[ $# -gt 0 && "${1}" == --* ]]; do
+  case "${1}" in
+    --ks-version)
+      [[ $# -ge 2 ]] || usage_error
+      KsVersions+=("${2}")
+      shift 2
+      ;;
+    *)
+      usage_error
+      ;;
+  esac
+done
+
 if [[ $# == 0 ]]; then
   Tag=":$(../k8s-tools/manage-cluster -v)"
 elif [[ $# == 1 ]]; then
@@ -35,7 +57,26 @@ else
   usage_error
 fi
 
-for target in manage-cluster-tf manage-cluster-ks; do
-  docker build --target=${target} -t tdmproject/${target}${Tag} .
+if [[ ${#KsVersions[@]} -eq 0 ]]; then
+  KsVersions=( $(supported_ks_versions) )
+fi
+# the image tagged without version is the one of the KubeSpray version that
+# the base has checked out, like the image built without a kubespray_version
+DefaultKsVersion="$(sed -n -e 's/^ARG default_kubespray_version="\(.*\)"$/\1/p' Dockerfile)"
+# the version manage-cluster deploys by default is always built too
+DeployKsVersion="$(sed -n -e "s/^DefaultKubesprayVersion='\(.*\)'$/\1/p" ../k8s-tools/manage-cluster)"
+for version in "${DefaultKsVersion}" "${DeployKsVersion}"; do
+  if [[ " ${KsVersions[*]} " != *" ${version} "* ]]; then
+    KsVersions+=("${version}")
+  fi
 done
 
+# the base layers are shared by all the images:  they are built once
+docker build --target=manage-cluster-tf -t tdmproject/manage-cluster-tf${Tag} .
+
+for version in "${KsVersions[@]}"; do
+  echo -e "\nBuilding manage-cluster-ks for KubeSpray ${version}..." >&2
+  docker build --target=manage-cluster-ks --build-arg kubespray_version="${version}" \
+    -t tdmproject/manage-cluster-ks${Tag}-ks${version} .
+done
+docker tag tdmproject/manage-cluster-ks${Tag}-ks${DefaultKsVersion} tdmproject/manage-cluster-ks${Tag}
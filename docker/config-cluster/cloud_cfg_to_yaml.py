@@ -1,73 +1,351 @@
 #!/usr/bin/env python3
 
+"""
+Writes the OpenStack credentials of a cluster for the tools that follow.
+
+The credentials are read from the k8s cloud_config ([Global] section) or,
+if CLOUD_CONFIG is '-', from the OS_* environment variables.  They are
+merged as cloud CLOUD in CLOUDS_YAML, which can hold other clouds too.
+
+With --token, one scoped token is fetched from Keystone and cached with
+its expiry in --cache.  It is reused by the following runs until it is
+about to expire (--refresh-margin).  The token is written as the
+token-auth cloud '<CLOUD>-token' and, with --env-file, as OS_* variables
+in docker's env-file format.  That way all the later steps authenticate
+with the same token rather than each one with the password.
+
+    cloud_cfg_to_yaml.py /etc/kubernetes/cloud_config mycluster /etc/openstack/clouds.yaml
+    cloud_cfg_to_yaml.py --token --env-file .os-token.env -
+"""
+
+import argparse
+import calendar
+import collections
 import configparser
+import fcntl
+import hashlib
+import json
 import os
 import re
+import ssl
 import sys
+import time
+import urllib.error
+import urllib.request
 
+DefaultCacheFilename = '.os-token-cache.json'
+DefaultRefreshMargin = 600
+DefaultTimeout = 30
+TokenCloudSuffix = '-token'
 
-def usage_error():
-    print(os.path.basename(__file__), "<k8s cloud_config> <cloud name> <clouds.yaml>", file=sys.stderr)
-    sys.exit(1)
+Credentials = collections.namedtuple('Credentials', [
+    'auth_url', 'username', 'password', 'user_domain_name', 'user_domain_id', 'project_id', 'project_name',
+    'project_domain_name', 'project_domain_id', 'region_name', 'cacert' ])
 
+Token = collections.namedtuple('Token', 'id expires_at project_id')
 
-v2_clouds_template = """
-clouds:
-  {cloud}:
-    auth:
-      auth_url: {auth_url}
-      username: {username}
-      password: {password}
-      project_id: {project_id}
-      project_name: {project_name}
-    region_name: {region_name}
-"""
 
-v3_clouds_template = """
-clouds:
-  {cloud}:
-    auth:
-      auth_url: {auth_url}
-      username: {username}
-      password: {password}
-      project_id: {project_id}
-      user_domain_name: {project_domain_name}
-      project_domain_name: {project_domain_name}
-    region_name: {region_name}
-"""
+def is_v2(auth_url):
+    return re.search(r'/v2.*', auth_url) is not None
 
 
-if __name__ == '__main__':
-    if len(sys.argv) != 4:
-        usage_error()
+def credentials_from_cloud_cfg(filename):
+    cfg = configparser.ConfigParser()
+    cfg.read(filename)
+    g = cfg['Global']
+    domain_name = g.get('domain-name', 'default')
+    return Credentials(
+        auth_url=g['auth-url'],
+        username=g['username'],
+        password=g['password'],
+        user_domain_name=g.get('user-domain-name', domain_name),
+        user_domain_id=g.get('user-domain-id', g.get('domain-id')),
+        project_id=g.get('tenant-id', ''),
+        project_name=g.get('tenant-name'),
+        project_domain_name=g.get('tenant-domain-name', domain_name),
+        project_domain_id=g.get('tenant-domain-id', g.get('domain-id')),
+        region_name=g.get('region', ''),
+        cacert=g.get('ca-file'))
 
-    cloud_cfg_file = sys.argv[1]
-    cloud_name = sys.argv[2]
-    clouds_yaml_file = sys.argv[3]
 
-    cfg = configparser.ConfigParser()
-    cfg.read(cloud_cfg_file)
-    global_section = cfg["Global"]
-
-    if re.search(r'/v2.*', global_section['auth-url']):
-        yml_string = v2_clouds_template.format(
-            cloud=cloud_name,
-            auth_url=global_section['auth-url'],
-            username=global_section['username'],
-            password=global_section['password'],
-            project_id=global_section.get('tenant-id', ''),
-            project_name=global_section.get('tenant-name'),
-            region_name=global_section.get('region', ''))
+def credentials_from_env(env=os.environ):
+    def get(*names, default=None):
+        return next((env[n] for n in names if env.get(n)), default)
+
+    missing = [ n for n in ('OS_AUTH_URL', 'OS_USERNAME', 'OS_PASSWORD') if not env.get(n) ]
+    if missing:
+        raise RuntimeError("Missing OpenStack environment variables: {}".format(', '.join(missing)))
+    return Credentials(
+        auth_url=env['OS_AUTH_URL'],
+        username=env['OS_USERNAME'],
+        password=env['OS_PASSWORD'],
+        user_domain_name=get('OS_USER_DOMAIN_NAME', 'OS_DOMAIN_NAME', default='default'),
+        user_domain_id=get('OS_USER_DOMAIN_ID', 'OS_DOMAIN_ID'),
+        project_id=get('OS_PROJECT_ID', 'OS_TENANT_ID', default=''),
+        project_name=get('OS_PROJECT_NAME', 'OS_TENANT_NAME'),
+        project_domain_name=get('OS_PROJECT_DOMAIN_NAME', 'OS_DOMAIN_NAME', default='default'),
+        project_domain_id=get('OS_PROJECT_DOMAIN_ID', 'OS_DOMAIN_ID'),
+        region_name=get('OS_REGION_NAME', default=''),
+        cacert=get('OS_CACERT'))
+
+
+def parse_timestamp(text):
+    """
+    '2020-01-01T10:00:00.000000Z' or '2020-01-01T10:00:00Z' -> seconds since the epoch
+    """
+    return calendar.timegm(time.strptime(re.sub(r'\.\d+', '', text).rstrip('Z'), '%Y-%m-%dT%H:%M:%S'))
+
+
+class Keystone(object):
+    """
+    Issues project-scoped tokens with the password of the credentials.
+    """
+
+    def __init__(self, credentials, timeout=DefaultTimeout):
+        self._credentials = credentials
+        self._timeout = timeout
+        self._context = ssl.create_default_context(cafile=credentials.cacert) if credentials.cacert else None
+
+
+    def _post(self, path, body):
+        url = self._credentials.auth_url.rstrip('/') + path
+        request = urllib.request.Request(url, data=json.dumps(body).encode(), method='POST',
+                                         headers={ 'Content-Type': 'application/json', 'Accept': 'application/json' })
+        with urllib.request.urlopen(request, timeout=self._timeout, context=self._context) as response:
+            return response.headers, json.loads(response.read().decode())
+
+
+    @staticmethod
+    def _domain(name, domain_id):
+        return { 'id': domain_id } if domain_id else { 'name': name }
+
+
+    def _issue_v3(self):
+        c = self._credentials
+        if c.project_id:
+            project = { 'id': c.project_id }
+        else:
+            project = { 'name': c.project_name, 'domain': self._domain(c.project_domain_name, c.project_domain_id) }
+        headers, body = self._post('/auth/tokens', { 'auth': {
+            'identity': { 'methods': [ 'password' ],
+                          'password': { 'user': { 'name': c.username, 'password': c.password,
+                                                  'domain': self._domain(c.user_domain_name, c.user_domain_id) } } },
+            'scope': { 'project': project } } })
+        token = body['token']
+        return Token(headers['X-Subject-Token'], parse_timestamp(token['expires_at']),
+                     token.get('project', {}).get('id', c.project_id))
+
+
+    def _issue_v2(self):
+        c = self._credentials
+        auth = { 'passwordCredentials': { 'username': c.username, 'password': c.password } }
+        if c.project_id:
+            auth['tenantId'] = c.project_id
+        else:
+            auth['tenantName'] = c.project_name
+        _, body = self._post('/tokens', { 'auth': auth })
+        token = body['access']['token']
+        return Token(token['id'], parse_timestamp(token['expires']), token.get('tenant', {}).get('id', c.project_id))
+
+
+    def issue_token(self):
+        return self._issue_v2() if is_v2(self._credentials.auth_url) else self._issue_v3()
+
+
+class TokenCache(object):
+    """
+    Tokens keyed by endpoint, user and project, in a JSON file only
+    readable by its owner.  Concurrent runs wait for the one that is
+    fetching a token instead of fetching their own.
+    """
+
+    def __init__(self, path=DefaultCacheFilename, refresh_margin=DefaultRefreshMargin):
+        self._path = path
+        self._refresh_margin = refresh_margin
+
+
+    @staticmethod
+    def key(credentials):
+        c = credentials
+        fields = (c.auth_url.rstrip('/'), c.username, c.user_domain_id or c.user_domain_name,
+                  c.project_id or '{}@{}'.format(c.project_name, c.project_domain_id or c.project_domain_name))
+        return hashlib.sha256('\n'.join(fields).encode()).hexdigest()[:16]
+
+
+    def _read(self):
+        try:
+            with open(self._path) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+
+    def _write(self, entries):
+        tmp = '{}.{}'.format(self._path, os.getpid())
+        with open(os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as f:
+            json.dump(entries, f, indent=1, sort_keys=True)
+        os.replace(tmp, self._path)
+
+
+    def _valid(self, entry):
+        return entry is not None and entry['expires_at'] - self._refresh_margin > time.time()
+
+
+    def get(self, credentials, issue):
+        """
+        Return the cached token for the credentials, calling issue() to get a
+        new one if it's missing or about to expire.
+        """
+        key = self.key(credentials)
+        entry = self._read().get(key)
+        if not self._valid(entry):
+            with open(os.open(self._path + '.lock', os.O_WRONLY | os.O_CREAT, 0o600)) as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                # check again: another run may have refreshed it while we waited
+                entries = self._read()
+                entry = entries.get(key)
+                if not self._valid(entry):
+                    token = issue()
+                    entry = token._asdict()
+                    # drop the expired tokens of the other clouds
+                    entries = { k: v for k, v in entries.items() if v['expires_at'] > time.time() }
+                    entries[key] = entry
+                    self._write(entries)
+        return Token(**entry)
+
+
+def password_cloud(credentials):
+    c = credentials
+    auth = { 'auth_url': c.auth_url, 'username': c.username, 'password': c.password }
+    if is_v2(c.auth_url):
+        auth.update(project_id=c.project_id, project_name=c.project_name)
+    else:
+        auth['project_id'] = c.project_id
+        if c.project_name:
+            auth['project_name'] = c.project_name
+        auth.update(user_domain_name=c.user_domain_name, project_domain_name=c.project_domain_name)
+    cloud = { 'auth': auth, 'region_name': c.region_name }
+    if c.cacert:
+        cloud['cacert'] = c.cacert
+    return cloud
+
+
+def token_cloud(credentials, token):
+    c = credentials
+    cloud = { 'auth_type': 'v2token' if is_v2(c.auth_url) else 'v3token',
+              'auth': { 'auth_url': c.auth_url, 'token': token.id, 'project_id': token.project_id },
+              'region_name': c.region_name }
+    if c.cacert:
+        cloud['cacert'] = c.cacert
+    return cloud
+
+
+def token_env(credentials, token):
+    """
+    The OS_* variables to authenticate with the token, as (name, value) pairs.
+    """
+    c = credentials
+    env = [ ('OS_AUTH_URL', c.auth_url),
+            ('OS_AUTH_TYPE', 'v2token' if is_v2(c.auth_url) else 'v3token'),
+            ('OS_IDENTITY_API_VERSION', '2' if is_v2(c.auth_url) else '3'),
+            ('OS_TOKEN', token.id),
+            ('OS_PROJECT_ID', token.project_id) ]
+    if c.region_name:
+        env.append(('OS_REGION_NAME', c.region_name))
+    if c.cacert:
+        env.append(('OS_CACERT', c.cacert))
+    return env
+
+
+def write_env_file(filename, credentials, token):
+    # docker's env-file format:  no quoting, comments on their own lines
+    with open(os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as f:
+        f.write('# expires-at {}\n'.format(int(token.expires_at)))
+        for name, value in token_env(credentials, token):
+            f.write('{}={}\n'.format(name, value))
+
+
+def merge_clouds(filename, clouds):
+    """
+    Add or replace `clouds` in the clouds.yaml file, keeping the other clouds.
+    Without PyYAML the file is written as JSON, which is valid YAML.
+    """
+    try:
+        import yaml
+    except ImportError:
+        yaml = None
+    existing = {}
+    if os.path.exists(filename):
+        with open(filename) as f:
+            text = f.read()
+        if yaml:
+            existing = yaml.safe_load(text) or {}
+        else:
+            try:
+                existing = json.loads(text)
+            except ValueError:
+                print("Can't parse {} without PyYAML:  replacing it".format(filename), file=sys.stderr)
+    existing.setdefault('clouds', {}).update(clouds)
+    with open(os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as f:
+        if yaml:
+            yaml.safe_dump(existing, f, default_flow_style=False)
+        else:
+            json.dump(existing, f, indent=2, sort_keys=True)
+            f.write('\n')
+
+
+def _build_parser():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('cloud_config', metavar='CLOUD_CONFIG',
+                        help="k8s cloud_config file, or '-' for the OS_* environment variables")
+    parser.add_argument('cloud', metavar='CLOUD', nargs='?', help="Name of the cloud in CLOUDS_YAML")
+    parser.add_argument('clouds_yaml', metavar='CLOUDS_YAML', nargs='?', help="clouds.yaml file to update")
+    parser.add_argument('--token', action='store_true', help="Also write a token-auth cloud, with a cached token")
+    parser.add_argument('--cache', metavar='FILE', help="Token cache (default: {} next to CLOUDS_YAML or "
+                        "in the current directory)".format(DefaultCacheFilename))
+    parser.add_argument('--env-file', metavar='FILE', help="Write the OS_* variables for token auth to FILE")
+    parser.add_argument('--refresh-margin', metavar='SECONDS', type=int, default=DefaultRefreshMargin,
+                        help="Replace cached tokens that expire within SECONDS")
+    parser.add_argument('--timeout', metavar='SECONDS', type=int, default=DefaultTimeout)
+    return parser
+
+
+def main(args=None):
+    parser = _build_parser()
+    options = parser.parse_args(args)
+    if bool(options.cloud) != bool(options.clouds_yaml):
+        parser.error("CLOUD and CLOUDS_YAML go together")
+    if options.env_file and not options.token:
+        parser.error("--env-file requires --token")
+    if not options.clouds_yaml and not options.env_file:
+        parser.error("Nothing to write:  give CLOUD and CLOUDS_YAML, or --token and --env-file")
+
+    if options.cloud_config == '-':
+        try:
+            credentials = credentials_from_env()
+        except RuntimeError as e:
+            sys.exit(str(e))
     else:
-        yml_string = v3_clouds_template.format(
-            cloud=cloud_name,
-            auth_url=global_section['auth-url'],
-            username=global_section['username'],
-            password=global_section['password'],
-            project_id=global_section.get('tenant-id', ''),
-            user_domain_name=global_section.get('domain-name', 'default'),
-            project_domain_name=global_section.get('domain-name', 'default'),
-            region_name=global_section.get('region', ''))
-
-    with open(clouds_yaml_file, 'w') as f:
-        f.write(yml_string)
+        credentials = credentials_from_cloud_cfg(options.cloud_config)
+
+    clouds = collections.OrderedDict()
+    if options.cloud:
+        clouds[options.cloud] = password_cloud(credentials)
+    if options.token:
+        cache_file = options.cache or os.path.join(os.path.dirname(options.clouds_yaml or '') or '.',
+                                                   DefaultCacheFilename)
+        keystone = Keystone(credentials, options.timeout)
+        try:
+            token = TokenCache(cache_file, options.refresh_margin).get(credentials, keystone.issue_token)
+        except (urllib.error.URLError, KeyError, ValueError) as e:
+            sys.exit("Can't get a token from {}: {}".format(credentials.auth_url, e))
+        if options.cloud:
+            clouds[options.cloud + TokenCloudSuffix] = token_cloud(credentials, token)
+        if options.env_file:
+            write_env_file(options.env_file, credentials, token)
+    if options.clouds_yaml:
+        merge_clouds(options.clouds_yaml, clouds)
+
+
+if __name__ == '__main__':
+    main()
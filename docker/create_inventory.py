@@ -15,12 +15,15 @@
 # limitations under the License.
 
 import os
+import re
 import json
 import argparse
 import random
+import collections
 import configparser
+import shlex
 
-VERSION = '0.2.0'
+VERSION = '0.4.0'
 
 
 class KubeSprayGroupName(object):
@@ -31,85 +34,345 @@ class KubeSprayGroupName(object):
     CLUSTER = 'k8s-cluster'
     MASTER = 'kube-master'
     NODE = 'kube-node'
-    # cache list
+    # caches
     __list__ = None
+    __set__ = None
 
     @staticmethod
     def list():
         if KubeSprayGroupName.__list__ is None:
             KubeSprayGroupName.__list__ = [KubeSprayGroupName.__dict__[x] for x in KubeSprayGroupName.__dict__ if
-                                           not x.startswith('_') and x != 'list']
+                                           not x.startswith('_') and x not in ('list', 'set')]
             KubeSprayGroupName.__list__.sort()
         return KubeSprayGroupName.__list__
 
+    @staticmethod
+    def set():
+        if KubeSprayGroupName.__set__ is None:
+            KubeSprayGroupName.__set__ = frozenset(KubeSprayGroupName.list())
+        return KubeSprayGroupName.__set__
 
-class Instance(object):
 
-    def __init__(self, raw_data):
+class Instance(object):
+    """
+    The attributes of an openstack_compute_instance_v2 resource needed for the
+    inventory, extracted once from the resource data (which isn't kept).
+    """
+    __slots__ = ('_address', '_id', '_name', '_kubespray_groups', '_group_set',
+                 '_private_ip', '_floating_ip', '_fixed_ip', '_ssh_user')
+
+    def __init__(self, raw_data, address=None):
         super(Instance, self).__init__()
-        self._raw_data = raw_data
+        attributes = raw_data['primary']['attributes']
+        self._address = address
+        self._id = attributes['id']
+        self._name = attributes['name']
+        self._kubespray_groups = tuple(attributes['all_metadata.kubespray_groups'].split(','))
+        self._group_set = frozenset(self._kubespray_groups)
+        self._private_ip = attributes['access_ip_v4']
+        self._floating_ip = attributes.get('network.0.floating_ip')
+        self._fixed_ip = attributes.get('network.0.fixed_ip_v4')
+        self._ssh_user = attributes['metadata.ssh_user']
+
+    @property
+    def address(self):
+        """
+        Terraform resource address (e.g., module.compute.openstack_compute_instance_v2.k8s_node[1])
+        """
+        return self._address
 
     @property
     def id(self):
-        return self._raw_data['primary']['attributes']['id']
+        return self._id
 
     @property
     def name(self):
-        return self._raw_data['primary']['attributes']['name']
+        return self._name
 
     @property
     def kubespray_groups(self):
-        return self._raw_data['primary']['attributes']['all_metadata.kubespray_groups'].split(',')
+        return self._kubespray_groups
+
+    def in_group(self, group):
+        return group in self._group_set
 
     def is_bastion_node(self):
-        return 'bastion' in self.kubespray_groups
+        return KubeSprayGroupName.BASTION in self._group_set
 
     @property
     def private_ip(self):
-        return self._raw_data['primary']['attributes']['access_ip_v4']
+        return self._private_ip
+
+    @property
+    def fixed_ip(self):
+        return self._fixed_ip
 
     @property
     def floating_ip(self):
-        return self._raw_data['primary']['attributes']['network.0.floating_ip']
+        return self._floating_ip
 
     @floating_ip.setter
     def floating_ip(self, fip):
-        self._raw_data['primary']['attributes']['network.0.floating_ip'] = fip
+        self._floating_ip = fip
 
     @property
     def ssh_user(self):
-        return self._raw_data['primary']['attributes']['metadata.ssh_user']
+        return self._ssh_user
+
+
+class _JsonStream(object):
+    """
+    Minimal pull parser over a JSON file.  It walks objects and arrays one
+    member at a time and only decodes the values it's asked for, so memory
+    use is bounded by the largest single value read rather than by the size
+    of the document.
+    """
+    CHUNK_SIZE = 1 << 16
+    PEEK_SIZE = 1024
+    NOT_BUFFERED = object()
+    _decoder = json.JSONDecoder()
+    _whitespace = re.compile(r'[ \t\n\r]*')
+    _first_member = re.compile(r'\{[ \t\n\r]*"([^"\\]*)"[ \t\n\r]*:[ \t\n\r]*"([^"\\]*)"')
+    # anything up to the next bracket that isn't in a string
+    _skip_run = re.compile(r'[^"{}\[\]]*(?:"[^"\\]*(?:\\.[^"\\]*)*"[^"{}\[\]]*)*')
+
+    def __init__(self, stream):
+        super(_JsonStream, self).__init__()
+        self._stream = stream
+        self._buf = ''
+        self._pos = 0
+        self._eof = False
+
+    def _fill(self, size=None):
+        chunk = self._stream.read(size or self.CHUNK_SIZE)
+        if not chunk:
+            self._eof = True
+            return False
+        self._buf = self._buf[self._pos:] + chunk
+        self._pos = 0
+        return True
+
+    def _peek(self):
+        while True:
+            self._pos = self._whitespace.match(self._buf, self._pos).end()
+            if self._pos < len(self._buf):
+                return self._buf[self._pos]
+            if not self._fill():
+                raise ValueError("Unexpected end of JSON data")
+
+    def _expect(self, chars):
+        c = self._peek()
+        if c not in chars:
+            raise ValueError("Expected one of {!r} in JSON data, found {!r}".format(chars, c))
+        self._pos += 1
+        return c
+
+    def value(self):
+        """
+        Decode the next value.
+        """
+        self._peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buf, self._pos)
+                # a number could continue in the next chunk
+                if end < len(self._buf) or self._eof:
+                    self._pos = end
+                    return value
+            except ValueError:
+                if self._eof:
+                    raise
+            # grow the buffer geometrically to keep decoding large values linear
+            self._fill(max(self.CHUNK_SIZE, len(self._buf) - self._pos))
+
+    def buffered_value(self):
+        """
+        Decode the next value if it's all in the buffer already, or return
+        NOT_BUFFERED without consuming anything.  The C decoder goes over a
+        small value faster than any peek or scan in Python, and the memory it
+        takes is bounded by the buffer.
+        """
+        self._peek()
+        try:
+            value, end = self._decoder.raw_decode(self._buf, self._pos)
+        except ValueError:
+            return self.NOT_BUFFERED
+        # a number could continue in the next chunk
+        if end == len(self._buf) and not self._eof:
+            return self.NOT_BUFFERED
+        self._pos = end
+        return value
+
+    def skip(self):
+        """
+        Skip the next value.  Objects and arrays that are already in the
+        buffer are decoded and dropped; the others (large values, or the ones
+        the buffer ends in) are scanned for their end without decoding
+        anything in them.
+        """
+        if self._peek() not in '{[':
+            self.value()
+            return
+        if self.buffered_value() is not self.NOT_BUFFERED:
+            return
+        self._pos += 1
+        depth = 1
+        # brackets in strings don't count:  the regex consumes whole strings
+        while True:
+            self._pos = self._skip_run.match(self._buf, self._pos).end()
+            if self._pos == len(self._buf) or self._buf[self._pos] == '"':
+                # the buffer ends, possibly in the middle of a string
+                if not self._fill(max(self.CHUNK_SIZE, len(self._buf) - self._pos)):
+                    raise ValueError("Unexpected end of JSON data")
+                continue
+            depth += 1 if self._buf[self._pos] in '{[' else -1
+            self._pos += 1
+            if depth == 0:
+                return
+
+    def peek_first_member(self):
+        """
+        If the next value is an object whose first member has a plain string
+        value (e.g., {"type": "openstack_compute_instance_v2", ...}), return
+        that (key, value) pair without consuming anything.  Return None
+        otherwise, or if the strings have escapes.
+        """
+        self._peek()
+        if len(self._buf) - self._pos < self.PEEK_SIZE and not self._eof:
+            self._fill()
+        match = self._first_member.match(self._buf, self._pos)
+        return match.groups() if match else None
+
+    def members(self):
+        """
+        Iterate over the keys of the next object.  The value of each member
+        must be consumed (value, skip, members or elements) before advancing.
+        """
+        self._expect('{')
+        if self._peek() == '}':
+            self._pos += 1
+            return
+        while True:
+            key = self.value()
+            self._expect(':')
+            yield key
+            if self._expect(',}') == '}':
+                return
+
+    def elements(self):
+        """
+        Iterate over the next array.  Each element must be consumed before advancing.
+        """
+        self._expect('[')
+        if self._peek() == ']':
+            self._pos += 1
+            return
+        while True:
+            yield
+            if self._expect(',]') == ']':
+                return
 
 
 class TerraformState(object):
 
-    def __init__(self, json_data):
+    # '- address' / '-/+ address' (terraform 0.11), '# address will be destroyed' / 'must be replaced' (0.12+)
+    PLAN_DESTROY_LINE = re.compile(r'^\s*(?:(?:-|-/\+)\s+(\S*openstack_compute_instance_v2\.\S+)'
+                                   r'|#\s+(\S*openstack_compute_instance_v2\.\S+) (?:will be destroyed|must be replaced))',
+                                   re.MULTILINE)
+
+    # the only resources needed to build the inventory
+    RESOURCE_TYPES = ('openstack_compute_instance_v2', 'openstack_compute_floatingip_associate_v2')
+    METADATA_KEYS = ('version', 'serial', 'lineage', 'terraform_version')
+
+    def __init__(self, resources, metadata=None, outputs=None):
+        """
+        :param resources: iterable of (address, resource) pairs, with resources
+                          in the terraform 0.11 format (attributes in flatmap form)
+        :param metadata: state version, serial, lineage and terraform_version
+        :param outputs: values of the outputs of the root module, by name
+        """
         super(TerraformState, self).__init__()
-        self._json_data = json_data
-        self._instances, self._fip_associations, self._groups = TerraformState.parse_json_data(json_data)
+        self._metadata = metadata if metadata is not None else {}
+        self._outputs = outputs if outputs is not None else {}
+        self._instances, self._fip_associations, self._groups = TerraformState.parse_resources(resources)
+        # indexes
+        self._by_name = {}
+        self._by_address = {}
+        self._bastion = None
+        self._private = []
+        for i in self._instances.values():
+            self._by_name.setdefault(i.name, i)
+            self._by_address[i.address] = i
+            if self._bastion is None and i.is_bastion_node():
+                self._bastion = i
+            if not i.floating_ip:
+                self._private.append(i)
+
+    @property
+    def serial(self):
+        return self._metadata.get('serial')
+
+    @property
+    def lineage(self):
+        return self._metadata.get('lineage')
 
     @property
     def instances(self):
         return self._instances
 
+    def output(self, name):
+        """
+        The value of an output of the root module (e.g., k8s_master_fips), or None.
+        """
+        return self._outputs.get(name)
+
     def get_instance_by_id(self, id):
         return self.instances[id]
 
+    def get_instance_by_name(self, name):
+        return self._by_name.get(name)
+
+    def get_instance_by_address(self, address):
+        instance = self._by_address.get(address)
+        # terraform 0.11 doesn't index resources with count = 1
+        if instance is None and address.endswith('[0]'):
+            instance = self._by_address.get(address[:-3])
+        return instance
+
+    def planned_removals(self, plan_text):
+        """
+        Instances of this state that are going to be destroyed (or replaced)
+        by the plan, given the output of `terraform show -no-color PLAN`.
+        """
+        removed = []
+        for match in TerraformState.PLAN_DESTROY_LINE.finditer(plan_text):
+            instance = self.get_instance_by_address(match.group(1) or match.group(2))
+            if instance and instance not in removed:
+                removed.append(instance)
+        return removed
+
+    @staticmethod
+    def diff(old_state, new_state):
+        """
+        Return the lists of the instances added to and removed from old_state in new_state.
+        """
+        added = [ i for i_id, i in new_state.instances.items() if i_id not in old_state.instances ]
+        removed = [ i for i_id, i in old_state.instances.items() if i_id not in new_state.instances ]
+        return added, removed
+
     @property
     def kubespray_groups(self):
         return self._groups
 
+    @property
+    def private_instances(self):
+        return self._private
+
     def has_private_instances(self):
-        for i in self._instances.values():
-            if not i.floating_ip:
-                return True
-        return False
+        return len(self._private) > 0
 
     def get_bastion_instance(self):
-        for i in self._instances.values():
-            if i.is_bastion_node():
-                return i
-        return None
+        return self._bastion
 
     def choose_random_fip_instance(self):
         if len(self._fip_associations) == 0:
@@ -117,42 +380,220 @@ class TerraformState(object):
         return random.choice(list(self._fip_associations.values()))
 
     @staticmethod
-    def parse_json_data(json_data):        
+    def parse_json_data(json_data):
+        return TerraformState.parse_resources(TerraformState.iter_json_resources(json_data))
+
+    @staticmethod
+    def parse_resources(resources):
         fips = {}
         public_ips = {}
         instances = {}
         groups = {x: [] for x in KubeSprayGroupName.list()}
-
-        for m in json_data['modules']:
-            for r in m['resources']:
-                resource = m['resources'][r]                
-                rtype = resource['type']
-                if rtype == 'openstack_compute_instance_v2':
-                    instance = Instance(resource)
-                    instances[instance.id] = instance
-                    if not instance.is_bastion_node():
-                        groups['all'].append(instance.id)
-                        for g in instance.kubespray_groups:
-                            if g in KubeSprayGroupName.list():
-                                groups[g].append(instance.id)
-                    if "k8s_master_ext_net" in r: # check master subtype by name
-                        instance.floating_ip = resource['primary']['attributes']['network.0.fixed_ip_v4']
-                        public_ips[instance.floating_ip] = instance
-                elif rtype == 'openstack_compute_floatingip_associate_v2':
-                    fips[resource['primary']['attributes']['instance_id']] = resource
+        known_groups = KubeSprayGroupName.set()
+
+        for address, resource in resources:
+            rtype = resource['type']
+            if rtype == 'openstack_compute_instance_v2':
+                instance = Instance(resource, address)
+                instances[instance.id] = instance
+                if not instance.is_bastion_node():
+                    groups['all'].append(instance.id)
+                    for g in instance.kubespray_groups:
+                        if g in known_groups:
+                            groups[g].append(instance.id)
+                if "k8s_master_ext_net" in address: # check master subtype by name
+                    instance.floating_ip = instance.fixed_ip
+                    public_ips[instance.floating_ip] = instance
+            elif rtype == 'openstack_compute_floatingip_associate_v2':
+                attributes = resource['primary']['attributes']
+                fips[attributes['instance_id']] = attributes['floating_ip']
 
         # associate floating ip to instances
         for i_id, instance in instances.items():
             if i_id in fips:
-                instance.floating_ip = fips[i_id]['primary']['attributes']['floating_ip']
+                instance.floating_ip = fips[i_id]
                 public_ips[instance.floating_ip] = instance
 
         return instances, public_ips, groups
 
+    @staticmethod
+    def iter_json_resources(json_data):
+        """
+        Iterate over the (address, resource) pairs of the relevant resources in a
+        state that has already been decoded.
+        """
+        for m in json_data.get('modules', ()):  # terraform < 0.12
+            for key, resource in m.get('resources', {}).items():
+                if resource.get('type') in TerraformState.RESOURCE_TYPES and not key.startswith('data.'):
+                    yield TerraformState.__resource_address(m['path'], key), resource
+        for header in json_data.get('resources', ()):  # state format version 4
+            if TerraformState.__wanted_v4_resource(header):
+                for instance in header.get('instances', ()):
+                    yield TerraformState.__v4_resource(header, instance)
+
+    @staticmethod
+    def iter_stream_resources(stream, metadata, outputs=None):
+        """
+        Iterate over the (address, resource) pairs of the relevant resources of
+        the state read from a _JsonStream, skipping all the other ones without
+        keeping them in memory.  The top level state metadata is stored in the
+        metadata dict and, if given, the values of the root module outputs in
+        the outputs dict.
+        """
+        if outputs is None:
+            outputs = {}
+        for key in stream.members():
+            if key == 'modules':
+                for _ in stream.elements():
+                    yield from TerraformState.__stream_module(stream, outputs)
+            elif key == 'resources':
+                for _ in stream.elements():
+                    yield from TerraformState.__stream_v4_resource(stream)
+            elif key == 'outputs':  # state format version 4
+                outputs.update(TerraformState.__output_values(stream.value()))
+            elif key in TerraformState.METADATA_KEYS:
+                metadata[key] = stream.value()
+            else:
+                stream.skip()
+
+    @staticmethod
+    def __output_values(outputs):
+        return { name: output.get('value') for name, output in outputs.items() }
+
+    @staticmethod
+    def __stream_module(stream, outputs):
+        path = None
+        module_outputs = {}
+        pending = []  # resources seen before the module path
+        for key in stream.members():
+            if key == 'path':
+                path = stream.value()
+            elif key == 'outputs':
+                module_outputs = TerraformState.__output_values(stream.value())
+            elif key == 'resources':
+                for rkey in stream.members():
+                    if rkey.startswith('data.'):
+                        stream.skip()
+                        continue
+                    resource = TerraformState.__stream_v3_resource(stream)
+                    if resource is None:
+                        continue
+                    if path is None:
+                        pending.append((rkey, resource))
+                    else:
+                        yield TerraformState.__resource_address(path, rkey), resource
+            else:
+                stream.skip()
+        if (path or ['root']) == ['root']:
+            outputs.update(module_outputs)
+        for rkey, resource in pending:
+            yield TerraformState.__resource_address(path or ['root'], rkey), resource
+
+    @staticmethod
+    def __stream_v3_resource(stream):
+        """
+        Read a resource of a 0.11 module, or return None if it isn't one of
+        the RESOURCE_TYPES.  Resources already in the read buffer (almost all
+        of them) are decoded whole; the large ones aren't decoded if they
+        aren't wanted:  terraform writes their type first, so they're skipped
+        after reading just that.
+        """
+        resource = stream.buffered_value()
+        if resource is _JsonStream.NOT_BUFFERED:
+            first = stream.peek_first_member()
+            if first and first[0] == 'type' and first[1] not in TerraformState.RESOURCE_TYPES:
+                stream.skip()
+                return None
+            resource = stream.value()
+        return resource if resource.get('type') in TerraformState.RESOURCE_TYPES else None
+
+    @staticmethod
+    def __stream_v4_resource(stream):
+        header = {}
+        instances = None
+        for key in stream.members():
+            if key in ('module', 'mode', 'type', 'name'):
+                header[key] = stream.value()
+            elif key == 'instances' and 'type' not in header:
+                # unusual key order:  decide once the whole resource is read
+                instances = stream.value()
+            elif key == 'instances' and TerraformState.__wanted_v4_resource(header):
+                for _ in stream.elements():
+                    yield TerraformState.__v4_resource(header, stream.value())
+            else:
+                stream.skip()
+        if instances and TerraformState.__wanted_v4_resource(header):
+            for instance in instances:
+                yield TerraformState.__v4_resource(header, instance)
+
+    @staticmethod
+    def __wanted_v4_resource(header):
+        return header.get('mode', 'managed') == 'managed' and header.get('type') in TerraformState.RESOURCE_TYPES
+
+    @staticmethod
+    def __v4_resource(header, instance):
+        # convert to the 0.11 format used by the rest of the code
+        address = '{}.{}'.format(header['type'], header['name'])
+        if header.get('module'):
+            address = '{}.{}'.format(header['module'], address)
+        if 'index_key' in instance:
+            address += '[{}]'.format(json.dumps(instance['index_key']))
+        return address, { 'type': header['type'],
+                          'primary': { 'attributes': TerraformState.__flatten(instance.get('attributes') or {}) } }
+
+    @staticmethod
+    def __flatten(attributes):
+        # nested attributes to flatmap keys, e.g., network[0].floating_ip -> network.0.floating_ip
+        flat = {}
+        stack = [ ('', attributes) ]
+        while stack:
+            prefix, value = stack.pop()
+            if isinstance(value, dict):
+                children = value.items()
+            elif isinstance(value, list):
+                children = enumerate(value)
+            else:
+                flat[prefix] = value
+                continue
+            for k, v in children:
+                stack.append(('{}.{}'.format(prefix, k) if prefix else str(k), v))
+        return flat
+
+    @staticmethod
+    def __resource_address(module_path, key):
+        # state keys look like 'openstack_compute_instance_v2.k8s_node.2'
+        parts = key.split('.')
+        if len(parts) == 3 and parts[2].isdigit():
+            key = '{}.{}[{}]'.format(*parts)
+        return ''.join('module.{}.'.format(p) for p in module_path[1:]) + key
+
+    @staticmethod
+    def read_metadata(filename):
+        """
+        Read the version, serial and lineage of a state without parsing its
+        resources (terraform writes them at the top of the file).
+        """
+        metadata = {}
+        with open(filename) as f:
+            stream = _JsonStream(f)
+            for key in stream.members():
+                if key in TerraformState.METADATA_KEYS:
+                    metadata[key] = stream.value()
+                    if all(k in metadata for k in TerraformState.METADATA_KEYS):
+                        break
+                elif key in ('modules', 'resources'):
+                    break
+                else:
+                    stream.skip()
+        return metadata
+
     @staticmethod
     def load(filename):
+        metadata = {}
+        outputs = {}
         with open(filename) as f:
-            return TerraformState(json.load(f))
+            return TerraformState(TerraformState.iter_stream_resources(_JsonStream(f), metadata, outputs),
+                                  metadata, outputs)
 
 
 class Inventory(object):
@@ -161,6 +602,64 @@ class Inventory(object):
     def __format_node_name(instance):
         return 'bastion' if instance.is_bastion_node() else instance.name
 
+    PYTHON_INTERPRETER = '/usr/bin/python3'
+
+    @staticmethod
+    def __host_vars(instance):
+        return collections.OrderedDict((
+            ('ansible_host', instance.floating_ip or instance.private_ip),
+            ('ip', instance.private_ip),
+            ('ansible_ssh_user', instance.ssh_user)))
+
+    @staticmethod
+    def __bastion_vars(bastion):
+        return collections.OrderedDict((('ansible_host', bastion.floating_ip), ('ansible_user', bastion.ssh_user)))
+
+    @staticmethod
+    def __format_line(name, host_vars):
+        return ' '.join([ name ] + [ '{}={}'.format(k, v) for k, v in host_vars.items() ])
+
+    @staticmethod
+    def __host_line(instance):
+        return Inventory.__format_line(Inventory.__format_node_name(instance), Inventory.__host_vars(instance))
+
+    @staticmethod
+    def __bastion_line(bastion):
+        return Inventory.__format_line(KubeSprayGroupName.BASTION, Inventory.__bastion_vars(bastion))
+
+    @staticmethod
+    def as_dict(terraform_state):
+        """
+        The inventory in the JSON format of ansible dynamic inventories, with
+        the variables of all hosts in _meta.hostvars.  It has the same hosts,
+        groups and variables as the one written by `generate`.
+
+        :type terraform_state: TerraformState
+        """
+        groups = terraform_state.kubespray_groups
+        # host names are lowercase in the ini inventory (configparser folds them)
+        hostvars = collections.OrderedDict()
+        for i in groups['all']:
+            instance = terraform_state.instances[i]
+            if not instance.is_bastion_node():
+                hostvars[Inventory.__format_node_name(instance).lower()] = Inventory.__host_vars(instance)
+
+        inventory = collections.OrderedDict()
+        inventory['all'] = { 'hosts': list(hostvars), 'vars': { 'ansible_python_interpreter': Inventory.PYTHON_INTERPRETER } }
+
+        bastion = terraform_state.get_bastion_instance()
+        if bastion or terraform_state.has_private_instances():
+            bastion = bastion or terraform_state.choose_random_fip_instance()
+            hostvars[KubeSprayGroupName.BASTION] = Inventory.__bastion_vars(bastion)
+            inventory['all']['hosts'].append(KubeSprayGroupName.BASTION)
+            inventory[KubeSprayGroupName.BASTION] = { 'hosts': [ KubeSprayGroupName.BASTION ] }
+
+        for group in KubeSprayGroupName.list()[2:]:
+            inventory[group] = { 'hosts': [ Inventory.__format_node_name(terraform_state.instances[i]).lower()
+                                            for i in groups[group] ] }
+        inventory['_meta'] = { 'hostvars': hostvars }
+        return inventory
+
     @staticmethod
     def generate(terraform_state, output_stream):
         """
@@ -183,17 +682,11 @@ class Inventory(object):
         for i in groups['all']:
             instance = terraform_state.instances[i]
             if not instance.is_bastion_node():
-                node_name = Inventory.__format_node_name(instance)
-                config.set('all', "{} ansible_host={} ip={} ansible_ssh_user={}"
-                           .format(node_name,
-                                   instance.floating_ip or instance.private_ip,
-                                   instance.private_ip,
-                                   instance.ssh_user))
+                config.set('all', Inventory.__host_line(instance))
 
         if bastion or terraform_state.has_private_instances():
             bastion = bastion or terraform_state.choose_random_fip_instance()
-            config.set('all', "{} ansible_host={} ansible_user={}"
-                       .format(KubeSprayGroupName.BASTION, bastion.floating_ip, bastion.ssh_user))
+            config.set('all', Inventory.__bastion_line(bastion))
             config.add_section(KubeSprayGroupName.BASTION)
             config.set(KubeSprayGroupName.BASTION, KubeSprayGroupName.BASTION)
 
@@ -207,13 +700,223 @@ class Inventory(object):
 
         all_vars = "all:vars"
         config.add_section(all_vars)
-        config.set(all_vars, 'ansible_python_interpreter', '/usr/bin/python3')
+        config.set(all_vars, 'ansible_python_interpreter', Inventory.PYTHON_INTERPRETER)
 
         # write the output file
         if output_stream:
             config.write(output_stream)
 
 
+    @staticmethod
+    def update(inventory_filepath, new_state, added=(), removed=()):
+        """
+        Update an inventory generated by `generate` adding and removing the
+        given instances, leaving the lines of all the other hosts untouched.
+
+        :param new_state: the terraform state after the change
+        :type new_state: TerraformState
+        """
+        config = configparser.RawConfigParser(allow_no_value=True)
+        config.read(inventory_filepath)
+
+        def host_options(section, name):
+            # host lines are parsed as 'name ansible_host' = 'x ...' or as a bare 'name'
+            return [ o for o in config.options(section) if o.split()[0] == name.lower() ]
+
+        removed_names = set(Inventory.__format_node_name(i) for i in removed)
+        for section in config.sections():
+            for name in removed_names:
+                for option in host_options(section, name):
+                    config.remove_option(section, option)
+
+        for instance in added:
+            if instance.is_bastion_node():
+                continue
+            config.set('all', Inventory.__host_line(instance))
+            for group in KubeSprayGroupName.list()[2:]:
+                if instance.in_group(group):
+                    config.set(group, Inventory.__format_node_name(instance))
+
+        # the bastion may have been one of the removed instances or may now be needed
+        bastion_options = host_options('all', KubeSprayGroupName.BASTION)
+        bastion_gone = any(config.get('all', o).split()[0] == i.floating_ip
+                           for o in bastion_options for i in removed if i.floating_ip)
+        if bastion_gone or (not bastion_options and new_state.has_private_instances()):
+            for option in bastion_options:
+                config.remove_option('all', option)
+            bastion = new_state.get_bastion_instance() or new_state.choose_random_fip_instance()
+            config.set('all', Inventory.__bastion_line(bastion))
+            # the group lost its member with the old bastion, if it was there
+            if not config.has_section(KubeSprayGroupName.BASTION):
+                config.add_section(KubeSprayGroupName.BASTION)
+            config.set(KubeSprayGroupName.BASTION, KubeSprayGroupName.BASTION)
+        else:
+            # keep the bastion after the added hosts, like `generate` does
+            for option in bastion_options:
+                value = config.get('all', option)
+                config.remove_option('all', option)
+                config.set('all', option, value)
+
+        with open(inventory_filepath, 'w') as f:
+            config.write(f, space_around_delimiters=False)
+
+
+class StateCache(object):
+    """
+    Data computed from the terraform state and cached in a file next to it.
+
+    The data is recomputed only when the state's lineage or serial change
+    (terraform bumps the serial on every change), so repeated queries don't
+    parse the state every time.  Subclasses set CACHE_FILENAME and compute the
+    data in `_compute`.
+    """
+
+    CACHE_FILENAME = None
+
+    def __init__(self, terraform_state_filepath, cache_filepath=None):
+        super(StateCache, self).__init__()
+        self._state_filepath = terraform_state_filepath
+        self._cache_filepath = cache_filepath or \
+            os.path.join(os.path.dirname(os.path.abspath(terraform_state_filepath)), self.CACHE_FILENAME)
+
+    def _state_key(self):
+        metadata = TerraformState.read_metadata(self._state_filepath)
+        if metadata.get('serial') is None or metadata.get('lineage') is None:
+            return None
+        return { 'lineage': metadata['lineage'], 'serial': metadata['serial'], 'version': VERSION }
+
+    def _read_cache(self, key):
+        try:
+            with open(self._cache_filepath) as f:
+                cache = json.load(f)
+        except (IOError, ValueError):
+            return None
+        if cache.get('key') != key:
+            return None
+        return cache['data']
+
+    def _write_cache(self, key, data):
+        # write and rename, so that concurrent readers never see a partial file
+        tmp = '{}.{}'.format(self._cache_filepath, os.getpid())
+        try:
+            with open(tmp, 'w') as f:
+                json.dump({ 'key': key, 'data': data }, f)
+            os.replace(tmp, self._cache_filepath)
+        except IOError:
+            # the cache is an optimization:  a read-only directory is not an error
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    def _compute(self, terraform_state):
+        raise NotImplementedError()
+
+    def data(self):
+        key = self._state_key()
+        data = self._read_cache(key) if key else None
+        if data is None:
+            data = self._compute(TerraformState.load(self._state_filepath))
+            if key:
+                self._write_cache(key, data)
+        return data
+
+
+class DynamicInventory(StateCache):
+    """
+    Ansible dynamic inventory (--list/--host) computed from the terraform state.
+    """
+
+    CACHE_FILENAME = '.inventory-cache.json'
+
+    def _compute(self, terraform_state):
+        return Inventory.as_dict(terraform_state)
+
+    def list(self):
+        return self.data()
+
+    def host(self, name):
+        return self.list()['_meta']['hostvars'].get(name, {})
+
+
+class StateQuery(StateCache):
+    """
+    Answers the questions that scripts ask about a cluster (master IPs, nodes,
+    bastion, ssh user and key) without running terraform.
+
+    The answers that come from the state are cached like the dynamic
+    inventory; the ones that come from the cluster variables file
+    (cluster.tf) are read from it every time, which is cheap.
+    """
+
+    CACHE_FILENAME = '.state-query-cache.json'
+    # tfvars lines like 'cluster_name = "my-cluster"'
+    VARIABLE_LINE = re.compile(r'^\s*(\w+)\s*=\s*"([^"]*)"', re.MULTILINE)
+    QUERIES = ('cluster-name', 'master-ips', 'masters', 'nodes', 'bastion', 'ssh-user', 'key-path', 'key-name')
+
+    def __init__(self, terraform_state_filepath, variables_filepath=None, cache_filepath=None):
+        super(StateQuery, self).__init__(terraform_state_filepath, cache_filepath)
+        self._variables_filepath = variables_filepath
+
+    @staticmethod
+    def __node_sort_key(instance):
+        # k8s-node-2 before k8s-node-10
+        return [ int(p) if p.isdigit() else p for p in re.split(r'(\d+)', instance.name) ]
+
+    def _compute(self, terraform_state):
+        instances = terraform_state.instances
+        groups = terraform_state.kubespray_groups
+        masters = sorted((instances[i] for i in groups[KubeSprayGroupName.MASTER]), key=StateQuery.__node_sort_key)
+        nodes = sorted((instances[i] for i in groups[KubeSprayGroupName.NODE]), key=StateQuery.__node_sort_key)
+        bastion = terraform_state.get_bastion_instance()
+        ssh_users = set(i.ssh_user for i in instances.values() if i.ssh_user)
+        # in the order of `terraform output k8s_master_fips`, like the scripts always got them
+        master_ips = terraform_state.output('k8s_master_fips')
+        if master_ips is None:
+            master_ips = [ i.floating_ip for i in masters ]
+        return {
+            'master-ips': [ ip for ip in master_ips if ip ],
+            'masters': [ i.name for i in masters ],
+            'nodes': [ i.name for i in nodes ],
+            'bastion': bastion.floating_ip if bastion else None,
+            'ssh-user': ssh_users.pop() if len(ssh_users) == 1 else None,
+        }
+
+    def _variables(self):
+        if not self._variables_filepath or not os.path.exists(self._variables_filepath):
+            return {}
+        with open(self._variables_filepath) as f:
+            text = '\n'.join(line for line in f if not line.lstrip().startswith('#'))
+        return dict(StateQuery.VARIABLE_LINE.findall(text))
+
+    def answers(self):
+        if os.path.exists(self._state_filepath):
+            answers = dict(self.data())
+        else:  # not deployed yet
+            answers = { 'master-ips': [], 'masters': [], 'nodes': [], 'bastion': None, 'ssh-user': None }
+        variables = self._variables()
+        answers['cluster-name'] = variables.get('cluster_name')
+        # the state knows the user of the instances, the variables that of new ones
+        answers['ssh-user'] = answers['ssh-user'] or variables.get('ssh_user')
+        key_path = variables.get('public_key_path', '')
+        if key_path.endswith('.pub'):
+            key_path = key_path[:-4]
+        answers['key-path'] = key_path or None
+        answers['key-name'] = os.path.basename(key_path) or None
+        return answers
+
+    @staticmethod
+    def format_shell(answers):
+        """
+        The answers as shell variable assignments, e.g., STATE_MASTER_IPS='1.2.3.4 1.2.3.5'.
+        """
+        lines = []
+        for name in StateQuery.QUERIES:
+            value = answers.get(name)
+            if isinstance(value, list):
+                value = ' '.join(value)
+            lines.append('STATE_{}={}'.format(name.replace('-', '_').upper(), shlex.quote(value or '')))
+        return '\n'.join(lines)
+
+
 def run(terraform_state_filepath, inventory_filepath):
     # load the terraform state
     terraform_state = TerraformState.load(terraform_state_filepath)
@@ -230,18 +933,51 @@ def _build_parse_args():
     parser = argparse.ArgumentParser(__file__, __doc__,
                                      formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     parser.add_argument('--version', action='store_true', help='print version and exit')
-    parser.add_argument('-s', '--terraform-state', default='terraform.tfstate',
-                        help='path of the terraform state file')
+    parser.add_argument('-s', '--terraform-state', default=os.getenv('TERRAFORM_STATE', 'terraform.tfstate'),
+                        help='path of the terraform state file (also set with TERRAFORM_STATE)')
     parser.add_argument('-o', '--output', default='hosts.ini', help='path of the output file')
+    # ansible dynamic inventory interface
+    parser.add_argument('--list', action='store_true', help='print the inventory as JSON')
+    parser.add_argument('--host', help='print the variables of HOST as JSON')
+    subparsers = parser.add_subparsers(dest='command')
+    parser_state = subparsers.add_parser('state', help='query the cluster state',
+                                         description='Print one answer (lists one item per line), '
+                                                     'or all of them as JSON')
+    parser_state.add_argument('query', nargs='?', choices=StateQuery.QUERIES)
+    parser_state.add_argument('--variables', default='cluster.tf',
+                              help='path of the cluster variables file')
+    parser_state.add_argument('--shell', action='store_true',
+                              help='print all the answers as shell variable assignments')
     return parser
 
 
+def query_state(args):
+    answers = StateQuery(args.terraform_state, args.variables).answers()
+    if args.shell:
+        print(StateQuery.format_shell(answers))
+    elif args.query is None:
+        print(json.dumps(answers, sort_keys=True, indent=2))
+    else:
+        value = answers[args.query]
+        if isinstance(value, list):
+            value = '\n'.join(value)
+        if value:
+            print(value)
+
+
 def main():
     parser = _build_parse_args()
     args = parser.parse_args()
     if args.version:
         print('%s %s' % (__file__, VERSION))
         parser.exit()
+    if args.command == 'state':
+        query_state(args)
+        parser.exit()
+    if args.list or args.host:
+        inventory = DynamicInventory(args.terraform_state)
+        print(json.dumps(inventory.list() if args.list else inventory.host(args.host)))
+        parser.exit()
     run(args.terraform_state, args.output)
     parser.exit()
 
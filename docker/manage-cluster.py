@@ -1,19 +1,65 @@
 #!/usr/bin/env python3
 
 import argparse
+import asyncio
+import collections
+import concurrent.futures
+import fcntl
 import git
+import hashlib
+import json
 import logging
 import os
+import posixpath
+import re
+import shutil
+import signal
+import ssl
 import subprocess
 import sys
+import tarfile
+import tempfile
 import time
+import urllib.error
+import urllib.parse
+import urllib.request
 
 from contextlib import contextmanager
 
+import create_inventory
+
 DefaultKubesprayVersion = os.getenv('DEFAULT_KUBESPRAY_VERSION', '2.14.0')
+# Version that the image has checked out, patched and whose requirements it
+# has installed (see the Dockerfile)
+PreinstalledKubesprayVersion = os.getenv('KUBESPRAY_PREINSTALLED_VERSION')
 
 KsVersionStampFilename = 'kubespray_deployer_version'
+UpgradeHistoryFilename = 'kubespray_upgrade_history'
+OperationJournalFilename = 'kubespray_operation_journal'
 PatchFilenameTemplate = '/home/manageks/kubespray_patches/v{}.patch'
+CallbackPluginDir = '/home/manageks/ansible_plugins/callback'
+SshConfigFilename = 'ssh-cluster.conf'
+SshControlPathDir = '/tmp/ansible-cp'
+FactCacheDirname = '.ansible-fact-cache'
+DefaultMaxForks = 50
+DefaultFactCacheTTL = 7200
+DefaultPreflightTimeout = 10
+DefaultPreflightConcurrency = 100
+DefaultPreflightMinFreeMB = 2048
+DefaultWorktreeCacheSize = 4
+DefaultVirtualenvCacheSize = 4
+DefaultArtifactCacheSize = 8
+ArtifactMirrorDir = '/home/manageks/artifact-mirror'
+ArtifactMirrorVarsFilename = 'artifact-mirror.json'
+DefaultArtifactMirrorPort = 8480
+# Upstream registries proxied by the artifact mirror:
+# (KubeSpray variable, upstream URL, port of the pull-through registry on the mirror host)
+ArtifactMirrorRegistries = (
+    ('docker_image_repo', 'https://registry-1.docker.io', 5001),
+    ('quay_image_repo', 'https://quay.io', 5002),
+    ('gcr_image_repo', 'https://gcr.io', 5003),
+    ('kube_image_repo', 'https://k8s.gcr.io', 5004),
+)
 
 # Correspondence between ansible and kubernetes versions
 # (this is manually extracted from the tag commit messages)
@@ -36,6 +82,9 @@ VersionTable = [
     ("2.14.0", "1.18.8")
 ]
 
+# Versions that upgrades can't skip (e.g., 2.9.0 requires changes to the inventory)
+MandatoryUpgradeStops = ("2.9.0",)
+
 
 @contextmanager
 def chdir(new_dir):
@@ -49,18 +98,418 @@ def chdir(new_dir):
         os.chdir(old_dir)
 
 
+class DirectoryCache(object):
+    """
+    A directory of cache entries that can be shared by concurrent and later
+    manage-cluster runs (e.g., across containers through a volume).
+
+    Each process holds a shared lock on the entry it's using and entries are
+    built under an exclusive lock.  The least recently used unlocked entries are
+    evicted when the cache grows beyond max_entries.
+    """
+
+    CompleteMarker = '.manage-cluster-complete'
+
+    def __init__(self, cache_dir, max_entries):
+        self._cache_dir = os.path.abspath(cache_dir)
+        self._max_entries = max_entries
+        self._locks = {}
+        os.makedirs(self._cache_dir, exist_ok=True)
+
+
+    def _lock_path(self, key):
+        return os.path.join(self._cache_dir, '.{}.lock'.format(key))
+
+
+    def _build_lock_path(self, key):
+        return os.path.join(self._cache_dir, '.{}.build-lock'.format(key))
+
+
+    def _hold(self, key):
+        # release the entries we were using before and lock the new one
+        for k in list(self._locks):
+            if k != key:
+                self._locks.pop(k).close()
+        if key not in self._locks:
+            f = open(self._lock_path(key), 'a')
+            fcntl.flock(f, fcntl.LOCK_SH)
+            self._locks[key] = f
+
+
+    def _evict(self):
+        entries = [ e for e in os.listdir(self._cache_dir)
+                    if not e.startswith('.') and os.path.isdir(os.path.join(self._cache_dir, e)) ]
+        entries.sort(key=lambda e: os.path.getmtime(os.path.join(self._cache_dir, e)))
+        excess = len(entries) - self._max_entries
+        for key in entries:
+            if excess <= 0:
+                break
+            if key in self._locks:
+                continue
+            with open(self._lock_path(key), 'a') as f:
+                try:
+                    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    logging.debug('Not evicting cache entry %s: in use', key)
+                    continue
+                logging.info('Evicting %s from the cache', key)
+                shutil.rmtree(os.path.join(self._cache_dir, key))
+                os.remove(self._lock_path(key))
+                if os.path.exists(self._build_lock_path(key)):
+                    os.remove(self._build_lock_path(key))
+            excess -= 1
+
+
+    def _get(self, key, build):
+        """
+        Return the path of the entry `key`, calling build(path) to create it if necessary.
+        """
+        path = os.path.join(self._cache_dir, key)
+        marker = os.path.join(path, self.CompleteMarker)
+        self._hold(key)
+        if os.path.exists(marker):
+            logging.info('Using cached %s', path)
+        else:
+            with open(self._build_lock_path(key), 'a') as build_lock:
+                fcntl.flock(build_lock, fcntl.LOCK_EX)
+                # check again: another process may have built it while we waited
+                if not os.path.exists(marker):
+                    if os.path.exists(path):
+                        logging.debug('Removing incomplete cache entry %s', path)
+                        shutil.rmtree(path)
+                    build(path)
+                    open(marker, 'w').close()
+        # the modification time of the entry tracks its last use
+        os.utime(path)
+        self._evict()
+        return path
+
+
+class WorktreeCache(DirectoryCache):
+    """
+    Pre-patched KubeSpray trees, one per version, exported from the repository.
+    Entries are keyed by tag and patch digest.  Concurrent runs (e.g., those
+    of the fleet command) share them:  nothing writes in a tree once built.
+    """
+
+    def __init__(self, repo_path, cache_dir, max_entries=DefaultWorktreeCacheSize):
+        super(WorktreeCache, self).__init__(cache_dir, max_entries)
+        self._repo_path = repo_path
+
+
+    @staticmethod
+    def _patch_digest(ks_version):
+        patch_filename = PatchFilenameTemplate.format(ks_version)
+        if not os.path.exists(patch_filename):
+            return 'nopatch', None
+        with open(patch_filename, 'rb') as f:
+            return hashlib.sha1(f.read()).hexdigest()[:12], patch_filename
+
+
+    def _build(self, ks_version, path, patch_filename):
+        ks_tag = 'v' + ks_version
+        logging.info('Exporting KubeSpray tag %s to %s', ks_tag, path)
+        os.makedirs(path)
+        archive = subprocess.Popen(['git', '-C', self._repo_path, 'archive', '--format=tar', ks_tag],
+                                   stdout=subprocess.PIPE)
+        with tarfile.open(fileobj=archive.stdout, mode='r|') as tar:
+            tar.extractall(path)
+        if archive.wait() != 0:
+            raise subprocess.CalledProcessError(archive.returncode, 'git archive')
+        if patch_filename:
+            logging.debug('Applying patch')
+            subprocess.check_call(['git', 'apply', patch_filename], cwd=path)
+        else:
+            logging.debug("Patch file for version %s doesn't exist.  No patch for this version", ks_version)
+
+
+    def get(self, ks_version):
+        """
+        Return the path of the pre-patched tree for ks_version, building it if necessary.
+        """
+        digest, patch_filename = WorktreeCache._patch_digest(ks_version)
+        return self._get('v{}-{}'.format(ks_version, digest),
+                         lambda path: self._build(ks_version, path, patch_filename))
+
+
+class VirtualenvCache(DirectoryCache):
+    """
+    Virtualenvs with the KubeSpray requirements installed, keyed by the content
+    of requirements.txt (and the python version).  They're isolated from the
+    packages of the image:  with --system-site-packages, pip leaves out the
+    requirements the image already satisfies, and with them their scripts
+    (e.g., bin/ansible-playbook).
+    """
+
+    def __init__(self, cache_dir, max_entries=DefaultVirtualenvCacheSize):
+        super(VirtualenvCache, self).__init__(cache_dir, max_entries)
+
+
+    @staticmethod
+    def _build(requirements_file, path):
+        logging.info("Creating virtualenv %s for %s", path, requirements_file)
+        subprocess.check_call([sys.executable, '-m', 'venv', path])
+        subprocess.check_call([os.path.join(path, 'bin', 'pip'), 'install', '--no-cache-dir',
+                               '-r', requirements_file])
+
+
+    def get(self, requirements_file):
+        digest = hashlib.sha256()
+        # 'isolated' tells these apart from the virtualenvs that used the system site packages
+        digest.update('python{}.{} isolated\n'.format(*sys.version_info[:2]).encode())
+        with open(requirements_file, 'rb') as f:
+            digest.update(f.read())
+        return self._get(digest.hexdigest()[:16], lambda path: VirtualenvCache._build(requirements_file, path))
+
+
+Download = collections.namedtuple('Download', 'name url sha256 variable')
+
+
+class ArtifactCache(DirectoryCache):
+    """
+    The files that KubeSpray downloads on the nodes (kubeadm, kubelet, etcd,
+    the CNI plugins...), fetched once and verified against their sha256.
+    Entries are keyed by KubeSpray version and list of downloads, so they're
+    shared by the clusters deployed with the same version and settings.  Each
+    entry stores the files as <host>/<URL path> and lists them in its manifest.
+    """
+
+    ManifestFilename = 'manifest.json'
+    ChunkSize = 1 << 20
+    MaxParallelDownloads = 4
+
+    def __init__(self, cache_dir, max_entries=DefaultArtifactCacheSize, timeout=60):
+        super(ArtifactCache, self).__init__(cache_dir, max_entries)
+        self._timeout = timeout
+
+
+    @staticmethod
+    def mirror_path(url):
+        """
+        'https://storage.googleapis.com/kubernetes-release/release/v1.18.8/bin/linux/amd64/kubeadm'
+        -> 'storage.googleapis.com/kubernetes-release/release/v1.18.8/bin/linux/amd64/kubeadm'
+        """
+        parsed = urllib.parse.urlsplit(url)
+        path = posixpath.normpath('/' + urllib.parse.unquote(parsed.path)).lstrip('/')
+        if not parsed.netloc or not path:
+            raise ValueError("Can't cache {}: not a file URL".format(url))
+        return posixpath.join(parsed.netloc.replace(':', '_'), path)
+
+
+    @staticmethod
+    def sha256(filename):
+        digest = hashlib.sha256()
+        with open(filename, 'rb') as f:
+            for chunk in iter(lambda: f.read(ArtifactCache.ChunkSize), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+
+    @staticmethod
+    def manifest(path):
+        with open(os.path.join(path, ArtifactCache.ManifestFilename)) as f:
+            return json.load(f)
+
+
+    def entries(self):
+        """
+        The complete entries of the cache, as (key, path).
+        """
+        for key in sorted(os.listdir(self._cache_dir)):
+            path = os.path.join(self._cache_dir, key)
+            if not key.startswith('.') and os.path.exists(os.path.join(path, self.CompleteMarker)):
+                yield key, path
+
+
+    def _cached_copy(self, sha256):
+        """
+        Path of a file with this checksum in the other complete entries, if any.
+        """
+        for _, entry in self.entries():
+            try:
+                for item in self.manifest(entry):
+                    if item['sha256'] == sha256:
+                        return os.path.join(entry, item['path'])
+            except (IOError, ValueError):
+                continue
+        return None
+
+
+    def _fetch(self, download, dest):
+        expected = (download.sha256 or '').lower()
+        tmp = dest + '.part'
+        source = self._cached_copy(expected) if expected else None
+        if source:
+            logging.debug('Reusing %s for %s', source, download.url)
+            try:
+                os.link(source, tmp)
+            except OSError:
+                shutil.copyfile(source, tmp)
+            actual = self.sha256(tmp)
+        else:
+            logging.info('Downloading %s', download.url)
+            digest = hashlib.sha256()
+            with urllib.request.urlopen(download.url, timeout=self._timeout) as response, open(tmp, 'wb') as f:
+                for chunk in iter(lambda: response.read(self.ChunkSize), b''):
+                    digest.update(chunk)
+                    f.write(chunk)
+            actual = digest.hexdigest()
+        if expected and actual != expected:
+            os.remove(tmp)
+            raise RuntimeError("Checksum mismatch for {}: expected sha256 {}, got {}".format(
+                download.url, expected, actual))
+        os.replace(tmp, dest)
+        return actual
+
+
+    def _build(self, downloads, path):
+        logging.info('Fetching %d KubeSpray downloads into %s', len(downloads), path)
+        os.makedirs(path)
+        targets = []
+        for d in downloads:
+            relpath = self.mirror_path(d.url)
+            dest = os.path.join(path, relpath)
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+            targets.append((d, relpath, dest))
+        with concurrent.futures.ThreadPoolExecutor(self.MaxParallelDownloads) as executor:
+            checksums = list(executor.map(lambda t: self._fetch(t[0], t[2]), targets))
+        manifest = [ dict(d._asdict(), path=relpath, sha256=sha256)
+                     for (d, relpath, _), sha256 in zip(targets, checksums) ]
+        with open(os.path.join(path, self.ManifestFilename), 'w') as f:
+            json.dump(manifest, f, indent=1, sort_keys=True)
+
+
+    def get(self, ks_version, downloads):
+        """
+        Return the path of the entry with the downloads of ks_version, fetching them if necessary.
+        """
+        digest = hashlib.sha256()
+        for d in sorted(downloads, key=lambda d: d.url):
+            digest.update('{} {}\n'.format(d.url, d.sha256 or '').encode())
+        return self._get('v{}-{}'.format(ks_version, digest.hexdigest()[:12]),
+                         lambda path: self._build(downloads, path))
+
+
+    @staticmethod
+    def verify(path):
+        """
+        Return the files of the entry that are missing or don't match their checksum.
+        """
+        bad = []
+        for item in ArtifactCache.manifest(path):
+            filename = os.path.join(path, item['path'])
+            if not os.path.exists(filename) or ArtifactCache.sha256(filename) != item['sha256']:
+                bad.append(item['path'])
+        return bad
+
+
+class UpgradePlanner(object):
+    """
+    Computes the shortest sequence of KubeSpray versions to go through to
+    upgrade a cluster.
+
+    A hop can skip entries of the VersionTable as long as it doesn't move
+    Kubernetes or KubeSpray forward by more than one minor version and it
+    doesn't skip a mandatory stop.  Consecutive entries of the table are
+    always allowed, so the planner never does worse than walking the table.
+    """
+
+    def __init__(self, version_table=VersionTable, mandatory_stops=MandatoryUpgradeStops):
+        self._versions = [ row[0] for row in version_table ]
+        self._k8s_versions = dict(version_table)
+        self._mandatory_stops = set(mandatory_stops)
+
+
+    @staticmethod
+    def _minor(version):
+        major, minor = version.split('.')[:2]
+        return int(major), int(minor)
+
+
+    @staticmethod
+    def _minor_skew(a, b):
+        (a_major, a_minor), (b_major, b_minor) = UpgradePlanner._minor(a), UpgradePlanner._minor(b)
+        return b_minor - a_minor if a_major == b_major else float('inf')
+
+
+    def hop_allowed(self, base, target):
+        i, j = self._versions.index(base), self._versions.index(target)
+        if j <= i:
+            return False
+        if j == i + 1:
+            return True
+        if any(v in self._mandatory_stops for v in self._versions[i + 1:j]):
+            return False
+        return UpgradePlanner._minor_skew(base, target) <= 1 and \
+               UpgradePlanner._minor_skew(self._k8s_versions[base], self._k8s_versions[target]) <= 1
+
+
+    def plan(self, base, target, sequential=False):
+        """
+        Returns the list of versions to upgrade to, in order, excluding base.
+        Among paths of the same length the one through the latest releases is chosen.
+        If `sequential` is set, every intermediate version is included.
+        """
+        base_index = self._versions.index(base)
+        target_index = self._versions.index(target)
+        if base_index > target_index:
+            raise ValueError("Base version {} is greater than target version {}".format(base, target))
+        if sequential:
+            return self._versions[base_index + 1:target_index + 1]
+
+        # hops[i]: min number of hops from version i to target; next_hop[i]: where to go from i
+        hops = { target_index: 0 }
+        next_hop = {}
+        for i in range(target_index - 1, base_index - 1, -1):
+            for j in range(target_index, i, -1):
+                if j in hops and self.hop_allowed(self._versions[i], self._versions[j]) and \
+                   (i not in hops or hops[j] + 1 < hops[i]):
+                    hops[i] = hops[j] + 1
+                    next_hop[i] = j
+
+        path = []
+        i = base_index
+        while i != target_index:
+            i = next_hop[i]
+            path.append(self._versions[i])
+        return path
+
+
+    @staticmethod
+    def estimate(path, history):
+        """
+        Estimate the duration of each hop of the path from the recorded upgrade history.
+        Returns a list of (version, seconds or None).
+        """
+        def total(entry):
+            return entry.get('playbook_seconds', 0) + (entry.get('convergence_seconds') or 0)
+
+        def median(values):
+            values = sorted(values)
+            return values[len(values) // 2] if values else None
+
+        overall = median([ total(e) for e in history ])
+        return [ (v, median([ total(e) for e in history if e.get('to') == v ]) or overall) for v in path ]
+
+
 class KubesprayRepo(object):
 
-    def __init__(self, path):
+    def __init__(self, path, worktree_cache=None, venv_cache=None, preinstalled_version=PreinstalledKubesprayVersion):
         self._path = path
         assert os.path.exists(self._path)
         self._repo = git.Repo(self._path)
+        self._repo_path = path
+        self._worktree_cache = worktree_cache
+        self._venv_cache = venv_cache
+        self._venv = None
         self._requirements_updated = False
         tag = self._repo.git.describe('--tags')
         if tag:
             self._ks_version = tag.lstrip('v')
         else:
             self._ks_version = None
+        # the pre-installed tree is only usable while it's still checked out
+        self._preinstalled_version = preinstalled_version if preinstalled_version == self._ks_version else None
 
 
     @property
@@ -73,6 +522,20 @@ class KubesprayRepo(object):
         return self._ks_version
 
 
+    def ansible_executable(self, name):
+        """
+        The ansible executable (e.g., 'ansible') that matches the checked out version.
+        """
+        if self._venv:
+            return os.path.join(self._venv, 'bin', name)
+        return name
+
+
+    @property
+    def ansible_playbook(self):
+        return self.ansible_executable('ansible-playbook')
+
+
     def clean(self):
         self._repo.head.reset(index=True, working_tree=True)
         self._repo.git.clean('-d', '-f')
@@ -81,9 +544,23 @@ class KubesprayRepo(object):
     def checkout(self, ks_version):
         assert ks_version in (row[0] for row in VersionTable)
         self._requirements_updated = False
+        self._venv = None
+        if ks_version == self._preinstalled_version:
+            logging.info('Using the pre-installed KubeSpray %s of the image', ks_version)
+            self._path = self._repo_path
+            self._ks_version = ks_version
+            self._requirements_updated = True
+            return
+        if self._worktree_cache:
+            self._path = self._worktree_cache.get(ks_version)
+            self._ks_version = ks_version
+            return
+
         ks_tag = 'v' + ks_version
         logging.info('Checking out KubeSpray tag %s', ks_tag)
 
+        # the tree and the installed requirements are changed from here on
+        self._preinstalled_version = None
         self.clean()
         self._repo.git.checkout(ks_tag)
         patch_filename = PatchFilenameTemplate.format(ks_version)
@@ -100,6 +577,11 @@ class KubesprayRepo(object):
         if self._requirements_updated and not force:
             return
 
+        if self._venv_cache:
+            self._venv = self._venv_cache.get(os.path.join(self.path, 'requirements.txt'))
+            self._requirements_updated = True
+            return
+
         cmd = [ 'pip3', 'install', '-r', os.path.join(self.path, 'requirements.txt') ]
         logging.info("Installing any new requirements...")
         subprocess.check_call(cmd)
@@ -107,39 +589,1110 @@ class KubesprayRepo(object):
         self._requirements_updated = True
 
 
-    def iterversions(self, base, target):
+    @staticmethod
+    def find_corresponding_k8s_version(ks_version):
+        for row in VersionTable:
+            if row[0] == ks_version:
+                return row[1]
+        return None
+
+
+class NotReady(Exception):
+    pass
+
+
+class ReadinessTimeout(RuntimeError):
+    pass
+
+
+class HttpApiClient(object):
+    """
+    Minimal read-only client for the Kubernetes API server.
+    """
+
+    def __init__(self, server, ca_file=None, cert_file=None, key_file=None, token=None,
+                 insecure=False, timeout=10, tmp_dir=None):
+        self._server = server.rstrip('/')
+        self._token = token
+        self._timeout = timeout
+        # holds the credentials taken from a kubeconfig:  removed by close()
+        self._tmp_dir = tmp_dir
+        if self._server.startswith('https'):
+            self._ssl_context = ssl.create_default_context(cafile=ca_file)
+            if insecure:
+                self._ssl_context.check_hostname = False
+                self._ssl_context.verify_mode = ssl.CERT_NONE
+            if cert_file:
+                self._ssl_context.load_cert_chain(cert_file, key_file)
+        else:
+            self._ssl_context = None
+
+
+    @property
+    def server(self):
+        return self._server
+
+
+    def close(self):
+        if self._tmp_dir is not None:
+            self._tmp_dir.cleanup()
+            self._tmp_dir = None
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+    def get(self, path):
+        request = urllib.request.Request(self._server + path)
+        if self._token:
+            request.add_header('Authorization', 'Bearer {}'.format(self._token))
+        try:
+            with urllib.request.urlopen(request, timeout=self._timeout, context=self._ssl_context) as response:
+                return response.read().decode('utf-8')
+        except (urllib.error.URLError, OSError) as e:
+            raise NotReady("GET {} failed: {}".format(path, e))
+
+
+    @staticmethod
+    def from_kubeconfig(filename):
         """
-        Iterate repository from version base+1 to target (included).
+        Build a client for the current context of a kubeconfig file.  Embedded
+        certificate data is written to a temporary directory that lives until
+        the client is closed.
         """
-        version_list = [ row[0] for row in VersionTable ]
-        base_index = version_list.index(base)
-        target_index = version_list.index(target)
+        import base64
+        import yaml
 
-        if base_index > target_index:
-            raise ValueError("Base version {} is greater than target version {}".format(base, target))
+        with open(filename) as f:
+            config = yaml.safe_load(f)
+
+        def by_name(section, name):
+            for entry in config.get(section) or []:
+                if entry['name'] == name:
+                    return entry[section[:-1]]
+            raise ValueError("{} {} not found in kubeconfig {}".format(section[:-1], name, filename))
+
+        context = by_name('contexts', config['current-context'])
+        cluster = by_name('clusters', context['cluster'])
+        user = by_name('users', context['user']) if context.get('user') else {}
+
+        tmp_dir = tempfile.TemporaryDirectory(prefix='manage-cluster-')
+
+        def materialize(entry, key):
+            if entry.get(key + '-data'):
+                path = os.path.join(tmp_dir.name, key)
+                with open(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600), 'wb') as f:
+                    f.write(base64.b64decode(entry[key + '-data']))
+                return path
+            return entry.get(key)
+
+        try:
+            return HttpApiClient(cluster['server'],
+                                 ca_file=materialize(cluster, 'certificate-authority'),
+                                 cert_file=materialize(user, 'client-certificate'),
+                                 key_file=materialize(user, 'client-key'),
+                                 token=user.get('token'),
+                                 insecure=cluster.get('insecure-skip-tls-verify', False),
+                                 tmp_dir=tmp_dir)
+        except Exception:
+            tmp_dir.cleanup()
+            raise
+
+
+class AnsibleKubectlClient(object):
+    """
+    Queries the API server by running `kubectl get --raw` on a master node
+    through ansible.  Used when no kubeconfig is available in the container.
+    The ansible of the KubeSpray version checked out in ks_repo is used, like
+    for the playbooks.
+    """
+
+    def __init__(self, inventory, ks_repo=None, host_pattern='kube-master[0]'):
+        self._inventory = inventory
+        self._ks_repo = ks_repo
+        self._host_pattern = host_pattern
+
+
+    @property
+    def server(self):
+        return self._host_pattern
+
+
+    def close(self):
+        pass
+
+
+    def get(self, path):
+        ansible = self._ks_repo.ansible_executable('ansible') if self._ks_repo else 'ansible'
+        cmd = [ ansible, self._host_pattern, '--become',
+                '-i', self._inventory,
+                '--timeout', '30',
+                '-m', 'command', '-a', 'kubectl get --raw {}'.format(path) ]
+        env = dict(os.environ, ANSIBLE_STDOUT_CALLBACK='json', ANSIBLE_LOAD_CALLBACK_PLUGINS='1')
+        logging.debug("Executing command: %s", cmd)
+        # run from the cluster directory to pick up its ansible.cfg
+        result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env,
+                                cwd=os.path.dirname(os.path.abspath(self._inventory)), universal_newlines=True)
+        try:
+            hosts = json.loads(result.stdout)['plays'][0]['tasks'][0]['hosts']
+        except (ValueError, KeyError, IndexError):
+            raise NotReady("Unable to query {} through ansible (exit code {})".format(path, result.returncode))
+        for host, host_result in hosts.items():
+            if host_result.get('unreachable') or host_result.get('rc', 1) != 0:
+                raise NotReady("kubectl get --raw {} failed on {}: {}".format(
+                    path, host, host_result.get('stderr') or host_result.get('msg')))
+            return host_result['stdout']
+        raise NotReady("No host matched {}".format(self._host_pattern))
+
+
+class ApiServerHealthProbe(object):
+    name = 'apiserver'
+
+    def check(self, client):
+        body = client.get('/healthz').strip()
+        if body != 'ok':
+            raise NotReady("API server health is '{}'".format(body))
+
+
+class NodesReadyProbe(object):
+    name = 'nodes'
+
+    def check(self, client):
+        nodes = json.loads(client.get('/api/v1/nodes'))['items']
+        if not nodes:
+            raise NotReady("No nodes registered")
+        not_ready = []
+        for node in nodes:
+            conditions = { c['type']: c['status'] for c in node['status'].get('conditions', []) }
+            if conditions.get('Ready') != 'True' or node['spec'].get('unschedulable'):
+                not_ready.append(node['metadata']['name'])
+        if not_ready:
+            raise NotReady("{} of {} nodes not ready: {}".format(
+                len(not_ready), len(nodes), ', '.join(sorted(not_ready))))
+
+
+class KubeSystemRolloutProbe(object):
+    name = 'kube-system'
+
+    def __init__(self, namespace='kube-system'):
+        self._namespace = namespace
+
+
+    def check(self, client):
+        pending = []
+        deployments = json.loads(client.get(
+            '/apis/apps/v1/namespaces/{}/deployments'.format(self._namespace)))['items']
+        for d in deployments:
+            wanted = d['spec'].get('replicas', 1)
+            status = d.get('status', {})
+            if status.get('observedGeneration', 0) < d['metadata'].get('generation', 0) or \
+               status.get('updatedReplicas', 0) < wanted or \
+               status.get('availableReplicas', 0) < wanted:
+                pending.append('deployment/' + d['metadata']['name'])
+
+        daemonsets = json.loads(client.get(
+            '/apis/apps/v1/namespaces/{}/daemonsets'.format(self._namespace)))['items']
+        for ds in daemonsets:
+            status = ds.get('status', {})
+            wanted = status.get('desiredNumberScheduled', 0)
+            if status.get('observedGeneration', 0) < ds['metadata'].get('generation', 0) or \
+               status.get('updatedNumberScheduled', 0) < wanted or \
+               status.get('numberAvailable', 0) < wanted:
+                pending.append('daemonset/' + ds['metadata']['name'])
+
+        if pending:
+            raise NotReady("Rollout pending in {}: {}".format(self._namespace, ', '.join(sorted(pending))))
+
+
+DefaultReadinessProbes = (ApiServerHealthProbe, NodesReadyProbe, KubeSystemRolloutProbe)
+
+
+class ReadinessGate(object):
+    """
+    Polls the cluster until every probe passes, backing off exponentially
+    between rounds.  Raises ReadinessTimeout if the deadline expires first.
+    """
+
+    def __init__(self, client, probes=None, deadline=1800, initial_delay=5, max_delay=60, backoff=2,
+                 clock=time.monotonic, sleep=time.sleep):
+        self._client = client
+        self._probes = probes if probes is not None else [ p() for p in DefaultReadinessProbes ]
+        self._deadline = deadline
+        self._initial_delay = initial_delay
+        self._max_delay = max_delay
+        self._backoff = backoff
+        self._clock = clock
+        self._sleep = sleep
+
+
+    def close(self):
+        self._client.close()
+
+
+    def _failures(self):
+        failures = []
+        for probe in self._probes:
+            try:
+                probe.check(self._client)
+            except NotReady as e:
+                failures.append("{}: {}".format(probe.name, e))
+                # the remaining probes depend on the API server answering
+                if isinstance(probe, ApiServerHealthProbe):
+                    break
+            except (ValueError, KeyError) as e:
+                failures.append("{}: unexpected response ({})".format(probe.name, e))
+        return failures
+
+
+    def wait(self):
+        """
+        Returns the number of seconds the cluster took to converge.
+        """
+        logging.info("Waiting for the cluster to become ready (timeout %ss, querying %s)",
+                     self._deadline, self._client.server)
+        start = self._clock()
+        delay = self._initial_delay
+        attempt = 0
+        while True:
+            attempt += 1
+            failures = self._failures()
+            elapsed = self._clock() - start
+            if not failures:
+                logging.info("Cluster ready after %.1f seconds (%d checks)", elapsed, attempt)
+                return elapsed
+            for f in failures:
+                logging.info("Not ready yet -- %s", f)
+            if elapsed >= self._deadline:
+                raise ReadinessTimeout("Cluster not ready after {:.0f} seconds: {}".format(
+                    elapsed, '; '.join(failures)))
+            self._sleep(min(delay, self._deadline - elapsed))
+            delay = min(delay * self._backoff, self._max_delay)
+
+
+def batched_plays(events):
+    """
+    Groups the play-end events recorded for the batches of the same play
+    (which ansible runs one after the other) and returns the groups of
+    the plays that were run in more than one batch.
+    """
+    plays = []
+    for e in events:
+        if e['event'] != 'play-end' or 'batch' not in e:
+            continue
+        if e['batch'] == 1 or not plays:
+            plays.append([])
+        plays[-1].append(e)
+    return [ batches for batches in plays if len(batches) > 1 ]
+
+
+class Operation(object):
+    """
+    A deploy or upgrade operation reconstructed from the journal.
+    """
+
+    def __init__(self, events):
+        begin = events[0]
+        self.id = begin['op']
+        self.action = begin['action']
+        self.target = begin['target']
+        self.plan = begin['plan']
+        self.events = events
+
+
+    def _events(self, name, version=None):
+        return [ e for e in self.events
+                 if e['event'] == name and (version is None or e.get('version') == version) ]
+
+
+    @property
+    def finished(self):
+        return bool(self._events('end') or self._events('abandoned'))
+
+
+    @property
+    def completed_hops(self):
+        return [ e['version'] for e in self._events('hop-end') ]
+
+
+    def is_ready(self, version):
+        return bool(self._events('hop-ready', version))
+
+
+    def _last_attempt(self, version):
+        attempt_start = 0
+        for i, e in enumerate(self.events):
+            if e['event'] == 'hop-start' and e.get('version') == version:
+                attempt_start = i
+        return self.events[attempt_start:]
+
+
+    def failure(self, version):
+        """
+        Returns (task name, failed hosts) for the first task that failed in
+        the last attempt of the given hop, or (None, []) if nothing failed.
+        """
+        task = None
+        hosts = []
+        for e in self._last_attempt(version):
+            if e['event'] == 'task' and e.get('version') == version and e['status'] in ('failed', 'unreachable'):
+                if task is None:
+                    task = e['task']
+                if e['task'] == task:
+                    hosts.append(e['host'])
+        return task, hosts
+
+
+    def batches(self, version):
+        """
+        Returns the play-end events of the plays that the last attempt of the
+        given hop ran in more than one batch (i.e., with serial).
+        """
+        return [ e for batches in batched_plays(e for e in self._last_attempt(version) if e.get('version') == version)
+                 for e in batches ]
+
+
+class OperationJournal(object):
+    """
+    JSON-lines journal of the operations run on a cluster.  manage-cluster
+    records the start and end of operations and upgrade hops, while the
+    manage_cluster_journal ansible callback records every task result.
+    """
+
+    def __init__(self, path):
+        self._path = path
+
+
+    @property
+    def path(self):
+        return self._path
+
+
+    def _append(self, event):
+        event['time'] = round(time.time(), 3)
+        with open(self._path, 'a') as f:
+            f.write(json.dumps(event, sort_keys=True) + '\n')
+
+
+    def record(self, op_id, event, **details):
+        details.update(op=op_id, event=event)
+        self._append(details)
+
+
+    def begin(self, action, target, plan):
+        last = self.last_operation()
+        if last and not last.finished:
+            logging.warning("Abandoning unfinished %s operation %s (started %s)", last.action, last.id,
+                            time.ctime(last.events[0]['time']))
+            self.record(last.id, 'abandoned')
+        op_id = self.new_operation_id()
+        self.record(op_id, 'begin', action=action, target=target, plan=plan)
+        return op_id
+
+
+    def events(self):
+        try:
+            with open(self._path) as f:
+                return [ json.loads(line) for line in f if line.strip() ]
+        except FileNotFoundError:
+            return []
+
+
+    def last_operation(self):
+        events = self.events()
+        begins = [ e['op'] for e in events if e['event'] == 'begin' ]
+        if not begins:
+            return None
+        return Operation([ e for e in events if e.get('op') == begins[-1] ])
+
+
+    def resumable_operation(self, action, target):
+        op = self.last_operation()
+        if op is None or op.finished:
+            raise RuntimeError("No interrupted operation to resume in {}".format(self._path))
+        if op.action != action or op.target != target:
+            raise RuntimeError("The interrupted operation is a {} to version {}: can't resume it as a {} to {}".format(
+                op.action, op.target, action, target))
+        return op
 
-        current_index = base_index + 1
-        while current_index <= target_index:
-            self.checkout(version_list[current_index])
-            yield version_list[current_index]
-            current_index += 1
+
+    def new_operation_id(self):
+        return '{}-{}'.format(time.strftime('%Y%m%d%H%M%S'), os.getpid())
+
+
+    def ansible_env(self, op_id, version, playbook):
+        """
+        Environment for ansible-playbook that enables the journal callback.
+        """
+        env = dict(os.environ)
+        plugin_path = [ CallbackPluginDir ] + [ p for p in env.get('ANSIBLE_CALLBACK_PLUGINS', '').split(':') if p ]
+        callbacks = [ 'manage_cluster_journal' ] + \
+                    [ c for c in env.get('ANSIBLE_CALLBACK_WHITELIST', '').split(',') if c ]
+        env.update(ANSIBLE_CALLBACK_PLUGINS=':'.join(plugin_path),
+                   # the option was renamed in ansible 2.11
+                   ANSIBLE_CALLBACK_WHITELIST=','.join(callbacks),
+                   ANSIBLE_CALLBACKS_ENABLED=','.join(callbacks),
+                   MANAGE_CLUSTER_JOURNAL=self._path,
+                   MANAGE_CLUSTER_JOURNAL_CONTEXT=json.dumps({ 'op': op_id, 'version': version, 'playbook': playbook }))
+        return env
+
+
+class PlaybookProfile(object):
+    """
+    Task, play and host timings of one playbook run, rebuilt from the
+    events recorded in the operation journal by the manage_cluster_journal callback.
+    """
+
+    def __init__(self, run_id, events):
+        self.run_id = run_id
+        self.playbook = events[0].get('playbook')
+        self.started = events[0]['time']
+        self.total_seconds = 0.0
+        # (play, task) -> totals; task names aren't unique so durations are summed
+        self.tasks = collections.OrderedDict()
+        # host -> { (play, task): seconds }
+        self.hosts = collections.defaultdict(dict)
+        # play-end events of the plays run in more than one batch, grouped by play
+        self.batches = batched_plays(events)
+        for e in events:
+            if e['event'] == 'task-end':
+                stats = self.tasks.setdefault((e['play'], e['task']), collections.Counter())
+                stats['duration'] += e['duration']
+                stats.update(e.get('hosts', {}))
+            elif e['event'] == 'task' and 'duration' in e:
+                key = (e['play'], e['task'])
+                self.hosts[e['host']][key] = self.hosts[e['host']].get(key, 0) + e['duration']
+            elif e['event'] == 'play-end':
+                self.total_seconds += e['duration']
+
+
+    def slowest_tasks(self, n):
+        return sorted(self.tasks.items(), key=lambda item: item[1]['duration'], reverse=True)[:n]
+
+
+    def slow_hosts(self, factor=1.5, min_seconds=1.0, min_fraction=0.1):
+        """
+        Hosts that were more than `factor` times slower than the median host on
+        at least `min_fraction` of the tasks they ran.
+        Returns a list of (host, fraction of slow tasks, seconds lost), slowest first.
+        """
+        per_task = collections.defaultdict(list)
+        for durations in self.hosts.values():
+            for key, seconds in durations.items():
+                per_task[key].append(seconds)
+        medians = { key: sorted(values)[len(values) // 2] for key, values in per_task.items() if len(values) >= 3 }
+
+        result = []
+        for host, durations in self.hosts.items():
+            slow = [ seconds - medians[key] for key, seconds in durations.items()
+                     if key in medians and seconds > factor * medians[key] and seconds - medians[key] > min_seconds ]
+            compared = sum(1 for key in durations if key in medians)
+            if compared and len(slow) >= min_fraction * compared:
+                result.append((host, len(slow) / compared, sum(slow)))
+        return sorted(result, key=lambda r: r[2], reverse=True)
 
 
     @staticmethod
-    def find_corresponding_k8s_version(ks_version):
-        for row in VersionTable:
-            if row[0] == ks_version:
-                return row[1]
-        return None
+    def compare(base, other, threshold=0.25, min_seconds=5.0):
+        """
+        Tasks that took at least `threshold` (relative) and `min_seconds` longer in
+        `other` than in `base`.  Returns a list of ((play, task), base seconds, other seconds).
+        """
+        regressions = []
+        for key, stats in other.tasks.items():
+            if key not in base.tasks:
+                continue
+            before, after = base.tasks[key]['duration'], stats['duration']
+            if after - before >= min_seconds and after > before * (1 + threshold):
+                regressions.append((key, before, after))
+        return sorted(regressions, key=lambda r: r[2] - r[1], reverse=True)
+
+
+    @staticmethod
+    def from_journal(journal):
+        """
+        Returns the profiles of all the playbook runs in the journal, oldest first.
+        """
+        runs = collections.OrderedDict()
+        for e in journal.events():
+            if e['event'] in ('play', 'play-end', 'task', 'task-end') and 'op' in e:
+                runs.setdefault('{}/{}'.format(e['op'], e.get('version')), []).append(e)
+        return [ PlaybookProfile(run_id, events) for run_id, events in runs.items() ]
+
+
+class InventoryFile(object):
+    """
+    Read-only view of the hosts.ini written by create_inventory.py.
+    """
+
+    def __init__(self, path):
+        self._path = path
+        self.hosts = collections.OrderedDict()
+        self.groups = collections.OrderedDict()
+        self.group_vars = collections.defaultdict(dict)
+        section = None
+        with open(path) as f:
+            for line in f:
+                line = line.strip()
+                if not line or line.startswith(('#', ';')):
+                    continue
+                if line.startswith('['):
+                    section = line.strip('[]')
+                    if ':' not in section:
+                        self.groups.setdefault(section, [])
+                    continue
+                if section is not None and section.endswith(':vars') and '=' in line:
+                    key, value = line.split('=', 1)
+                    self.group_vars[section[:-len(':vars')]][key.strip()] = value.strip()
+                    continue
+                if section is None or ':' in section:
+                    continue
+                name, *assignments = line.split()
+                host_vars = self.hosts.setdefault(name, {})
+                host_vars.update(a.split('=', 1) for a in assignments if '=' in a)
+                if section != 'all':
+                    self.groups[section].append(name)
+
+
+    @property
+    def path(self):
+        return self._path
+
+
+    @property
+    def bastion(self):
+        return self.hosts.get('bastion')
+
+
+    @property
+    def nodes(self):
+        """
+        Names of the cluster nodes (i.e., all hosts but the bastion).
+        """
+        return [ h for h in self.hosts if h != 'bastion' ]
+
+
+    def address(self, host):
+        return self.hosts[host].get('ansible_host')
+
+
+    def user(self, host):
+        host_vars = self.hosts[host]
+        return host_vars.get('ansible_ssh_user') or host_vars.get('ansible_user')
+
+
+    def behind_bastion(self, host):
+        """
+        Whether the host is only reachable through the bastion (it has no floating IP).
+        """
+        host_vars = self.hosts[host]
+        return self.bastion is not None and host != 'bastion' and host_vars.get('ansible_host') == host_vars.get('ip')
+
+
+class DisruptionBudget(object):
+    """
+    How many nodes of a group an upgrade may take down at the same time:
+    a number of nodes ('2') or a percentage of the group ('25%').  At least
+    one node is always allowed, or the upgrade couldn't make progress:  a
+    budget of zero ('0' or '0%') is rejected rather than rounded up.
+    """
+
+    Format = re.compile(r'^(\d+)(%?)$')
+
+    def __init__(self, spec):
+        match = DisruptionBudget.Format.match(str(spec).strip())
+        if not match or int(match.group(1)) == 0 or (match.group(2) and int(match.group(1)) > 100):
+            raise ValueError("Invalid disruption budget '{}':  expected a number of nodes or a percentage "
+                             "between 1% and 100%".format(spec))
+        self._value = int(match.group(1))
+        self._percent = bool(match.group(2))
+
+
+    def __str__(self):
+        return '{}{}'.format(self._value, '%' if self._percent else '')
+
+
+    def nodes(self, group_size):
+        if self._percent:
+            allowed = group_size * self._value // 100
+        else:
+            allowed = min(self._value, group_size)
+        return max(1, allowed)
+
+
+class UpgradeBatches(object):
+    """
+    How upgrade-cluster.yml takes down the nodes of the inventory.  The
+    masters and the etcd members are upgraded one at a time, as KubeSpray
+    does; the workers in batches sized on the disruption budgets:  the
+    default one and those set per group in hosts.ini, e.g.
+
+        [kube-node:vars]
+        upgrade_max_unavailable=25%
+
+    Since KubeSpray batches the workers in inventory order, regardless of
+    their groups, the batch size is the smallest one allowed by the budgets
+    of the groups the workers belong to.
+    """
+
+    # hosts of the worker play of upgrade-cluster.yml
+    WorkerGroups = ('kube-node', 'calico-rr')
+    SerialGroups = ('kube-master', 'etcd')
+    BudgetVariable = 'upgrade_max_unavailable'
+
+    def __init__(self, inventory, default_budget=None):
+        self.control_plane = [ h for h in inventory.hosts
+                               if any(h in inventory.groups.get(g, ()) for g in UpgradeBatches.SerialGroups) ]
+        self.workers = [ h for h in inventory.hosts
+                         if any(h in inventory.groups.get(g, ()) for g in UpgradeBatches.WorkerGroups)
+                         and h not in inventory.groups.get('kube-master', ()) ]
+        # group -> (budget, number of workers in the group)
+        self.budgets = collections.OrderedDict()
+        if default_budget is not None and self.workers:
+            self.budgets['default'] = (DisruptionBudget(default_budget), len(self.workers))
+        for group, group_vars in inventory.group_vars.items():
+            if UpgradeBatches.BudgetVariable not in group_vars:
+                continue
+            members = self.workers if group == 'all' else \
+                      [ h for h in self.workers if h in inventory.groups.get(group, ()) ]
+            if members:
+                self.budgets[group] = (DisruptionBudget(group_vars[UpgradeBatches.BudgetVariable]), len(members))
+        # etcd members in the worker play would be taken down together with the other workers
+        self.etcd_workers = [ h for h in self.workers if h in inventory.groups.get('etcd', ()) ]
+
+
+    @property
+    def batch_size(self):
+        """
+        Number of workers upgraded at the same time, or None to leave it to KubeSpray.
+        """
+        if not self.budgets:
+            return None
+        if self.etcd_workers:
+            return 1
+        return min(budget.nodes(size) for budget, size in self.budgets.values())
+
+
+    @property
+    def batches(self):
+        size = self.batch_size
+        if not size:
+            return None
+        return -(-len(self.workers) // size)
+
+
+    def extra_args(self):
+        if self.batch_size is None:
+            return []
+        return [ '-e', 'serial={}'.format(self.batch_size) ]
+
+
+    def describe(self):
+        lines = [ "Control plane and etcd: {} nodes, one at a time".format(len(self.control_plane)) ]
+        if self.batch_size is None:
+            lines.append("Workers: {} nodes, in KubeSpray's default batches".format(len(self.workers)))
+        else:
+            lines.append("Workers: {} nodes, in {} batches of {} (budgets: {})".format(
+                len(self.workers), self.batches, self.batch_size,
+                ', '.join('{} {} of {}'.format(group, budget, size) for group, (budget, size) in self.budgets.items())))
+        if self.etcd_workers and self.budgets:
+            lines.append("Workers are upgraded one at a time because {} are etcd members".format(
+                ', '.join(self.etcd_workers)))
+        return lines
+
+
+class AnsibleConfig(object):
+    """
+    Generates an ansible.cfg for the cluster directory, sized on its inventory:
+    forks proportional to the number of nodes, pipelining, persistent SSH
+    connections (also to the bastion) and a fact cache shared by all the
+    playbooks run on the cluster.
+    """
+
+    Marker = '# Generated by manage-cluster.py'
+
+    def __init__(self, inventory, max_forks=DefaultMaxForks, fact_cache_ttl=DefaultFactCacheTTL):
+        self._inventory = inventory
+        self._max_forks = max_forks
+        self._fact_cache_ttl = fact_cache_ttl
+
+
+    @property
+    def forks(self):
+        return max(5, min(len(self._inventory.nodes), self._max_forks))
+
+
+    def ssh_config(self, cluster_dir):
+        lines = [ AnsibleConfig.Marker, '' ]
+        bastion = self._inventory.bastion
+        proxied = [ self._inventory.address(h) for h in self._inventory.nodes if self._inventory.behind_bastion(h) ]
+        if bastion and proxied:
+            # all the proxied connections go through a single multiplexed
+            # connection to the bastion
+            lines.extend([
+                'Host {}'.format(bastion['ansible_host']),
+                '  ControlMaster auto',
+                '  ControlPath /tmp/manage-cluster-bastion-%C',
+                '  ControlPersist 30m',
+                '',
+                'Host {}'.format(' '.join(proxied)),
+                '  ProxyCommand ssh -F {} -W %h:%p {}@{}'.format(
+                    os.path.join(cluster_dir, SshConfigFilename), self._inventory.user('bastion'), bastion['ansible_host']),
+                '' ])
+        lines.extend([
+            'Host *',
+            '  StrictHostKeyChecking no',
+            '  UserKnownHostsFile /dev/null',
+            '  ServerAliveInterval 30' ])
+        return '\n'.join(lines) + '\n'
+
+
+    def ansible_cfg(self, cluster_dir):
+        return '\n'.join([
+            AnsibleConfig.Marker,
+            '# Delete this line to stop manage-cluster from regenerating the file.',
+            '',
+            '[defaults]',
+            'forks = {}'.format(self.forks),
+            'host_key_checking = False',
+            'retry_files_enabled = False',
+            'timeout = 30',
+            'gathering = smart',
+            'fact_caching = jsonfile',
+            'fact_caching_connection = {}'.format(os.path.join(cluster_dir, FactCacheDirname)),
+            'fact_caching_timeout = {}'.format(self._fact_cache_ttl),
+            '',
+            '[ssh_connection]',
+            'pipelining = True',
+            'ssh_args = -F {} -o ControlMaster=auto -o ControlPersist=30m'.format(
+                os.path.join(cluster_dir, SshConfigFilename)),
+            'control_path_dir = {}'.format(SshControlPathDir),
+            '' ])
+
+
+    def write(self, cluster_dir):
+        """
+        Write ansible.cfg and the ssh configuration in cluster_dir, unless the
+        user has taken over the ansible.cfg there.
+        """
+        cfg_path = os.path.join(cluster_dir, 'ansible.cfg')
+        if os.path.exists(cfg_path):
+            with open(cfg_path) as f:
+                if f.readline().rstrip('\n') != AnsibleConfig.Marker:
+                    logging.info("%s wasn't generated by manage-cluster.  Leaving it alone", cfg_path)
+                    return
+        logging.info("Writing ansible configuration for %d nodes (%d forks)", len(self._inventory.nodes), self.forks)
+        with open(os.path.join(cluster_dir, SshConfigFilename), 'w') as f:
+            f.write(self.ssh_config(cluster_dir))
+        with open(cfg_path, 'w') as f:
+            f.write(self.ansible_cfg(cluster_dir))
+
+
+class ArtifactMirror(object):
+    """
+    Serves the ArtifactCache to the nodes from the bastion or, without one,
+    the first master:  an HTTP server for the files and pull-through
+    registries for the container images.  The registries need docker, which
+    is installed on the bastion but is only found on a master once Kubernetes
+    has been deployed.  KubeSpray is pointed at the mirror through a file of
+    extra variables in the cluster directory.
+    """
+
+    # 'url: "{{ kubeadm_download_url }}"' in the download role's defaults
+    UrlVariable = re.compile(r'^\{\{\s*(\w+)\s*\}\}$')
+
+    def __init__(self, cache, port=DefaultArtifactMirrorPort, registries=True):
+        self._cache = cache
+        self._port = port
+        self._registries = registries
+
+
+    @staticmethod
+    def mirror_host(inventory):
+        if inventory.bastion is not None:
+            return 'bastion'
+        masters = inventory.groups.get('kube-master')
+        if not masters:
+            raise RuntimeError("The inventory has neither a bastion nor a master to serve the artifacts from")
+        return masters[0]
+
+
+    @staticmethod
+    def url_variables(ks_path):
+        """
+        Map the KubeSpray downloads to the variables that hold their URLs
+        (e.g., 'kubeadm' -> 'kubeadm_download_url').
+        """
+        import yaml  # installed with ansible
+        with open(os.path.join(ks_path, 'roles', 'download', 'defaults', 'main.yml')) as f:
+            defaults = yaml.safe_load(f)
+        variables = {}
+        for name, download in (defaults.get('downloads') or {}).items():
+            match = ArtifactMirror.UrlVariable.match(str(download.get('url', '')))
+            if match:
+                variables[name] = match.group(1)
+        return variables
+
+
+    @staticmethod
+    def _run_playbook(ks_repo, inventory, playbook, extra_vars):
+        cmd = [ ks_repo.ansible_playbook, '--become', '-i', inventory, '--timeout', '30',
+                '-e', json.dumps(extra_vars), os.path.join(ArtifactMirrorDir, playbook) ]
+        logging.debug("Executing command: %s", cmd)
+        subprocess.check_call(cmd, env=dict(os.environ, ANSIBLE_ROLES_PATH=os.path.join(ks_repo.path, 'roles')))
+
+
+    def downloads(self, ks_repo, inventory):
+        """
+        The files KubeSpray downloads on the nodes, rendered with the variables of the cluster.
+        """
+        variables = self.url_variables(ks_repo.path)
+        with tempfile.TemporaryDirectory(prefix='manage-cluster-') as tmp:
+            output = os.path.join(tmp, 'downloads.json')
+            self._run_playbook(ks_repo, inventory, 'list-downloads.yml', { 'output_file': output })
+            with open(output) as f:
+                rendered = json.load(f)
+        downloads = []
+        for name, d in sorted(rendered.items()):
+            if name not in variables:
+                logging.debug("Not mirroring %s:  its URL isn't set by a variable", name)
+                continue
+            downloads.append(Download(name, d['url'], d.get('sha256') or None, variables[name]))
+        return downloads
+
+
+    def extra_vars(self, address, manifest, registries=()):
+        base = 'http://{}:{}'.format(address, self._port)
+        extra_vars = { item['variable']: '{}/{}'.format(base, urllib.parse.quote(item['path'])) for item in manifest }
+        if registries:
+            mirrors = [ '{}:{}'.format(address, r['port']) for r in registries ]
+            extra_vars.update((r['variable'], m) for r, m in zip(registries, mirrors))
+            extra_vars['docker_insecure_registries'] = mirrors
+        return extra_vars
+
+
+    @staticmethod
+    def write_vars(cluster_dir, extra_vars):
+        """
+        Write the extra variables for KubeSpray and return the ansible arguments that load them.
+        """
+        path = os.path.join(cluster_dir, ArtifactMirrorVarsFilename)
+        with open(path, 'w') as f:
+            json.dump(extra_vars, f, indent=1, sort_keys=True)
+        return [ '-e', '@' + path ]
+
+
+    def setup(self, ks_repo, deployment, version):
+        """
+        Fetch the downloads of KubeSpray `version` into the cache, serve them
+        from the mirror host and return the ansible arguments that point
+        KubeSpray at it.
+        """
+        host = self.mirror_host(InventoryFile(deployment.inventory))
+        downloads = self.downloads(ks_repo, deployment.inventory)
+        entry = self._cache.get(version, downloads)
+        registries = [ { 'variable': v, 'upstream': u, 'port': p } for v, u, p in ArtifactMirrorRegistries ] \
+                     if self._registries else []
+        logging.info("Serving %d files for KubeSpray %s from %s", len(downloads), version, host)
+        with tempfile.TemporaryDirectory(prefix='manage-cluster-') as tmp:
+            output = os.path.join(tmp, 'mirror.json')
+            self._run_playbook(ks_repo, deployment.inventory, 'artifact-mirror.yml', {
+                'mirror_host': host, 'entry_dir': entry, 'mirror_port': self._port,
+                'registries': registries, 'output_file': output })
+            with open(output) as f:
+                served = json.load(f)
+        if registries and not served['registries']:
+            logging.warning("No docker on %s:  the container images will be pulled from their registries", host)
+        extra_vars = self.extra_vars(served['address'], ArtifactCache.manifest(entry),
+                                     registries if served['registries'] else ())
+        return self.write_vars(deployment.path, extra_vars)
+
+
+class PreflightFailed(RuntimeError):
+    pass
+
+
+class HostCheck(object):
+    __slots__ = ('host', 'address', 'latency', 'error', 'sudo', 'python3', 'free_mb')
+
+    def __init__(self, host, address):
+        self.host = host
+        self.address = address
+        self.latency = None
+        self.error = None
+        self.sudo = None
+        self.python3 = None
+        self.free_mb = None
+
+
+    def problems(self, min_free_mb):
+        if self.error:
+            return [ self.error ]
+        problems = []
+        if not self.sudo:
+            problems.append('no passwordless sudo')
+        if not self.python3:
+            problems.append('no python3')
+        if self.free_mb is not None and self.free_mb < min_free_mb:
+            problems.append('{} MB free on /'.format(self.free_mb))
+        return problems
+
+
+def run_coroutine(coro):
+    """
+    asyncio.run(), on a fresh event loop that is closed afterwards.  Python 3.6
+    (the python of the image) doesn't have it yet.
+    """
+    if hasattr(asyncio, 'run'):
+        return asyncio.run(coro)
+    loop = asyncio.new_event_loop()
+    # set as the current loop, to attach the child watcher of the subprocesses
+    asyncio.set_event_loop(loop)
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()
+
+
+class Preflight(object):
+    """
+    Checks that all the hosts in the inventory are reachable over ssh (through
+    the bastion, when there is one) and ready to run the playbooks.
+
+    The hosts are checked concurrently, each one with its own deadline, so that
+    an unreachable node is reported in seconds rather than after ansible has
+    gone through its connection timeouts halfway through a playbook.
+    """
+
+    Policies = ('fail', 'exclude', 'off')
+    # hosts that can't be left out of a run without breaking the cluster
+    CriticalGroups = ('kube-master', 'etcd')
+
+    RemoteScript = ('sudo -n true >/dev/null 2>&1 && echo sudo=1; '
+                    'command -v python3 >/dev/null 2>&1 && echo python3=1; '
+                    'echo free_mb=$(df -Pm / | awk \'NR==2 {print $4}\')')
+
+    def __init__(self, policy='fail', timeout=DefaultPreflightTimeout,
+                 concurrency=DefaultPreflightConcurrency, min_free_mb=DefaultPreflightMinFreeMB):
+        if policy not in Preflight.Policies:
+            raise ValueError("Unknown pre-flight policy {}".format(policy))
+        self._policy = policy
+        self._timeout = timeout
+        self._concurrency = concurrency
+        self._min_free_mb = min_free_mb
+
+
+    def _ssh_cmd(self, inventory, host, ssh_config):
+        cmd = [ 'ssh', '-o', 'BatchMode=yes', '-o', 'ConnectTimeout={}'.format(self._timeout) ]
+        if ssh_config and os.path.exists(ssh_config):
+            cmd.extend(('-F', ssh_config))
+        else:
+            cmd.extend(('-o', 'StrictHostKeyChecking=no', '-o', 'UserKnownHostsFile=/dev/null'))
+        cmd.append('{}@{}'.format(inventory.user(host), inventory.address(host)))
+        cmd.append(Preflight.RemoteScript)
+        return cmd
+
+
+    async def _check_host(self, semaphore, inventory, host, ssh_config):
+        result = HostCheck(host, inventory.address(host))
+        async with semaphore:
+            start = time.time()
+            proc = await asyncio.create_subprocess_exec(*self._ssh_cmd(inventory, host, ssh_config),
+                    stdin=asyncio.subprocess.DEVNULL, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
+                    start_new_session=True)
+            try:
+                out, err = await asyncio.wait_for(proc.communicate(), self._timeout)
+            except asyncio.TimeoutError:
+                # also kill the ProxyCommand, which holds on to our stderr
+                os.killpg(proc.pid, signal.SIGKILL)
+                await proc.wait()
+                result.error = 'timed out after {}s'.format(self._timeout)
+                return result
+            result.latency = time.time() - start
+        if proc.returncode == 255:
+            lines = err.decode(errors='replace').strip().splitlines()
+            result.error = lines[-1] if lines else 'ssh connection failed'
+            return result
+        values = dict(line.split('=', 1) for line in out.decode(errors='replace').splitlines() if '=' in line)
+        result.sudo = values.get('sudo') == '1'
+        result.python3 = values.get('python3') == '1'
+        if values.get('free_mb', '').isdigit():
+            result.free_mb = int(values['free_mb'])
+        return result
+
+
+    async def _check_all(self, inventory, ssh_config):
+        semaphore = asyncio.Semaphore(self._concurrency)
+        results = collections.OrderedDict()
+        if inventory.bastion:
+            # open the bastion's master connection before the proxied hosts pile up on it
+            results['bastion'] = await self._check_host(semaphore, inventory, 'bastion', ssh_config)
+            if results['bastion'].error:
+                for host in inventory.nodes:
+                    if inventory.behind_bastion(host):
+                        results[host] = HostCheck(host, inventory.address(host))
+                        results[host].error = 'bastion unreachable'
+        pending = [ h for h in inventory.nodes if h not in results ]
+        checks = await asyncio.gather(*[ self._check_host(semaphore, inventory, h, ssh_config) for h in pending ])
+        results.update((c.host, c) for c in checks)
+        return list(results.values())
+
+
+    def check(self, inventory, ssh_config=None):
+        """
+        Check the hosts of the inventory and return the list of the ones to
+        exclude from the run.  Raises PreflightFailed if the run can't go on.
+        """
+        if self._policy == 'off':
+            logging.warning("Pre-flight checks disabled")
+            return []
+
+        logging.info("Pre-flight check of %d hosts...", len(inventory.hosts))
+        start = time.time()
+        results = run_coroutine(self._check_all(inventory, ssh_config))
+
+        fmt = "{:30}  {:20}  {:>9}  {}"
+        print(fmt.format("HOST", "ADDRESS", "LATENCY", "STATUS"))
+        failed = []
+        for r in results:
+            problems = r.problems(self._min_free_mb)
+            if problems:
+                failed.append(r.host)
+            print(fmt.format(r.host, r.address or '', '-' if r.latency is None else '{:.0f}ms'.format(r.latency * 1000),
+                             '; '.join(problems) or 'ok'))
+        logging.info("Pre-flight check completed in %.1f s: %d of %d hosts ready",
+                     time.time() - start, len(results) - len(failed), len(results))
+
+        if not failed:
+            return []
+        if self._policy == 'fail' or 'bastion' in failed:
+            raise PreflightFailed("Pre-flight check failed for hosts {}".format(', '.join(failed)))
+        critical = [ h for g in Preflight.CriticalGroups for h in inventory.groups.get(g, ()) if h in failed ]
+        if critical:
+            raise PreflightFailed("Pre-flight check failed for hosts {} which can't be excluded".format(
+                ', '.join(sorted(set(critical)))))
+        logging.warning("Excluding hosts %s from the run", ', '.join(failed))
+        return failed
 
 
 class Deployment(object):
-    def __init__(self, cluster_dir, inventory_file):
+    def __init__(self, cluster_dir, inventory_file, ansible_config=True,
+                 max_forks=DefaultMaxForks, fact_cache_ttl=DefaultFactCacheTTL, preflight=None,
+                 artifact_mirror=None):
         self._path = os.path.abspath(cluster_dir)
         self._current_version = self._get_last_deployment_ks_version()
         self._inventory = os.path.abspath(inventory_file)
+        self._journal = OperationJournal(os.path.join(self._path, OperationJournalFilename))
         assert os.path.exists(self._path)
         assert os.path.exists(self._inventory)
+        self._preflight = preflight
+        self._artifact_mirror = artifact_mirror
+        self._ansible_config = (max_forks, fact_cache_ttl) if ansible_config else None
 
 
     @property
@@ -147,11 +1700,21 @@ class Deployment(object):
         return self._path
 
 
+    @property
+    def inventory(self):
+        return self._inventory
+
+
     @property
     def current_ks_version(self):
         return self._current_version
 
 
+    @property
+    def journal(self):
+        return self._journal
+
+
     @property
     def _ks_version_stamp_file(self):
         return os.path.join(self.path, KsVersionStampFilename)
@@ -171,56 +1734,291 @@ class Deployment(object):
             logging.exception(e)
             raise
 
-    def _exec_kubespray_upgrade(self, ks_repo):
+    def _configure_ansible(self):
+        """
+        Write ansible.cfg and the ssh configuration for the inventory.  Called
+        once by the operations that run ansible, before any host is contacted.
+        """
+        if self._ansible_config:
+            AnsibleConfig(InventoryFile(self._inventory), *self._ansible_config).write(self._path)
+
+
+    def _preflight_excluded_hosts(self):
+        if self._preflight is None:
+            return []
+        return self._preflight.check(InventoryFile(self._inventory), os.path.join(self.path, SshConfigFilename))
+
+
+    @staticmethod
+    def _exclude_args(hosts):
+        if hosts:
+            return [ '--limit', ':'.join('!' + h for h in hosts) ]
+        return []
+
+
+    def _preflight_check(self):
+        """
+        Returns the ansible arguments to exclude the hosts that failed the pre-flight check.
+        """
+        return self._exclude_args(self._preflight_excluded_hosts())
+
+
+    def _artifact_mirror_args(self, ks_repo, version):
+        """
+        Returns the ansible arguments that point KubeSpray at the artifact mirror, if there's one.
+        """
+        if self._artifact_mirror is None:
+            return []
+        with chdir(self.path):
+            ks_repo.update_requirements()
+            return self._artifact_mirror.setup(ks_repo, self, version)
+
+
+    def _exec_playbook(self, ks_repo, playbook, op_id, version, start_at_task=None, extra_args=()):
         with chdir(self.path):
             # ensure the kubespray requirements are met
             ks_repo.update_requirements()
-            logging.info("Executing upgrade-cluster playbook...")
-            cmd = [ 'ansible-playbook', '-v', '--become',\
+            logging.info("Executing %s playbook...", playbook)
+            cmd = [ ks_repo.ansible_playbook, '-v', '--become',\
                     '-i', self._inventory,\
-                    '--timeout', '30',
-                    os.path.join(ks_repo.path, 'upgrade-cluster.yml') ]
+                    '--timeout', '30' ]
+            if start_at_task:
+                logging.info("Resuming at task '%s'", start_at_task)
+                cmd.extend(('--start-at-task', start_at_task))
+            cmd.extend(extra_args)
+            cmd.append(os.path.join(ks_repo.path, playbook))
             logging.debug("Executing command: %s", cmd)
-            subprocess.check_call(cmd)
+            self._journal.record(op_id, 'hop-start', version=version, playbook=playbook, start_at_task=start_at_task)
+            try:
+                subprocess.check_call(cmd, env=self._journal.ansible_env(op_id, version, playbook))
+            except subprocess.CalledProcessError as e:
+                self._journal.record(op_id, 'hop-failed', version=version, returncode=e.returncode)
+                raise
 
 
     def _stamp_installation(self, kubespray_version, action):
         with open(self._ks_version_stamp_file, 'a') as f:
                 f.write("{} {}\n".format(kubespray_version, action))
 
-    def deploy(self, ks_repo, version):
+    def _resume_point(self, op, version):
+        task, hosts = op.failure(version)
+        if task:
+            logging.info("Version %s failed at task '%s' on hosts %s", version, task, ', '.join(hosts))
+        return task
+
+
+    def deploy(self, ks_repo, version, resume=False):
         logging.info("Deploying Kubernetes with KubeSpray version %s", version)
-        logging.info("Using KubeSpray repository at path %s", ks_repo.path)
+        self._configure_ansible()
+        limit_args = self._preflight_check()
+
+        start_at_task = None
+        if resume:
+            op = self._journal.resumable_operation('deploy', version)
+            op_id = op.id
+            start_at_task = self._resume_point(op, version)
+            self._journal.record(op_id, 'resume')
+        else:
+            op_id = self._journal.begin('deploy', version, [ version ])
 
         ks_repo.checkout(version)
-        ks_repo.update_requirements()
+        logging.info("Using KubeSpray repository at path %s", ks_repo.path)
+
+        mirror_args = self._artifact_mirror_args(ks_repo, version)
 
         logging.info("Deploying Kubernetes")
-        cmd = [ 'ansible-playbook', '-v', '--become',\
-                '-i', self._inventory,\
-                '--timeout', '30',
-                os.path.join(ks_repo.path, 'cluster.yml') ]
-        logging.debug("Executing command: %s", cmd)
-        subprocess.check_call(cmd)
+        self._exec_playbook(ks_repo, 'cluster.yml', op_id, version, start_at_task, limit_args + mirror_args)
 
         self._stamp_installation(version, 'deploy')
+        self._journal.record(op_id, 'hop-end', version=version)
+        self._journal.record(op_id, 'end')
         logging.info("Deployment playbook completed")
 
 
-    def upgrade(self, target_ks_version, ks_repo):
+    def run_playbook(self, ks_repo, playbook, ansible_args=()):
+        """
+        Run one of the cluster's own playbooks (e.g., config-cluster-playbook.yml)
+        with the ansible of the cluster's KubeSpray version, recording its task
+        timings in the journal.
+        """
+        op_id = self._journal.new_operation_id()
+        self._configure_ansible()
+        limit_args = self._preflight_check()
+        if limit_args and any(a == '--limit' or a.startswith('--limit=') or a == '-l' for a in ansible_args):
+            raise PreflightFailed("Can't exclude the unreachable hosts from a run that already specifies --limit")
+        if self.current_ks_version:
+            ks_repo.checkout(self.current_ks_version)
+        with chdir(self.path):
+            ks_repo.update_requirements()
+            cmd = [ ks_repo.ansible_playbook, '--become', '-i', self._inventory, '--timeout', '30' ]
+            cmd.extend(limit_args)
+            cmd.extend(ansible_args)
+            cmd.append(playbook)
+            logging.debug("Executing command: %s", cmd)
+            subprocess.check_call(cmd, env=self._journal.ansible_env(op_id, self.current_ks_version,
+                                                                       os.path.basename(playbook)))
+
+
+    def scale_in(self, ks_repo, state_file, plan_file):
+        """
+        Remove from the cluster the nodes that the terraform plan in plan_file
+        (the output of `terraform show`) is going to destroy.  Must be run
+        before applying the plan, while the nodes can still be drained.
+        """
+        with open(plan_file) as f:
+            removed = create_inventory.TerraformState.load(state_file).planned_removals(f.read())
+        names = [ i.name.lower() for i in removed ]
+        if not names:
+            logging.info("The terraform plan doesn't remove any node")
+            return
+
+        inventory = InventoryFile(self._inventory)
+        protected = sorted(set(n for g in Preflight.CriticalGroups for n in inventory.groups.get(g, ()) if n in names))
+        if any(i.is_bastion_node() for i in removed) or protected:
+            raise RuntimeError("The terraform plan removes or replaces the bastion or master or etcd nodes ({}).  "
+                               "Only worker nodes can be removed by scaling the cluster".format(', '.join(protected)))
+
+        version = self.current_ks_version
+        logging.info("Removing nodes %s with KubeSpray version %s", ', '.join(names), version)
+        self._configure_ansible()
+        extra_args = self._preflight_check()
+        op_id = self._journal.begin('scale-in', version, [ version ])
+        ks_repo.checkout(version)
+        extra_args += [ '-e', 'node={}'.format(','.join(names)), '-e', 'skip_confirmation=yes' ]
+        self._exec_playbook(ks_repo, 'remove-node.yml', op_id, version, extra_args=extra_args)
+        self._journal.record(op_id, 'hop-end', version=version)
+        self._journal.record(op_id, 'end')
+
+
+    def scale_out(self, ks_repo, previous_state_file, state_file):
+        """
+        Update the inventory with the difference between the terraform states
+        before and after scaling the cluster and join the new nodes, without
+        running the playbooks on the nodes that were already there.
+        """
+        previous_state = create_inventory.TerraformState.load(previous_state_file)
+        state = create_inventory.TerraformState.load(state_file)
+        added, removed = create_inventory.TerraformState.diff(previous_state, state)
+        logging.info("Terraform state changes:  %d instances added, %d removed", len(added), len(removed))
+        create_inventory.Inventory.update(self._inventory, state, added, removed)
+        self._configure_ansible()
+
+        names = [ i.name.lower() for i in added if not i.is_bastion_node() ]
+        if not names:
+            logging.info("No new nodes to add to the cluster")
+            return
+
+        version = self.current_ks_version
+        logging.info("Adding nodes %s with KubeSpray version %s", ', '.join(names), version)
+        excluded = self._preflight_excluded_hosts()
+        names = [ n for n in names if n not in excluded ]
+        if not names:
+            raise PreflightFailed("None of the new nodes passed the pre-flight check")
+        op_id = self._journal.begin('scale-out', version, [ version ])
+        ks_repo.checkout(version)
+        # scale.yml is limited to the new nodes, so first refresh the facts of
+        # all the others (newer KubeSpray versions have a playbook just for that)
+        if os.path.exists(os.path.join(ks_repo.path, 'facts.yml')):
+            self._exec_playbook(ks_repo, 'facts.yml', op_id, version, extra_args=self._exclude_args(excluded))
+        self._exec_playbook(ks_repo, 'scale.yml', op_id, version,
+                            extra_args=[ '--limit', ','.join(names) ] + self._artifact_mirror_args(ks_repo, version))
+        self._journal.record(op_id, 'hop-end', version=version)
+        self._journal.record(op_id, 'end')
+        logging.info("Nodes added to the cluster")
+
+
+    @property
+    def _upgrade_history_file(self):
+        return os.path.join(self.path, UpgradeHistoryFilename)
+
+
+    def upgrade_history(self):
+        try:
+            with open(self._upgrade_history_file) as f:
+                return [ json.loads(line) for line in f if line.strip() ]
+        except FileNotFoundError:
+            return []
+
+
+    def _record_upgrade_history(self, entry):
+        with open(self._upgrade_history_file, 'a') as f:
+            f.write(json.dumps(entry, sort_keys=True) + '\n')
+
+
+    def upgrade_batches(self, max_unavailable=None):
+        return UpgradeBatches(InventoryFile(self._inventory), max_unavailable)
+
+
+    def upgrade(self, target_ks_version, ks_repo, readiness_gate=None, sequential=False, resume=False,
+                max_unavailable=None):
         logging.info("Current deployment created with KubeSpray version %s", self.current_ks_version)
         logging.info("Requested upgrade to version %s", target_ks_version)
-        logging.info("Using KubeSpray repository at path %s", ks_repo.path)
+        batches = self.upgrade_batches(max_unavailable)
+        for line in batches.describe():
+            logging.info(line)
+        self._configure_ansible()
+        limit_args = self._preflight_check()
+
+        start_at_task = None
+        if resume:
+            op = self._journal.resumable_operation('upgrade', target_ks_version)
+            op_id = op.id
+            completed = op.completed_hops
+            plan = [ v for v in op.plan if v not in completed ]
+            logging.info("Resuming upgrade %s: %d of %d steps already completed", op_id, len(completed), len(op.plan))
+            if plan:
+                start_at_task = self._resume_point(op, plan[0])
+            self._journal.record(op_id, 'resume')
+            # the cluster may not have converged after the last completed step
+            if completed and readiness_gate and not op.is_ready(completed[-1]):
+                readiness_gate.wait()
+                self._journal.record(op_id, 'hop-ready', version=completed[-1])
+        else:
+            plan = UpgradePlanner().plan(self.current_ks_version, target_ks_version, sequential)
+            op_id = self._journal.begin('upgrade', target_ks_version, plan)
 
-        for ks_version in ks_repo.iterversions(self.current_ks_version, target_ks_version):
+        base_ks_version = self.current_ks_version
+        for ks_version in plan:
             logging.info("Attempting upgrade to version %s", ks_version)
-            self._exec_kubespray_upgrade(ks_repo)
+            ks_repo.checkout(ks_version)
+            logging.info("Using KubeSpray repository at path %s", ks_repo.path)
+            started = time.time()
+            mirror_args = self._artifact_mirror_args(ks_repo, ks_version)
+            # the mirror setup fills the cache on its first run:  it's kept out of
+            # the playbook time that the estimates of the next upgrades use
+            start = time.time()
+            mirror_seconds = start - started
+            self._exec_playbook(ks_repo, 'upgrade-cluster.yml', op_id, ks_version, start_at_task,
+                                limit_args + mirror_args + batches.extra_args())
+            playbook_seconds = time.time() - start
+            start_at_task = None
             self._stamp_installation(ks_version, 'upgrade')
+            self._journal.record(op_id, 'hop-end', version=ks_version)
             logging.info("Upgrade playbook for version %s completed", ks_version)
-            logging.warn("Sleeping 60 seconds hoping it'll be enough for everything to come up...")
-            time.sleep(60)
-            
 
+            batch_timings = self._journal.last_operation().batches(ks_version)
+            for e in batch_timings:
+                logging.info("Play %s, batch %s (%d nodes): %.0f s", e['play'], e['batch'], len(e['hosts']), e['duration'])
+
+            convergence_seconds = None
+            if readiness_gate:
+                convergence_seconds = readiness_gate.wait()
+                self._journal.record(op_id, 'hop-ready', version=ks_version)
+            self._record_upgrade_history({
+                'from': base_ks_version,
+                'to': ks_version,
+                'started': started,
+                'mirror_seconds': round(mirror_seconds, 1),
+                'playbook_seconds': round(playbook_seconds, 1),
+                'convergence_seconds': None if convergence_seconds is None else round(convergence_seconds, 1),
+                'worker_batch_size': batches.batch_size,
+                'batches': [ { 'play': e['play'], 'batch': e['batch'], 'nodes': len(e['hosts']),
+                               'seconds': e['duration'] } for e in batch_timings ] })
+            logging.info("Hop %s -> %s: playbook %.0f s, convergence %s s", base_ks_version, ks_version,
+                         playbook_seconds, 'n/a' if convergence_seconds is None else '{:.0f}'.format(convergence_seconds))
+            base_ks_version = ks_version
+
+        self._journal.record(op_id, 'end')
         logging.info("Upgrade operation complete.  Cluster is now deployed with Kubespray version %s", target_ks_version)
 
 
@@ -232,17 +2030,21 @@ def checkout_cmd(ks_repo, options):
 
 
 def deploy_cmd(repo, options):
-    deployment = _construct_deployment(options)
+    deployment = _construct_deployment(options, preflight=True)
     target_ks_version = options.target_version
-    deployment.deploy(repo, target_ks_version)
+    deployment.deploy(repo, target_ks_version, options.resume)
 
 
 def upgrade_cmd(repo, options):
-    deployment = _construct_deployment(options)
+    deployment = _construct_deployment(options, preflight=not options.dry_run)
     target_ks_version = options.target_version
     k8s_version = KubesprayRepo.find_corresponding_k8s_version(target_ks_version)
     logging.info("Upgrading to Kubespray version %s (k8s version %s)", target_ks_version, k8s_version)
 
+    if options.dry_run:
+        print_upgrade_plan(deployment, target_ks_version, options.sequential, options.max_unavailable)
+        return
+
     if not options.yes_upgrade_28_29:
         if tuple(target_ks_version.split('.')) >= ('2', '9') and \
            tuple(deployment.current_ks_version.split('.')) < ('2', '9'):
@@ -254,12 +2056,183 @@ def upgrade_cmd(repo, options):
                           "for details.")
             raise RuntimeError("Specify --yes-upgrade-28-29 to upgrade from 2.8.5 to 2.9.")
 
-    deployment.upgrade(target_ks_version, repo)
+    readiness_gate = _construct_readiness_gate(repo, deployment, options)
+    try:
+        deployment.upgrade(target_ks_version, repo, readiness_gate,
+                           options.sequential, options.resume, options.max_unavailable)
+    finally:
+        if readiness_gate:
+            readiness_gate.close()
     logging.info("Upgrade complete!")
 
 
-def _construct_deployment(options):
-    return Deployment(options.cluster_dir, os.path.join(options.cluster_dir, 'hosts.ini'))
+def print_upgrade_plan(deployment, target_ks_version, sequential=False, max_unavailable=None):
+    path = UpgradePlanner().plan(deployment.current_ks_version, target_ks_version, sequential)
+    estimates = UpgradePlanner.estimate(path, deployment.upgrade_history())
+
+    fmt = "{:>4}  {:15}\t{:15}\t{:>12}"
+    print("Upgrade plan from KubeSpray {} to {} ({} steps):".format(
+        deployment.current_ks_version, target_ks_version, len(path)))
+    print(fmt.format("Step", "KubeSpray", "Kubernetes", "Estimate"))
+    for step, (version, seconds) in enumerate(estimates, 1):
+        print(fmt.format(step, version, KubesprayRepo.find_corresponding_k8s_version(version),
+                         '{:.0f} min'.format(seconds / 60) if seconds is not None else 'unknown'))
+    if path and all(seconds is not None for _, seconds in estimates):
+        print("Estimated total: {:.0f} min".format(sum(seconds for _, seconds in estimates) / 60))
+    else:
+        print("Estimated total: unknown (not enough upgrade history for this cluster)")
+    print("\nEvery step upgrades the nodes as follows:")
+    for line in deployment.upgrade_batches(max_unavailable).describe():
+        print("  " + line)
+
+
+def run_playbook_cmd(repo, options):
+    deployment = _construct_deployment(options, preflight=True)
+    deployment.run_playbook(repo, options.playbook, options.ansible_args)
+
+
+def scale_cmd(repo, options):
+    # the nodes that a scale-in removes are often the unreachable ones
+    deployment = _construct_deployment(options, preflight=not options.plan)
+    if deployment.current_ks_version is None:
+        raise RuntimeError("Kubernetes hasn't been deployed on the cluster yet.  Run deploy-k8s instead")
+    if options.plan:
+        deployment.scale_in(repo, options.state, options.plan)
+    else:
+        deployment.scale_out(repo, options.previous_state, options.state)
+
+
+def _format_task(key):
+    play, task = key
+    return "{} | {}".format(play, task)
+
+
+def profile_cmd(repo, options):
+    deployment = _construct_deployment(options)
+    profiles = PlaybookProfile.from_journal(deployment.journal)
+    if not profiles:
+        raise RuntimeError("No playbook timings recorded in {}".format(deployment.journal.path))
+
+    if options.list:
+        print("{:30}  {:30}  {:19}  {:>10}".format("RUN", "PLAYBOOK", "STARTED", "DURATION"))
+        for p in profiles:
+            print("{:30}  {:30}  {:19}  {:>9.0f}s".format(p.run_id, p.playbook or '', time.strftime(
+                '%Y-%m-%d %H:%M:%S', time.localtime(p.started)), p.total_seconds))
+        return
+
+    by_id = { p.run_id: p for p in profiles }
+    if options.run and options.run not in by_id:
+        raise ValueError("Unknown run {}.  Use --list to see the recorded runs".format(options.run))
+    profile = by_id[options.run] if options.run else profiles[-1]
+
+    if options.compare:
+        if options.compare == 'previous':
+            previous = [ p for p in profiles[:profiles.index(profile)] if p.playbook == profile.playbook ]
+            if not previous:
+                raise RuntimeError("No previous run of {} to compare with".format(profile.playbook))
+            base = previous[-1]
+        elif options.compare in by_id:
+            base = by_id[options.compare]
+        else:
+            raise ValueError("Unknown run {}.  Use --list to see the recorded runs".format(options.compare))
+        print("Comparing run {} ({:.0f}s) with {} ({:.0f}s)".format(
+            profile.run_id, profile.total_seconds, base.run_id, base.total_seconds))
+        regressions = PlaybookProfile.compare(base, profile, options.threshold / 100.0)
+        if not regressions:
+            print("No task regressed by more than {}%".format(options.threshold))
+        for key, before, after in regressions[:options.top]:
+            print("REGRESSION {:>8.1f}s -> {:>8.1f}s  {}".format(before, after, _format_task(key)))
+        return
+
+    print("Run {} of {}: {:.0f}s".format(profile.run_id, profile.playbook, profile.total_seconds))
+    print("\nSlowest tasks:")
+    print("{:>9}  {:>7}  {:>6}  {:>11}  {}".format("SECONDS", "CHANGED", "FAILED", "UNREACHABLE", "TASK"))
+    for key, stats in profile.slowest_tasks(options.top):
+        print("{:>9.1f}  {:>7}  {:>6}  {:>11}  {}".format(
+            stats['duration'], stats['changed'], stats['failed'], stats['unreachable'], _format_task(key)))
+
+    if profile.batches:
+        print("\nBatches:")
+        print("{:>9}  {:>5}  {:>5}  {}".format("SECONDS", "BATCH", "NODES", "PLAY"))
+        for batches in profile.batches:
+            for e in batches:
+                print("{:>9.1f}  {:>5}  {:>5}  {}".format(e['duration'], e['batch'], len(e['hosts']), e['play']))
+
+    # how many of the runs flagged each host as slow
+    slow_counts = collections.Counter()
+    for p in profiles:
+        slow_counts.update(host for host, _, _ in p.slow_hosts())
+    print("\nSlow hosts:")
+    slow_hosts = profile.slow_hosts()
+    if not slow_hosts:
+        print("none")
+    for host, fraction, seconds in slow_hosts[:options.top]:
+        print("{:30} slow on {:.0%} of its tasks ({:.0f}s lost); slow in {} of {} runs".format(
+            host, fraction, seconds, slow_counts[host], len(profiles)))
+
+
+def artifacts_cmd(repo, options):
+    cache = _construct_artifact_cache(options)
+    if options.artifacts_action == 'list':
+        fmt = "{:28}\t{:>6}\t{:>10}\t{}"
+        print(fmt.format("ENTRY", "FILES", "SIZE (MB)", "LAST USED"))
+        for key, path in cache.entries():
+            manifest = ArtifactCache.manifest(path)
+            size = sum(os.path.getsize(os.path.join(path, item['path'])) for item in manifest)
+            print(fmt.format(key, len(manifest), '{:.1f}'.format(size / 2**20),
+                             time.strftime('%Y-%m-%d %H:%M', time.localtime(os.path.getmtime(path)))))
+    elif options.artifacts_action == 'verify':
+        bad_entries = 0
+        for key, path in cache.entries():
+            bad = ArtifactCache.verify(path)
+            for item in bad:
+                logging.error("%s: %s is missing or corrupted", key, item)
+            bad_entries += 1 if bad else 0
+        if bad_entries:
+            raise RuntimeError("{} cache entries are corrupted:  delete them to fetch them again".format(bad_entries))
+    else:
+        if options.downloads:
+            with open(options.downloads) as f:
+                downloads = [ Download(d['name'], d['url'], d.get('sha256'), d['variable']) for d in json.load(f) ]
+        else:
+            repo.checkout(options.target_version)
+            with chdir(options.cluster_dir):
+                repo.update_requirements()
+                downloads = ArtifactMirror(cache).downloads(repo, os.path.join(options.cluster_dir, 'hosts.ini'))
+        entry = cache.get(options.target_version, downloads)
+        print(entry)
+        if options.mirror_address:
+            mirror = ArtifactMirror(cache, options.artifact_mirror_port)
+            ArtifactMirror.write_vars(options.cluster_dir,
+                                      mirror.extra_vars(options.mirror_address, ArtifactCache.manifest(entry)))
+
+
+def _construct_artifact_cache(options):
+    if not options.artifact_cache:
+        raise RuntimeError("The artifact cache requires --artifact-cache")
+    return ArtifactCache(options.artifact_cache, options.artifact_cache_size)
+
+
+def _construct_deployment(options, preflight=False):
+    artifact_mirror = None
+    if options.artifact_mirror:
+        artifact_mirror = ArtifactMirror(_construct_artifact_cache(options), options.artifact_mirror_port,
+                                         not options.no_registry_mirror)
+    return Deployment(options.cluster_dir, os.path.join(options.cluster_dir, 'hosts.ini'),
+                      not options.no_ansible_config, options.max_forks, options.fact_cache_ttl,
+                      Preflight(options.preflight, options.preflight_timeout) if preflight else None,
+                      artifact_mirror)
+
+
+def _construct_readiness_gate(repo, deployment, options):
+    if options.readiness_timeout <= 0:
+        logging.warning("Readiness checks between upgrade hops are disabled")
+        return None
+    if options.kubeconfig:
+        client = HttpApiClient.from_kubeconfig(options.kubeconfig)
+    else:
+        client = AnsibleKubectlClient(deployment.inventory, repo)
+    return ReadinessGate(client, deadline=options.readiness_timeout)
 
 
 def create_parser():
@@ -267,6 +2240,37 @@ def create_parser():
     parser.add_argument('kubespray_repo', metavar='KUBESPRAY_DIR', help="Path to Kubespray git repository")
     parser.add_argument('--cluster-dir', metavar='CLUSTER_TF_DIR', help="Path to cluster tf deployment directory", default=os.getcwd())
     parser.add_argument('--target-version', metavar='x.y.z', help='Target kubespray version', default=DefaultKubesprayVersion)
+    parser.add_argument('--worktree-cache', metavar='DIR',
+            help="Use pre-patched KubeSpray trees cached in DIR instead of checking out versions in KUBESPRAY_DIR")
+    parser.add_argument('--worktree-cache-size', metavar='N', type=int, default=DefaultWorktreeCacheSize,
+            help="Max number of KubeSpray versions kept in the worktree cache")
+    parser.add_argument('--venv-cache', metavar='DIR',
+            help="Install the KubeSpray requirements in virtualenvs cached in DIR instead of the system python")
+    parser.add_argument('--venv-cache-size', metavar='N', type=int, default=DefaultVirtualenvCacheSize,
+            help="Max number of virtualenvs kept in the cache")
+    parser.add_argument('--artifact-cache', metavar='DIR',
+            help="Cache the files downloaded by KubeSpray in DIR, verified against their checksums")
+    parser.add_argument('--artifact-cache-size', metavar='N', type=int, default=DefaultArtifactCacheSize,
+            help="Max number of KubeSpray versions kept in the artifact cache")
+    parser.add_argument('--artifact-mirror', action='store_true',
+            help="Serve the artifact cache from the bastion (or the first master) and have KubeSpray "
+                 "download from there (requires --artifact-cache)")
+    parser.add_argument('--artifact-mirror-port', metavar='PORT', type=int, default=DefaultArtifactMirrorPort,
+            help="Port of the HTTP server of the artifact mirror")
+    parser.add_argument('--no-registry-mirror', action='store_true',
+            help="Don't run pull-through registries for the container images on the artifact mirror")
+
+    parser.add_argument('--no-ansible-config', action='store_true',
+            help="Don't generate ansible.cfg and the ssh configuration in the cluster directory")
+    parser.add_argument('--max-forks', metavar='N', type=int, default=DefaultMaxForks,
+            help="Upper limit for the ansible forks, which are otherwise sized on the number of nodes")
+    parser.add_argument('--fact-cache-ttl', metavar='SECONDS', type=int, default=DefaultFactCacheTTL,
+            help="How long ansible facts are cached between playbook runs")
+    parser.add_argument('--preflight', choices=Preflight.Policies, default='fail',
+            help="What to do when some hosts fail the ssh pre-flight check run before the playbooks: "
+                 "abort the run, exclude the hosts from it (not masters and etcd) or skip the check altogether")
+    parser.add_argument('--preflight-timeout', metavar='SECONDS', type=int, default=DefaultPreflightTimeout,
+            help="Deadline for the pre-flight check of each host")
 
     subparsers = parser.add_subparsers(dest='action')
 
@@ -277,12 +2281,68 @@ def create_parser():
     parser_checkout.set_defaults(func=checkout_cmd)
 
     parser_install = subparsers.add_parser('deploy-k8s')
+    parser_install.add_argument('--resume', action='store_true',
+            help="Resume the last interrupted deployment from the task that failed")
     parser_install.set_defaults(func=deploy_cmd)
 
     parser_upgrade = subparsers.add_parser('upgrade-k8s')
     parser_upgrade.add_argument('--yes-upgrade-28-29', action='store_true', default=False, help="Allow upgrade from 2.8.5 to 2.9")
+    parser_upgrade.add_argument('--readiness-timeout', metavar='SECONDS', type=int, default=1800,
+            help="Max time to wait for the cluster to become ready after each upgrade step (0 disables the check)")
+    parser_upgrade.add_argument('--resume', action='store_true',
+            help="Resume the last interrupted upgrade from the step and task that failed")
+    parser_upgrade.add_argument('--dry-run', action='store_true',
+            help="Print the upgrade plan and its estimated duration without upgrading")
+    parser_upgrade.add_argument('--sequential', action='store_true',
+            help="Upgrade through every intermediate version in the version table instead of the shortest safe path")
+    parser_upgrade.add_argument('--kubeconfig', metavar='FILE',
+            help="Query the API server directly with this kubeconfig instead of running kubectl on the first master")
+    parser_upgrade.add_argument('--max-unavailable', metavar='N|PERCENT',
+            help="Disruption budget of the workers:  how many of them (or which percentage) can be upgraded at "
+                 "the same time.  Groups can have their own with upgrade_max_unavailable in [group:vars] of "
+                 "hosts.ini.  Masters and etcd members are always upgraded one at a time")
     parser_upgrade.set_defaults(func=upgrade_cmd)
 
+    parser_playbook = subparsers.add_parser('run-playbook',
+      help="Run a playbook of the cluster directory recording its timings in the journal")
+    parser_playbook.add_argument('playbook', metavar='PLAYBOOK')
+    parser_playbook.add_argument('ansible_args', metavar='ANSIBLE_ARGS', nargs=argparse.REMAINDER,
+            help="Additional arguments for ansible-playbook")
+    parser_playbook.set_defaults(func=run_playbook_cmd)
+
+    parser_scale = subparsers.add_parser('scale',
+      help="Remove the nodes a terraform plan is going to destroy or add the nodes created since a previous state")
+    scale_mode = parser_scale.add_mutually_exclusive_group(required=True)
+    scale_mode.add_argument('--plan', metavar='FILE',
+            help="Output of `terraform show` for the plan about to be applied: remove the nodes it destroys")
+    scale_mode.add_argument('--previous-state', metavar='FILE',
+            help="Terraform state before the last apply: update the inventory and add the new nodes")
+    parser_scale.add_argument('--state', metavar='FILE', default='terraform.tfstate', help="Current terraform state")
+    parser_scale.set_defaults(func=scale_cmd)
+
+    parser_profile = subparsers.add_parser('profile',
+      help="Report the slowest tasks and hosts of the playbook runs recorded in the journal")
+    parser_profile.add_argument('--list', action='store_true', help="List the recorded runs")
+    parser_profile.add_argument('--run', metavar='RUN', help="Run to report on (default: the latest)")
+    parser_profile.add_argument('--compare', metavar='RUN', nargs='?', const='previous',
+            help="Report the tasks that got slower than in RUN (default: the previous run of the same playbook)")
+    parser_profile.add_argument('--threshold', metavar='PERCENT', type=int, default=25,
+            help="Min slowdown for a task to be reported as a regression")
+    parser_profile.add_argument('--top', metavar='N', type=int, default=20, help="Number of tasks and hosts to show")
+    parser_profile.set_defaults(func=profile_cmd)
+
+    parser_artifacts = subparsers.add_parser('artifacts',
+      help="Manage the cache of the files downloaded by KubeSpray (see --artifact-cache)")
+    parser_artifacts.add_argument('artifacts_action', choices=('fetch', 'list', 'verify'),
+            help="fetch the downloads of the target version, list the cached versions or verify their checksums")
+    parser_artifacts.add_argument('--downloads', metavar='FILE',
+            help="fetch: JSON list of the downloads ({name, url, sha256, variable}) instead of the ones "
+                 "KubeSpray needs for the cluster")
+    parser_artifacts.add_argument('--mirror-address', metavar='ADDRESS',
+            help="fetch: write the variables that point KubeSpray at a mirror of the fetched files "
+                 "served from ADDRESS (e.g., a manually started HTTP server)")
+    parser_artifacts.set_defaults(func=artifacts_cmd)
+
     return parser
 
 
@@ -290,7 +2350,13 @@ def main(args=None):
     parser = create_parser()
     options = parser.parse_args(args)
 
-    repo = KubesprayRepo(options.kubespray_repo)
+    worktree_cache = None
+    if options.worktree_cache:
+        worktree_cache = WorktreeCache(options.kubespray_repo, options.worktree_cache, options.worktree_cache_size)
+    venv_cache = None
+    if options.venv_cache:
+        venv_cache = VirtualenvCache(options.venv_cache, options.venv_cache_size)
+    repo = KubesprayRepo(options.kubespray_repo, worktree_cache, venv_cache)
 
     options.func(repo, options)
 
@@ -47,10 +47,14 @@ echo "$DOCKER_PASSWORD" | docker login -u "$DOCKER_USERNAME" --password-stdin
 # get manage-cluster version to tag the image
 image_tag=$(../k8s-tools/manage-cluster -v)
 
-# tag and push images
-for target in manage-cluster-tf manage-cluster-ks; do
-  docker_image_name="tdmproject/${target}:${image_tag}"
-  tagged_docker_image="${DockerHubOwner}/${target}:${image_tag}"
+# tag and push images:  manage-cluster-tf and manage-cluster-ks, with the
+# manage-cluster-ks images of the single KubeSpray versions built by build.sh
+images=(manage-cluster-tf:${image_tag} manage-cluster-ks:${image_tag})
+images+=( $(docker images --format '{{.Tag}}' tdmproject/manage-cluster-ks | \
+            sed -n -e "s/^${image_tag//./\\.}-ks[0-9.]*$/manage-cluster-ks:&/p") )
+for image in "${images[@]}"; do
+  docker_image_name="tdmproject/${image}"
+  tagged_docker_image="${DockerHubOwner}/${image}"
   docker tag "${docker_image_name}" "${tagged_docker_image}"
   echo -e "\nPushing ${tagged_docker_image}..." >&2
   docker push ${tagged_docker_image}
@@ -0,0 +1,310 @@
+#!/usr/bin/env python3
+
+# Copyright 2018-2020 CRS4 (http://www.crs4.it/)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Runs `terraform apply` or `terraform destroy` for manage-cluster.
+
+The parallelism is chosen from the number of instances in cluster.tf and
+from the OpenStack API errors seen in the previous runs, which are recorded
+in a history file in the working directory.  Runs that fail because the
+API throttled them are retried with exponential backoff and halved
+parallelism:  terraform resumes from where it stopped.  At the end, the
+provisioning time of every resource type is reported.
+"""
+
+import argparse
+import collections
+import json
+import logging
+import os
+import random
+import re
+import subprocess
+import sys
+import time
+
+HistoryFilename = '.terraform-runs.json'
+HistorySize = 20
+DefaultMinParallelism = 5
+# terraform's own default
+DefaultParallelism = 10
+DefaultMaxParallelism = 40
+DefaultMaxRetries = 4
+DefaultRetryDelay = 20
+MaxRetryDelay = 300
+
+# 'number_of_k8s_nodes = 4' or 'number_of_k8s_nodes = "4"' in cluster.tf
+InstanceCountLine = re.compile(r'^\s*(number_of_\w+)\s*=\s*"?(\d+)"?', re.MULTILINE)
+AnsiEscape = re.compile(r'\x1b\[[0-9;]*m')
+# 'module.compute.openstack_compute_instance_v2.k8s_node.0: Creation complete after 1m5s (ID: ...)'
+CompletedLine = re.compile(r'^(?P<address>\S+): (?:Creation|Destruction|Modifications) complete after (?P<duration>[0-9hms]+)')
+DurationPart = re.compile(r'(\d+)([hms])')
+# errors of OpenStack APIs that are throttling us:  worth retrying
+RateLimitError = re.compile(r'\b(?:429|413)\b|too many requests|rate ?limit|over ?limit|'
+                            r'\b503\b|service unavailable', re.IGNORECASE)
+# exhausted quotas:  retrying won't help
+QuotaError = re.compile(r'quota exceeded|exceeds? (?:the |your )?quota|QuotaExceeded', re.IGNORECASE)
+
+
+def count_instances(variables_filename):
+    """
+    Number of instances requested by the cluster variables file.
+    """
+    with open(variables_filename) as f:
+        text = '\n'.join(line for line in f if not line.lstrip().startswith('#'))
+    return sum(int(count) for name, count in InstanceCountLine.findall(text))
+
+
+def resource_type(address):
+    """
+    'module.compute.openstack_compute_instance_v2.k8s_node[0]' -> 'openstack_compute_instance_v2'
+    """
+    parts = address.split('.')
+    while len(parts) > 2 and parts[0] == 'module':
+        parts = parts[2:]
+    if parts[0] == 'data' and len(parts) > 1:
+        return 'data.' + parts[1]
+    return parts[0]
+
+
+def parse_duration(text):
+    return sum(int(n) * { 'h': 3600, 'm': 60, 's': 1 }[unit] for n, unit in DurationPart.findall(text))
+
+
+class RunStats(object):
+    """
+    What a terraform run printed:  completion times per resource type and
+    API errors.
+    """
+    __slots__ = ('by_type', 'throttled', 'quota_errors')
+
+    def __init__(self):
+        # resource type -> [count, total seconds, max seconds]
+        self.by_type = collections.OrderedDict()
+        self.throttled = 0
+        self.quota_errors = 0
+
+
+    def feed(self, line):
+        line = AnsiEscape.sub('', line).strip()
+        match = CompletedLine.match(line)
+        if match:
+            seconds = parse_duration(match.group('duration'))
+            entry = self.by_type.setdefault(resource_type(match.group('address')), [0, 0, 0])
+            entry[0] += 1
+            entry[1] += seconds
+            entry[2] = max(entry[2], seconds)
+        elif line.startswith('* ') or line.startswith('Error'):
+            if QuotaError.search(line):
+                self.quota_errors += 1
+            elif RateLimitError.search(line):
+                self.throttled += 1
+
+
+    def add(self, other):
+        for rtype, (count, total, longest) in other.by_type.items():
+            entry = self.by_type.setdefault(rtype, [0, 0, 0])
+            entry[0] += count
+            entry[1] += total
+            entry[2] = max(entry[2], longest)
+        self.throttled += other.throttled
+        self.quota_errors += other.quota_errors
+
+
+    @property
+    def resources(self):
+        return sum(entry[0] for entry in self.by_type.values())
+
+
+    def report(self, out=sys.stdout):
+        if not self.by_type:
+            return
+        print("\nProvisioning time by resource type:", file=out)
+        print("  {:<48} {:>6} {:>10} {:>8}".format("RESOURCE TYPE", "COUNT", "TOTAL (s)", "MAX (s)"), file=out)
+        for rtype, (count, total, longest) in sorted(self.by_type.items(), key=lambda item: -item[1][1]):
+            print("  {:<48} {:>6} {:>10} {:>8}".format(rtype, count, total, longest), file=out)
+
+
+class RunHistory(object):
+    """
+    The last runs, as a list of JSON objects in a file.
+    """
+
+    def __init__(self, filename=HistoryFilename):
+        self._filename = filename
+
+
+    def runs(self, action=None):
+        try:
+            with open(self._filename) as f:
+                runs = json.load(f)
+        except (IOError, ValueError):
+            return []
+        return [ r for r in runs if action is None or r.get('action') == action ]
+
+
+    def record(self, run):
+        runs = self.runs() + [ run ]
+        tmp = '{}.{}'.format(self._filename, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(runs[-HistorySize:], f, indent=1)
+        os.replace(tmp, self._filename)
+
+
+class TerraformRunner(object):
+    """
+    :param action: 'apply' or 'destroy'
+    :param terraform_args: the other arguments for terraform
+    :param instances: number of instances in the cluster (sizes the parallelism)
+    :param parallelism: fixed parallelism (None to choose it)
+    """
+
+    Actions = ('apply', 'destroy')
+
+    def __init__(self, action, terraform_args, instances=0, history=None, parallelism=None,
+                 min_parallelism=DefaultMinParallelism, max_parallelism=DefaultMaxParallelism,
+                 max_retries=DefaultMaxRetries, retry_delay=DefaultRetryDelay, terraform='terraform'):
+        if action not in TerraformRunner.Actions:
+            raise ValueError("Unsupported terraform action {}".format(action))
+        self._action = action
+        self._args = list(terraform_args)
+        self._instances = instances
+        self._history = history or RunHistory()
+        self._parallelism = parallelism
+        self._min_parallelism = min_parallelism
+        self._max_parallelism = max(min_parallelism, max_parallelism)
+        self._max_retries = max_retries
+        self._retry_delay = retry_delay
+        self._terraform = terraform
+
+
+    def choose_parallelism(self):
+        """
+        Start from one operation per instance (at least terraform's default)
+        and adapt to the previous run of the same action:  halve its
+        parallelism if it gave up because the API throttled it, keep the
+        parallelism that got it through the throttling, or grow it by half
+        if it wasn't throttled at all.
+        """
+        if self._parallelism:
+            return self._parallelism
+        target = min(self._max_parallelism, max(DefaultParallelism, self._instances))
+        previous = self._history.runs(self._action)
+        if not previous:
+            return target
+        last = previous[-1]
+        if last.get('throttled'):
+            parallelism = last['final_parallelism'] // 2
+        elif last.get('total_throttled'):
+            parallelism = last['final_parallelism']
+        else:
+            parallelism = min(target, last['final_parallelism'] + max(1, last['final_parallelism'] // 2))
+        return max(self._min_parallelism, parallelism)
+
+
+    def _backoff(self, attempt):
+        delay = min(MaxRetryDelay, self._retry_delay * 2 ** attempt)
+        return delay * random.uniform(0.8, 1.2)
+
+
+    def _run_once(self, parallelism, stats):
+        cmd = [ self._terraform, self._action, '-parallelism={}'.format(parallelism) ] + self._args
+        logging.debug("Running %s", cmd)
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+        for line in proc.stdout:
+            sys.stdout.write(line)
+            sys.stdout.flush()
+            stats.feed(line)
+        return proc.wait()
+
+
+    def run(self):
+        parallelism = self.choose_parallelism()
+        total = RunStats()
+        start = time.time()
+        attempt = 0
+        while True:
+            logging.info("terraform %s with parallelism %s (attempt %s)", self._action, parallelism, attempt + 1)
+            stats = RunStats()
+            returncode = self._run_once(parallelism, stats)
+            total.add(stats)
+            if returncode == 0 or stats.quota_errors or not stats.throttled or attempt >= self._max_retries:
+                break
+            delay = self._backoff(attempt)
+            attempt += 1
+            parallelism = max(1, parallelism // 2)
+            logging.warning("The OpenStack API throttled %s operations.  Retrying in %.0f seconds with parallelism %s",
+                            stats.throttled, delay, parallelism)
+            time.sleep(delay)
+
+        total.report()
+        if stats.quota_errors:
+            logging.error("The OpenStack quota of the project is exhausted:  "
+                          "reduce the size of the cluster or ask for a larger quota")
+        elif returncode != 0 and stats.throttled:
+            logging.error("Still throttled by the OpenStack API after %s retries", self._max_retries)
+        self._history.record({
+            'action': self._action,
+            'time': round(start, 3),
+            'seconds': round(time.time() - start, 1),
+            'returncode': returncode,
+            'instances': self._instances,
+            'attempts': attempt + 1,
+            'final_parallelism': parallelism,
+            'throttled': stats.throttled,
+            'total_throttled': total.throttled,
+            'quota_errors': total.quota_errors,
+            'resources': total.resources,
+            'by_type': total.by_type,
+        })
+        return returncode
+
+
+def _build_parser():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('action', choices=TerraformRunner.Actions)
+    parser.add_argument('terraform_args', metavar='TERRAFORM_ARGS', nargs=argparse.REMAINDER,
+                        help="Other terraform arguments (after '--')")
+    parser.add_argument('--variables', metavar='FILE', default='cluster.tf',
+                        help="Cluster variables file, to count the instances")
+    parser.add_argument('--parallelism', metavar='N', type=int, help="Use this parallelism instead of choosing it")
+    parser.add_argument('--min-parallelism', metavar='N', type=int, default=DefaultMinParallelism)
+    parser.add_argument('--max-parallelism', metavar='N', type=int, default=DefaultMaxParallelism)
+    parser.add_argument('--max-retries', metavar='N', type=int, default=DefaultMaxRetries,
+                        help="Retries of runs throttled by the OpenStack API")
+    parser.add_argument('--retry-delay', metavar='SECONDS', type=float, default=DefaultRetryDelay,
+                        help="Delay before the first retry (doubled at every retry)")
+    parser.add_argument('--history', metavar='FILE', default=HistoryFilename)
+    parser.add_argument('--terraform', metavar='PATH', default='terraform', help="terraform executable")
+    parser.add_argument('--debug', action='store_true')
+    return parser
+
+
+def main(args=None):
+    options = _build_parser().parse_args(args)
+    logging.basicConfig(level=logging.DEBUG if options.debug else logging.INFO, format='%(levelname)s: %(message)s')
+    terraform_args = options.terraform_args
+    if terraform_args and terraform_args[0] == '--':
+        terraform_args = terraform_args[1:]
+    instances = count_instances(options.variables) if os.path.exists(options.variables) else 0
+    runner = TerraformRunner(options.action, terraform_args, instances, RunHistory(options.history),
+                             options.parallelism, options.min_parallelism, options.max_parallelism,
+                             options.max_retries, options.retry_delay, options.terraform)
+    sys.exit(runner.run())
+
+
+if __name__ == '__main__':
+    main()
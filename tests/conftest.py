@@ -0,0 +1,62 @@
+# Copyright 2018-2020 CRS4 (http://www.crs4.it/)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import importlib.util
+import io
+import os
+import sys
+
+import pytest
+
+ThisDir = os.path.dirname(os.path.abspath(__file__))
+DockerDir = os.path.join(ThisDir, '..', 'docker')
+sys.path.insert(0, DockerDir)
+sys.path.insert(0, os.path.join(DockerDir, 'config-cluster'))
+# tfstate_generator writes the terraform states of the tests
+sys.path.insert(0, os.path.join(ThisDir, '..', 'benchmarks'))
+sys.path.insert(0, ThisDir)
+
+
+@pytest.fixture(scope='session')
+def mc():
+    """
+    The manage-cluster.py module (its name isn't a valid module name).
+    """
+    spec = importlib.util.spec_from_file_location('manage_cluster', os.path.join(DockerDir, 'manage-cluster.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+@pytest.fixture
+def hosts_ini(tmp_path):
+    """
+    Returns a function that writes the hosts.ini create_inventory.py generates
+    for a synthetic cluster (the keyword arguments go to StateGenerator),
+    followed by the `extra` text, and returns its path.
+    """
+    import create_inventory
+    from tfstate_generator import StateGenerator
+
+    def write(extra='', **kwargs):
+        state = io.StringIO()
+        StateGenerator(**kwargs).write(state)
+        state_path = tmp_path / 'terraform.tfstate'
+        state_path.write_text(state.getvalue())
+        path = str(tmp_path / 'hosts.ini')
+        with open(path, 'w') as f:
+            create_inventory.Inventory.generate(create_inventory.TerraformState.load(str(state_path)), f)
+            f.write(extra)
+        return path
+    return write
@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+
+# Copyright 2018-2020 CRS4 (http://www.crs4.it/)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+A local fake Kubernetes API server, to exercise the readiness gate of
+manage-cluster.py without a cluster.
+
+It serves /healthz, /api/v1/nodes and the deployments and daemonsets of
+kube-system from an in-memory cluster.  The cluster starts converging:
+the API server is unhealthy, the nodes aren't ready and the deployments
+aren't available until --converge-after seconds have passed.  The tests
+change the state directly through FakeKubeApi.cluster.
+
+    ./fake_kube_api.py --port 6443 --nodes 3 --converge-after 30 &
+    manage-cluster.py ... upgrade-k8s --kubeconfig kubeconfig   # server: http://127.0.0.1:6443
+"""
+
+import argparse
+import http.server
+import json
+import socketserver
+import threading
+
+
+class Cluster(object):
+    """
+    In-memory state of the cluster.
+    """
+
+    def __init__(self, nodes=3, deployments=('coredns',), daemonsets=('kube-proxy',)):
+        self.lock = threading.Lock()
+        self.healthy = True
+        # node name -> ready
+        self.nodes = { 'node{}'.format(i + 1): True for i in range(nodes) }
+        # deployment name -> [wanted replicas, available replicas]
+        self.deployments = { name: [2, 2] for name in deployments }
+        # daemonset name -> [desired, available]
+        self.daemonsets = { name: [nodes, nodes] for name in daemonsets }
+
+
+    def set_ready(self, ready):
+        with self.lock:
+            self.healthy = ready
+            for name in self.nodes:
+                self.nodes[name] = ready
+            for counts in list(self.deployments.values()) + list(self.daemonsets.values()):
+                counts[1] = counts[0] if ready else 0
+
+
+    def node_list(self):
+        with self.lock:
+            return { 'kind': 'NodeList', 'items': [
+                { 'metadata': { 'name': name }, 'spec': {},
+                  'status': { 'conditions': [ { 'type': 'Ready', 'status': 'True' if ready else 'False' } ] } }
+                for name, ready in sorted(self.nodes.items()) ] }
+
+
+    def deployment_list(self):
+        with self.lock:
+            return { 'kind': 'DeploymentList', 'items': [
+                { 'metadata': { 'name': name, 'generation': 1 }, 'spec': { 'replicas': wanted },
+                  'status': { 'observedGeneration': 1, 'updatedReplicas': wanted, 'availableReplicas': available } }
+                for name, (wanted, available) in sorted(self.deployments.items()) ] }
+
+
+    def daemonset_list(self):
+        with self.lock:
+            return { 'kind': 'DaemonSetList', 'items': [
+                { 'metadata': { 'name': name, 'generation': 1 }, 'spec': {},
+                  'status': { 'observedGeneration': 1, 'desiredNumberScheduled': desired,
+                              'updatedNumberScheduled': desired, 'numberAvailable': available } }
+                for name, (desired, available) in sorted(self.daemonsets.items()) ] }
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super(Handler, self).log_message(format, *args)
+
+    def _send(self, status, data, content_type='application/json'):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests.append(self.path)
+        cluster = server.cluster
+        if self.path == '/healthz':
+            if cluster.healthy:
+                self._send(200, b'ok', 'text/plain')
+            else:
+                self._send(500, b'[-]etcd failed: reason withheld\nhealthz check failed', 'text/plain')
+        elif self.path == '/api/v1/nodes':
+            self._send(200, json.dumps(cluster.node_list()).encode())
+        elif self.path == '/apis/apps/v1/namespaces/kube-system/deployments':
+            self._send(200, json.dumps(cluster.deployment_list()).encode())
+        elif self.path == '/apis/apps/v1/namespaces/kube-system/daemonsets':
+            self._send(200, json.dumps(cluster.daemonset_list()).encode())
+        else:
+            self._send(404, json.dumps({ 'kind': 'Status', 'code': 404 }).encode())
+
+
+class FakeKubeApi(socketserver.ThreadingMixIn, http.server.HTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, address, cluster=None, verbose=False):
+        http.server.HTTPServer.__init__(self, address, Handler)
+        self.cluster = cluster or Cluster()
+        self.lock = threading.Lock()
+        self.requests = []
+        self.verbose = verbose
+
+
+    @property
+    def url(self):
+        return 'http://{}:{}'.format(*self.server_address[:2])
+
+
+    def start(self):
+        """
+        Serve from a background thread (for the tests).
+        """
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return self
+
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def _build_parser():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--address', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=6443)
+    parser.add_argument('--nodes', type=int, default=3)
+    parser.add_argument('--converge-after', type=float, default=0,
+                        help="Seconds after which the cluster becomes ready")
+    parser.add_argument('--verbose', action='store_true', help="Log every request")
+    return parser
+
+
+def main(args=None):
+    options = _build_parser().parse_args(args)
+    server = FakeKubeApi((options.address, options.port), Cluster(options.nodes), options.verbose)
+    if options.converge_after > 0:
+        server.cluster.set_ready(False)
+        timer = threading.Timer(options.converge_after, server.cluster.set_ready, (True,))
+        timer.daemon = True
+        timer.start()
+    print("Fake Kubernetes API listening on {}".format(server.url), flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
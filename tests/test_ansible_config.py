@@ -0,0 +1,101 @@
+# Copyright 2018-2020 CRS4 (http://www.crs4.it/)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+
+import pytest
+
+
+def ssh_hosts(config):
+    """
+    Returns { host pattern: [ options ] } of an ssh configuration.
+    """
+    hosts = {}
+    options = None
+    for line in config.splitlines():
+        if line.startswith('Host '):
+            options = hosts.setdefault(line[len('Host '):], [])
+        elif line.strip() and not line.startswith('#'):
+            options.append(line.strip())
+    return hosts
+
+
+@pytest.mark.parametrize('instances, max_forks, forks', [
+    (4, 50, 5),         # never less than ansible's default
+    (21, 50, 20),       # a fork per node, the bastion excluded
+    (80, 50, 50),
+    (80, 30, 30),
+])
+def test_forks_are_sized_on_the_nodes(mc, hosts_ini, instances, max_forks, forks):
+    inventory = mc.InventoryFile(hosts_ini(instances=instances))
+    config = mc.AnsibleConfig(inventory, max_forks=max_forks)
+    assert config.forks == forks
+    assert 'forks = {}\n'.format(forks) in config.ansible_cfg('/cluster')
+
+
+def test_private_nodes_are_proxied_by_the_bastion(mc, hosts_ini):
+    inventory = mc.InventoryFile(hosts_ini(instances=12, fip_ratio=0.3))
+    bastion = inventory.bastion['ansible_host']
+    private = [ inventory.address(h) for h in inventory.nodes if h.startswith('bench-k8s-node-no-floating-ip') ]
+    assert private and len(private) < len(inventory.nodes)
+
+    hosts = ssh_hosts(mc.AnsibleConfig(inventory).ssh_config('/cluster'))
+    # one multiplexed connection to the bastion that all the proxied ones share
+    assert hosts[bastion] == [ 'ControlMaster auto', 'ControlPath /tmp/manage-cluster-bastion-%C', 'ControlPersist 30m' ]
+    proxied = [ h for h in hosts if h not in (bastion, '*') ]
+    assert len(proxied) == 1
+    assert proxied[0].split() == private
+    assert hosts[proxied[0]] == [ 'ProxyCommand ssh -F /cluster/{} -W %h:%p ubuntu@{}'.format(
+        mc.SshConfigFilename, bastion) ]
+    assert 'StrictHostKeyChecking no' in hosts['*']
+
+
+def test_no_proxy_without_private_nodes(mc, hosts_ini):
+    inventory = mc.InventoryFile(hosts_ini(instances=6, bastion=False, fip_ratio=1))
+    assert inventory.bastion is None
+    assert list(ssh_hosts(mc.AnsibleConfig(inventory).ssh_config('/cluster'))) == [ '*' ]
+
+
+def test_ansible_cfg(mc, hosts_ini):
+    cfg = mc.AnsibleConfig(mc.InventoryFile(hosts_ini(instances=8)), fact_cache_ttl=600).ansible_cfg('/cluster')
+    lines = cfg.splitlines()
+    assert lines[0] == mc.AnsibleConfig.Marker
+    assert 'pipelining = True' in lines
+    assert 'gathering = smart' in lines
+    assert 'fact_caching_connection = /cluster/{}'.format(mc.FactCacheDirname) in lines
+    assert 'fact_caching_timeout = 600' in lines
+    assert 'ssh_args = -F /cluster/{} -o ControlMaster=auto -o ControlPersist=30m'.format(
+        mc.SshConfigFilename) in lines
+    assert 'control_path_dir = {}'.format(mc.SshControlPathDir) in lines
+
+
+def test_write_leaves_a_users_ansible_cfg_alone(mc, hosts_ini, tmp_path):
+    cluster_dir = str(tmp_path)
+    config = mc.AnsibleConfig(mc.InventoryFile(hosts_ini(instances=8)))
+    config.write(cluster_dir)
+    with open(os.path.join(cluster_dir, 'ansible.cfg')) as f:
+        assert f.read() == config.ansible_cfg(cluster_dir)
+    with open(os.path.join(cluster_dir, mc.SshConfigFilename)) as f:
+        assert f.read() == config.ssh_config(cluster_dir)
+
+    # regenerated while the marker is there
+    mc.AnsibleConfig(mc.InventoryFile(hosts_ini(instances=30)), max_forks=10).write(cluster_dir)
+    with open(os.path.join(cluster_dir, 'ansible.cfg')) as f:
+        assert 'forks = 10\n' in f.read()
+
+    (tmp_path / 'ansible.cfg').write_text('[defaults]\nforks = 3\n')
+    os.remove(os.path.join(cluster_dir, mc.SshConfigFilename))
+    config.write(cluster_dir)
+    assert (tmp_path / 'ansible.cfg').read_text() == '[defaults]\nforks = 3\n'
+    assert not os.path.exists(os.path.join(cluster_dir, mc.SshConfigFilename))
@@ -0,0 +1,172 @@
+# Copyright 2018-2020 CRS4 (http://www.crs4.it/)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+import threading
+import time
+
+import pytest
+import yaml
+
+import cloud_cfg_to_yaml
+from fake_openstack import FakeOpenStack, ProjectId
+
+
+Credentials = cloud_cfg_to_yaml.Credentials(
+    auth_url='https://keystone.example.com:5000/v3', username='admin', password='secret',
+    user_domain_name='default', user_domain_id=None, project_id='1234', project_name='tdm',
+    project_domain_name='default', project_domain_id=None, region_name='RegionOne', cacert=None)
+
+
+def test_merge_clouds_writes_block_yaml(tmp_path):
+    filename = str(tmp_path / 'clouds.yaml')
+    cloud_cfg_to_yaml.merge_clouds(filename, { 'mycluster': cloud_cfg_to_yaml.password_cloud(Credentials) })
+    with open(filename) as f:
+        text = f.read()
+    assert text.startswith('clouds:\n  mycluster:\n')
+    assert '{' not in text
+    assert yaml.safe_load(text)['clouds']['mycluster']['auth']['project_id'] == '1234'
+    assert os.stat(filename).st_mode & 0o777 == 0o600
+
+
+def test_merge_clouds_keeps_the_other_clouds(tmp_path):
+    filename = str(tmp_path / 'clouds.yaml')
+    with open(filename, 'w') as f:
+        f.write('clouds:\n  other:\n    auth:\n      auth_url: https://other:5000/v3\n')
+    token = cloud_cfg_to_yaml.Token('gAAAA', 2000000000, '1234')
+    cloud_cfg_to_yaml.merge_clouds(filename, {
+        'mycluster': cloud_cfg_to_yaml.password_cloud(Credentials),
+        'mycluster-token': cloud_cfg_to_yaml.token_cloud(Credentials, token) })
+    with open(filename) as f:
+        clouds = yaml.safe_load(f)['clouds']
+    assert sorted(clouds) == [ 'mycluster', 'mycluster-token', 'other' ]
+    assert clouds['other']['auth']['auth_url'] == 'https://other:5000/v3'
+    assert clouds['mycluster-token']['auth']['token'] == 'gAAAA'
+
+
+def test_merge_clouds_reads_the_json_of_previous_runs(tmp_path):
+    filename = str(tmp_path / 'clouds.yaml')
+    with open(filename, 'w') as f:
+        json.dump({ 'clouds': { 'mycluster': { 'region_name': 'old' } } }, f)
+    cloud_cfg_to_yaml.merge_clouds(filename, { 'mycluster': cloud_cfg_to_yaml.password_cloud(Credentials) })
+    with open(filename) as f:
+        assert yaml.safe_load(f)['clouds']['mycluster']['region_name'] == 'RegionOne'
+
+
+@pytest.fixture
+def keystone(monkeypatch):
+    server = FakeOpenStack(('127.0.0.1', 0))
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    for name in [ n for n in os.environ if n.startswith('OS_') ]:
+        monkeypatch.delenv(name)
+    monkeypatch.setenv('OS_AUTH_URL', 'http://127.0.0.1:{}/v3'.format(server.server_address[1]))
+    monkeypatch.setenv('OS_USERNAME', 'demo')
+    monkeypatch.setenv('OS_PASSWORD', 'demo')
+    monkeypatch.setenv('OS_PROJECT_NAME', 'demo')
+    monkeypatch.setenv('OS_REGION_NAME', 'RegionOne')
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def read_env_file(filename):
+    with open(filename) as f:
+        lines = f.read().splitlines()
+    return lines[0], dict(line.split('=', 1) for line in lines[1:])
+
+
+def test_token_is_issued_once_and_reused(keystone, tmp_path):
+    env_file, cache = str(tmp_path / 'os-token.env'), str(tmp_path / 'cache.json')
+    args = [ '--token', '--env-file', env_file, '--cache', cache, '-' ]
+    cloud_cfg_to_yaml.main(args)
+    first = read_env_file(env_file)
+    cloud_cfg_to_yaml.main(args)
+    assert keystone.stats['tokens'] == 1
+    assert read_env_file(env_file) == first
+
+    comment, env = first
+    assert comment.startswith('# expires-at ')
+    assert int(comment.split()[-1]) > time.time() + 3500
+    assert env['OS_AUTH_TYPE'] == 'v3token'
+    assert env['OS_PROJECT_ID'] == ProjectId
+    assert 'OS_PASSWORD' not in env
+    for filename in (env_file, cache):
+        assert os.stat(filename).st_mode & 0o777 == 0o600
+
+
+def test_token_close_to_expiry_is_replaced(keystone, tmp_path):
+    env_file, cache = str(tmp_path / 'os-token.env'), str(tmp_path / 'cache.json')
+    args = [ '--token', '--env-file', env_file, '--cache', cache ]
+    cloud_cfg_to_yaml.main(args + [ '-' ])
+    token = read_env_file(env_file)[1]['OS_TOKEN']
+    # the token lasts an hour:  within the margin
+    cloud_cfg_to_yaml.main(args + [ '--refresh-margin', '4000', '-' ])
+    assert keystone.stats['tokens'] == 2
+    assert read_env_file(env_file)[1]['OS_TOKEN'] != token
+    with open(cache) as f:
+        assert len(json.load(f)) == 1
+
+
+def test_token_cloud_is_merged_with_the_password_one(keystone, tmp_path):
+    clouds_yaml = str(tmp_path / 'clouds.yaml')
+    cloud_cfg_to_yaml.main([ '--token', '-', 'mycluster', clouds_yaml ])
+    assert keystone.stats['tokens'] == 1
+    # next to clouds.yaml by default
+    assert os.path.exists(str(tmp_path / cloud_cfg_to_yaml.DefaultCacheFilename))
+    with open(clouds_yaml) as f:
+        clouds = yaml.safe_load(f)['clouds']
+    assert clouds['mycluster']['auth']['password'] == 'demo'
+    assert clouds['mycluster-token']['auth_type'] == 'v3token'
+    assert clouds['mycluster-token']['auth']['project_id'] == ProjectId
+    assert 'password' not in clouds['mycluster-token']['auth']
+
+
+def test_expired_tokens_of_other_clouds_are_dropped(tmp_path):
+    path = str(tmp_path / 'cache.json')
+    now = time.time()
+    with open(path, 'w') as f:
+        json.dump({ 'expired': { 'id': 'a', 'expires_at': now - 10, 'project_id': 'p' },
+                    'valid': { 'id': 'b', 'expires_at': now + 3600, 'project_id': 'p' } }, f)
+    token = cloud_cfg_to_yaml.TokenCache(path).get(
+        Credentials, lambda: cloud_cfg_to_yaml.Token('c', now + 3600, '1234'))
+    assert token.id == 'c'
+    with open(path) as f:
+        assert sorted(json.load(f)) == sorted([ 'valid', cloud_cfg_to_yaml.TokenCache.key(Credentials) ])
+
+
+def test_token_refreshed_by_another_run_while_waiting_is_used(tmp_path):
+    path = str(tmp_path / 'cache.json')
+    key = cloud_cfg_to_yaml.TokenCache.key(Credentials)
+    fresh = { key: { 'id': 'theirs', 'expires_at': time.time() + 3600, 'project_id': '1234' } }
+
+    class RacingCache(cloud_cfg_to_yaml.TokenCache):
+        reads = 0
+
+        def _read(self):
+            self.reads += 1
+            if self.reads == 1:
+                # another run gets the lock first and writes its token
+                self._write(fresh)
+                return {}
+            return super(RacingCache, self)._read()
+
+    def issue():
+        raise AssertionError("issued a token the cache already has")
+
+    cache = RacingCache(path)
+    assert cache.get(Credentials, issue).id == 'theirs'
+    assert cache.reads == 2
@@ -0,0 +1,475 @@
+# Copyright 2018-2020 CRS4 (http://www.crs4.it/)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections
+import io
+import json
+import subprocess
+import sys
+
+import pytest
+
+import create_inventory
+from tfstate_generator import StateGenerator
+
+
+def write_state(tmp_path, state_version, **kwargs):
+    out = io.StringIO()
+    StateGenerator(state_version=state_version, **kwargs).write(out)
+    path = tmp_path / 'terraform.tfstate'
+    path.write_text(out.getvalue())
+    return str(path)
+
+
+@pytest.mark.parametrize('state_version', [ 3, 4 ])
+def test_master_ips_in_terraform_output_order(tmp_path, state_version):
+    path = write_state(tmp_path, state_version, instances=20, masters=3)
+    with open(path) as f:
+        state = json.load(f)
+    outputs = state['modules'][0]['outputs'] if state_version == 3 else state['outputs']
+    # e.g., the masters on the external network come first
+    outputs['k8s_master_fips']['value'].reverse()
+    with open(path, 'w') as f:
+        json.dump(state, f)
+
+    answers = create_inventory.StateQuery(path).answers()
+    assert answers['master-ips'] == [ '172.16.0.3', '172.16.0.2', '172.16.0.1' ]
+    assert answers['masters'] == [ 'bench-k8s-master-1', 'bench-k8s-master-2', 'bench-k8s-master-3' ]
+
+
+def stream(text, chunk_size=None):
+    s = create_inventory._JsonStream(io.StringIO(text))
+    if chunk_size:
+        s.CHUNK_SIZE = chunk_size
+    return s
+
+
+def test_json_stream_walks_objects_and_arrays():
+    s = stream('{"a": [1, {"b": null}, []], "c": {}, "d": "x", "e": 12345}', chunk_size=3)
+    members = s.members()
+    assert next(members) == 'a'
+    values = []
+    for _ in s.elements():
+        values.append(s.value())
+    assert values == [ 1, { 'b': None }, [] ]
+    assert next(members) == 'c'
+    assert list(s.members()) == []
+    assert next(members) == 'd'
+    s.skip()
+    assert next(members) == 'e'
+    # a number split across chunks
+    assert s.value() == 12345
+    assert list(members) == []
+
+
+def test_json_stream_skips_without_decoding(monkeypatch):
+    text = '{"a": {"s": "x}]\\"{[", "t": [[1, 2], {"u": "]"}, []], "v": {}}, "b": [], "c": "end"}'
+    decoded = []
+    value = create_inventory._JsonStream.value
+    monkeypatch.setattr(create_inventory._JsonStream, 'value', lambda self: decoded.append(value(self)) or decoded[-1])
+    for chunk_size in (1, 2, 3, 5, 1 << 16):
+        del decoded[:]
+        s = stream(text, chunk_size)
+        members = s.members()
+        assert next(members) == 'a'
+        s.skip()
+        assert next(members) == 'b'
+        s.skip()
+        assert next(members) == 'c'
+        assert s.value() == 'end'
+        # only the keys were decoded
+        assert decoded == [ 'a', 'b', 'c', 'end' ]
+
+
+def test_json_stream_peeks_first_member():
+    s = stream('{"type": "openstack_compute_instance_v2", "primary": {}} {"depends_on": [], "type": "x"}')
+    assert s.peek_first_member() == ('type', 'openstack_compute_instance_v2')
+    assert s.value()['primary'] == {}
+    assert s.peek_first_member() is None
+
+
+def test_json_stream_rejects_truncated_data():
+    s = stream('{"a": [1, 2')
+    members = s.members()
+    next(members)
+    with pytest.raises(ValueError):
+        for _ in s.elements():
+            s.value()
+
+
+def resources_from_json(path):
+    with open(path) as f:
+        return sorted(create_inventory.TerraformState.iter_json_resources(json.load(f)))
+
+
+def resources_from_stream(path, chunk_size):
+    metadata = {}
+    outputs = {}
+    with open(path) as f:
+        s = create_inventory._JsonStream(f)
+        s.CHUNK_SIZE = chunk_size
+        resources = sorted(create_inventory.TerraformState.iter_stream_resources(s, metadata, outputs))
+    return resources, metadata, outputs
+
+
+@pytest.mark.parametrize('state_version', [ 3, 4 ])
+@pytest.mark.parametrize('chunk_size', [ 16, 1 << 16 ])
+def test_stream_reads_the_same_resources_as_json(tmp_path, state_version, chunk_size):
+    path = write_state(tmp_path, state_version, instances=30, masters=3, etcd=2, fip_ratio=0.3)
+    resources, metadata, outputs = resources_from_stream(path, chunk_size)
+    assert resources == resources_from_json(path)
+    types = collections.Counter(r['type'] for _, r in resources)
+    assert types['openstack_compute_instance_v2'] == 30
+    assert set(types) <= set(create_inventory.TerraformState.RESOURCE_TYPES)
+    assert metadata['version'] == state_version
+    assert metadata['serial'] == 1 and metadata['lineage'] == 'synthetic'
+    assert len(outputs['k8s_master_fips']) == 3
+    assert create_inventory.TerraformState.read_metadata(path) == metadata
+
+
+@pytest.mark.parametrize('state_version', [ 3, 4 ])
+def test_stream_doesnt_decode_other_resources(tmp_path, monkeypatch, state_version):
+    path = write_state(tmp_path, state_version, instances=10, filler=3)
+    # a security group rule larger than the read buffer
+    description = 'x' * 2 * create_inventory._JsonStream.CHUNK_SIZE
+    with open(path) as f:
+        state = json.load(f)
+    if state_version == 3:
+        rule = next(r for k, r in state['modules'][1]['resources'].items() if '_rule_v2.' in k)
+        rule['primary']['attributes']['description'] = description
+    else:
+        rule = next(r for r in state['resources'] if r['type'] == 'openstack_networking_secgroup_rule_v2')
+        rule['instances'][0]['attributes']['description'] = description
+    with open(path, 'w') as f:
+        json.dump(state, f)
+    decoded = []
+
+    def spy(method):
+        def decode(self):
+            v = method(self)
+            decoded.append(v)
+            return v
+        return decode
+
+    monkeypatch.setattr(create_inventory._JsonStream, 'value', spy(create_inventory._JsonStream.value))
+    monkeypatch.setattr(create_inventory._JsonStream, 'buffered_value',
+                        spy(create_inventory._JsonStream.buffered_value))
+    state = create_inventory.TerraformState.load(path)
+    assert len(state.instances) == 10
+
+    def contains_rule(v):
+        if isinstance(v, dict):
+            return any(map(contains_rule, v.values()))
+        if isinstance(v, list):
+            return any(map(contains_rule, v))
+        return v == description
+
+    # the small resources are decoded from the buffer, the large rule is only scanned
+    assert decoded
+    assert not any(contains_rule(v) for v in decoded)
+
+
+def test_json_stream_decodes_buffered_values():
+    s = stream('[{"a": "}"}, 123, "x", 45]', chunk_size=14)
+    elements = s.elements()
+    next(elements)
+    assert s.buffered_value() == { 'a': '}' }
+    next(elements)
+    # the number could continue in the next chunk
+    assert s.buffered_value() is s.NOT_BUFFERED
+    assert s.value() == 123
+    next(elements)
+    assert s.buffered_value() == 'x'
+    next(elements)
+    assert s.buffered_value() == 45
+    assert list(elements) == []
+
+
+def test_v3_resource_with_type_after_its_attributes(tmp_path):
+    instance = { 'primary': { 'id': 'i-1', 'attributes': {
+        'id': 'i-1', 'name': 'c-k8s-master-1', 'access_ip_v4': '10.0.0.1', 'network.#': '1',
+        'network.0.fixed_ip_v4': '10.0.0.1', 'network.0.floating_ip': '',
+        'metadata.ssh_user': 'ubuntu', 'metadata.kubespray_groups': 'etcd,kube-master,k8s-cluster' } },
+        'depends_on': [], 'type': 'openstack_compute_instance_v2' }
+    rule = { 'primary': { 'id': 'r-1', 'attributes': { 'direction': 'ingress' } },
+             'type': 'openstack_networking_secgroup_rule_v2' }
+    path = tmp_path / 'terraform.tfstate'
+    path.write_text(json.dumps({ 'version': 3, 'serial': 1, 'lineage': 'l', 'modules': [ {
+        'resources': {
+            'openstack_networking_secgroup_rule_v2.r': rule,
+            'openstack_compute_instance_v2.k8s_master.0': instance,
+            'data.openstack_compute_instance_v2.x': instance },
+        'path': [ 'root', 'compute' ] } ] }))
+    resources, _, _ = resources_from_stream(str(path), 8)
+    assert resources == [ ('module.compute.openstack_compute_instance_v2.k8s_master[0]', instance) ]
+
+
+def generated_state(tmp_path, name, **kwargs):
+    out = io.StringIO()
+    StateGenerator(**dict(dict(masters=1, fip_ratio=0.3), **kwargs)).write(out)
+    path = tmp_path / name
+    path.write_text(out.getvalue())
+    return str(path)
+
+
+def generated_inventory(state):
+    out = io.StringIO()
+    create_inventory.Inventory.generate(state, out)
+    return out.getvalue()
+
+
+def updated_inventory(tmp_path, old_state, new_state):
+    path = tmp_path / 'hosts.ini'
+    path.write_text(generated_inventory(old_state))
+    added, removed = create_inventory.TerraformState.diff(old_state, new_state)
+    create_inventory.Inventory.update(str(path), new_state, added, removed)
+    return path.read_text()
+
+
+def assert_same_inventory(updated, generated):
+    # the only difference:  configparser writes the variables back without spaces
+    assert 'ansible_python_interpreter=/usr/bin/python3' in updated
+    assert updated == generated.replace('ansible_python_interpreter = ', 'ansible_python_interpreter=')
+
+
+@pytest.mark.parametrize('before, after', [ (8, 11), (11, 8) ])
+def test_update_matches_generate(tmp_path, before, after):
+    old = create_inventory.TerraformState.load(generated_state(tmp_path, 'old.tfstate', instances=before))
+    new = create_inventory.TerraformState.load(generated_state(tmp_path, 'new.tfstate', instances=after))
+    updated = updated_inventory(tmp_path, old, new)
+    assert_same_inventory(updated, generated_inventory(new))
+    assert len(create_inventory.TerraformState.diff(old, new)[0 if after > before else 1]) == 3
+
+
+def test_update_replaces_a_removed_bastion(tmp_path, monkeypatch):
+    old_path = generated_state(tmp_path, 'old.tfstate', instances=8)
+    with open(old_path) as f:
+        state = json.load(f)
+    resources = state['modules'][1]['resources']
+    for key in [ k for k in resources if '.bastion.' in k ]:
+        del resources[key]
+    new_path = str(tmp_path / 'new.tfstate')
+    with open(new_path, 'w') as f:
+        json.dump(state, f)
+    old = create_inventory.TerraformState.load(old_path)
+    new = create_inventory.TerraformState.load(new_path)
+    assert new.get_bastion_instance() is None and new.has_private_instances()
+
+    # the replacement is chosen at random among the instances with a floating IP
+    monkeypatch.setattr(create_inventory.random, 'choice', lambda seq: seq[0])
+    updated = updated_inventory(tmp_path, old, new)
+    assert 'bastion ansible_host={} '.format(old.get_bastion_instance().floating_ip) not in updated
+    assert_same_inventory(updated, generated_inventory(new))
+
+
+PlanV011 = """
+An execution plan has been generated and is shown below.
+
+  - module.compute.openstack_compute_instance_v2.k8s_node_no_floating_ip[3]
+
+  - module.compute.openstack_compute_floatingip_associate_v2.k8s_node[0]
+
+-/+ module.compute.openstack_compute_instance_v2.k8s_master[0] (new resource required)
+      id:                  "00000001-0000-4000-8000-000000000001" => <computed> (forces new resource)
+
+  ~ module.compute.openstack_compute_instance_v2.k8s_node_no_floating_ip[1]
+      name:                "a" => "b"
+
+Plan: 1 to add, 1 to change, 3 to destroy.
+"""
+
+PlanV012 = """
+  # module.compute.openstack_compute_floatingip_associate_v2.k8s_node[0] will be destroyed
+  - resource "openstack_compute_floatingip_associate_v2" "k8s_node" {
+    }
+
+  # module.compute.openstack_compute_instance_v2.k8s_master[0] must be replaced
+-/+ resource "openstack_compute_instance_v2" "k8s_master" {
+    }
+
+  # module.compute.openstack_compute_instance_v2.k8s_node_no_floating_ip[1] will be updated in-place
+  ~ resource "openstack_compute_instance_v2" "k8s_node_no_floating_ip" {
+    }
+
+  # module.compute.openstack_compute_instance_v2.k8s_node_no_floating_ip[3] will be destroyed
+  - resource "openstack_compute_instance_v2" "k8s_node_no_floating_ip" {
+    }
+
+Plan: 1 to add, 1 to change, 3 to destroy.
+"""
+
+
+@pytest.mark.parametrize('plan', [ PlanV011, PlanV012 ], ids=[ '0.11', '0.12' ])
+def test_planned_removals(tmp_path, plan):
+    state = create_inventory.TerraformState.load(generated_state(tmp_path, 'terraform.tfstate', instances=8))
+    removed = state.planned_removals(plan)
+    assert sorted(i.name for i in removed) == [ 'bench-k8s-master-1', 'bench-k8s-node-no-floating-ip-4' ]
+
+
+def test_planned_removals_of_unindexed_resources(tmp_path):
+    # terraform 0.11 doesn't index the resources with count = 1 in its state
+    path = generated_state(tmp_path, 'terraform.tfstate', instances=8)
+    with open(path) as f:
+        state = json.load(f)
+    resources = state['modules'][1]['resources']
+    resources['openstack_compute_instance_v2.bastion'] = resources.pop('openstack_compute_instance_v2.bastion.0')
+    with open(path, 'w') as f:
+        json.dump(state, f)
+    state = create_inventory.TerraformState.load(path)
+    plan = "  # module.compute.openstack_compute_instance_v2.bastion[0] will be destroyed\n"
+    assert [ i.name for i in state.planned_removals(plan) ] == [ 'bench-bastion-1' ]
+    assert state.planned_removals("  - module.compute.openstack_compute_instance_v2.bastion\n") == \
+           state.planned_removals(plan)
+
+
+def parse_ini_inventory(text):
+    """
+    Returns the groups and the host variables of an ini inventory, like ansible reads them.
+    """
+    groups = collections.OrderedDict()
+    hostvars = collections.OrderedDict()
+    section = None
+    for line in text.splitlines():
+        if not line.strip():
+            continue
+        if line.startswith('['):
+            section = line.strip('[]')
+            continue
+        if section == 'all:vars':
+            key, value = line.split('=', 1)
+            groups[section] = { key.strip(): value.strip() }
+            continue
+        name, *host_vars = line.split()
+        groups.setdefault(section, []).append(name)
+        if host_vars:
+            hostvars[name] = dict(v.split('=', 1) for v in host_vars)
+    return groups, hostvars
+
+
+@pytest.mark.parametrize('state_version', [ 3, 4 ])
+@pytest.mark.parametrize('bastion', [ True, False ])
+def test_dynamic_inventory_matches_generate(tmp_path, monkeypatch, state_version, bastion):
+    # without a bastion one of the instances with a floating IP is chosen at random
+    monkeypatch.setattr(create_inventory.random, 'choice', lambda seq: seq[0])
+    path = generated_state(tmp_path, 'terraform.tfstate', instances=12, bastion=bastion, state_version=state_version)
+    groups, hostvars = parse_ini_inventory(generated_inventory(create_inventory.TerraformState.load(path)))
+    inventory = create_inventory.DynamicInventory(path).list()
+
+    assert inventory['all']['vars'] == groups.pop('all:vars')
+    assert list(inventory) == list(groups) + [ '_meta' ]
+    for group, hosts in groups.items():
+        assert inventory[group]['hosts'] == hosts
+    assert inventory['_meta']['hostvars'] == hostvars
+    assert inventory['bastion']['hosts'] == [ 'bastion' ]
+
+
+def test_state_cache_is_reused_until_the_serial_changes(tmp_path, monkeypatch):
+    path = generated_state(tmp_path, 'terraform.tfstate', instances=8)
+    inventory = create_inventory.DynamicInventory(path).list()
+    assert (tmp_path / create_inventory.DynamicInventory.CACHE_FILENAME).exists()
+
+    def load(filename):
+        raise AssertionError("the state shouldn't be parsed")
+    original_load = create_inventory.TerraformState.load
+    monkeypatch.setattr(create_inventory.TerraformState, 'load', staticmethod(load))
+    assert create_inventory.DynamicInventory(path).list() == inventory
+
+    # terraform bumps the serial when it changes the state
+    monkeypatch.setattr(create_inventory.TerraformState, 'load', staticmethod(original_load))
+    text = (tmp_path / 'terraform.tfstate').read_text()
+    generated_state(tmp_path, 'terraform.tfstate', instances=11)
+    # (with the same serial the cached inventory is still the answer)
+    assert create_inventory.DynamicInventory(path).list() == inventory
+    (tmp_path / 'terraform.tfstate').write_text(
+        (tmp_path / 'terraform.tfstate').read_text().replace('"serial": 1,', '"serial": 2,'))
+    refreshed = create_inventory.DynamicInventory(path).list()
+    assert len(refreshed['kube-node']['hosts']) == len(inventory['kube-node']['hosts']) + 3
+
+    # and a new state (e.g., after destroying the cluster) has another lineage
+    (tmp_path / 'terraform.tfstate').write_text(text.replace('"lineage": "synthetic"', '"lineage": "another"'))
+    assert create_inventory.DynamicInventory(path).list() == inventory
+
+
+def test_state_cache_isnt_needed(tmp_path):
+    path = generated_state(tmp_path, 'terraform.tfstate', instances=8)
+    cache = tmp_path / 'cache' / 'inventory.json'
+    # the cache directory doesn't exist, so the cache can't be written
+    inventory = create_inventory.DynamicInventory(path, str(cache)).list()
+    assert inventory == create_inventory.Inventory.as_dict(create_inventory.TerraformState.load(path))
+    assert not cache.parent.exists()
+    # nor is a corrupt cache a problem
+    (tmp_path / 'cache').mkdir()
+    cache.write_text('{"key": ')
+    assert create_inventory.DynamicInventory(path, str(cache)).list() == inventory
+    assert json.loads(cache.read_text())['data'] == inventory
+
+
+def run_main(monkeypatch, capsys, *args):
+    monkeypatch.setattr(sys, 'argv', [ 'create_inventory.py' ] + list(args))
+    with pytest.raises(SystemExit) as e:
+        create_inventory.main()
+    assert not e.value.code
+    return capsys.readouterr().out
+
+
+def test_dynamic_inventory_list_and_host(tmp_path, monkeypatch, capsys):
+    path = generated_state(tmp_path, 'terraform.tfstate', instances=8)
+    inventory = create_inventory.DynamicInventory(path).list()
+    assert json.loads(run_main(monkeypatch, capsys, '-s', path, '--list')) == inventory
+    assert json.loads(run_main(monkeypatch, capsys, '-s', path, '--host', 'bench-k8s-master-1')) == \
+           inventory['_meta']['hostvars']['bench-k8s-master-1']
+    assert json.loads(run_main(monkeypatch, capsys, '-s', path, '--host', 'bastion'))['ansible_user'] == 'ubuntu'
+    assert json.loads(run_main(monkeypatch, capsys, '-s', path, '--host', 'unknown')) == {}
+
+
+ClusterVariables = """
+cluster_name = "tdm's cluster"
+# ssh_user = "centos"
+ssh_user = "ubuntu"
+public_key_path = "~/.ssh/id_rsa $(touch pwned).pub"
+"""
+
+
+def test_state_query_shell_format_is_sourced_by_bash(tmp_path, monkeypatch, capsys):
+    path = generated_state(tmp_path, 'terraform.tfstate', instances=8, masters=3)
+    variables = tmp_path / 'cluster.tf'
+    variables.write_text(ClusterVariables)
+    answers = create_inventory.StateQuery(path, str(variables)).answers()
+    assert answers['cluster-name'] == "tdm's cluster"
+    assert answers['key-name'] == 'id_rsa $(touch pwned)'
+
+    # what manage-cluster does in _load_state_info
+    info = tmp_path / 'state-info'
+    info.write_text(run_main(monkeypatch, capsys, '-s', path, 'state', '--variables', str(variables), '--shell'))
+    names = [ 'STATE_{}'.format(q.replace('-', '_').upper()) for q in create_inventory.StateQuery.QUERIES ]
+    script = 'source "$1" && printf "%s\\0" {}'.format(' '.join('"${}"'.format(n) for n in names))
+    out = subprocess.check_output([ 'bash', '-c', script, 'bash', str(info) ], cwd=str(tmp_path))
+    values = out.decode().split('\0')[:-1]
+    expected = [ ' '.join(v) if isinstance(v, list) else v or ''
+                 for v in (answers[q] for q in create_inventory.StateQuery.QUERIES) ]
+    assert values == expected
+    assert values[names.index('STATE_MASTER_IPS')] == '172.16.0.1 172.16.0.2 172.16.0.3'
+    assert values[names.index('STATE_BASTION')]
+    assert not (tmp_path / 'pwned').exists()
+
+
+def test_state_query_before_deploying(tmp_path, monkeypatch, capsys):
+    variables = tmp_path / 'cluster.tf'
+    variables.write_text(ClusterVariables)
+    answers = create_inventory.StateQuery(str(tmp_path / 'terraform.tfstate'), str(variables)).answers()
+    assert answers['masters'] == [] and answers['bastion'] is None
+    assert answers['ssh-user'] == 'ubuntu'
+    out = run_main(monkeypatch, capsys, '-s', str(tmp_path / 'terraform.tfstate'), 'state', 'cluster-name',
+                   '--variables', str(variables))
+    assert out == "tdm's cluster\n"
@@ -0,0 +1,216 @@
+# Copyright 2018-2020 CRS4 (http://www.crs4.it/)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import subprocess
+
+import pytest
+
+Plan = [ '2.11.2', '2.12.5', '2.14.0' ]
+
+
+def callback_events(op, version, playbook, tasks):
+    """
+    The events that the manage_cluster_journal callback records for a run
+    of the playbook; tasks is a list of (task, { host: status }).
+    """
+    context = dict(op=op, version=version, playbook=playbook)
+    events = [ dict(event='play', play='Upgrade', batch=None, **context) ]
+    for task, results in tasks:
+        for host, status in sorted(results.items()):
+            events.append(dict(event='task', play='Upgrade', task=task, host=host, status=status, duration=1.0,
+                               **context))
+        events.append(dict(event='task-end', play='Upgrade', task=task, duration=1.0,
+                           hosts={ s: sum(1 for v in results.values() if v == s) for s in set(results.values()) },
+                           **context))
+    events.append(dict(event='play-end', play='Upgrade', batch=None, hosts=[], duration=1.0, **context))
+    return events
+
+
+def interrupted_upgrade(op='op-1'):
+    """
+    A journal of an upgrade that completed its first hop and failed twice on the second:
+    first on 'download', then (after a resume) on 'kubeadm upgrade'.
+    """
+    events = [ dict(op=op, event='begin', action='upgrade', target=Plan[-1], plan=Plan) ]
+    events.append(dict(op=op, event='hop-start', version=Plan[0], playbook='upgrade-cluster.yml', start_at_task=None))
+    events += callback_events(op, Plan[0], 'upgrade-cluster.yml', [ ('download', { 'node-1': 'ok', 'node-2': 'ok' }) ])
+    events.append(dict(op=op, event='hop-end', version=Plan[0]))
+    events.append(dict(op=op, event='hop-ready', version=Plan[0]))
+    events.append(dict(op=op, event='hop-start', version=Plan[1], playbook='upgrade-cluster.yml', start_at_task=None))
+    events += callback_events(op, Plan[1], 'upgrade-cluster.yml', [
+        ('download', { 'node-1': 'ok', 'node-2': 'failed' }) ])
+    events.append(dict(op=op, event='hop-failed', version=Plan[1], returncode=2))
+    events.append(dict(op=op, event='resume'))
+    events.append(dict(op=op, event='hop-start', version=Plan[1], playbook='upgrade-cluster.yml',
+                       start_at_task='download'))
+    events += callback_events(op, Plan[1], 'upgrade-cluster.yml', [
+        ('download', { 'node-1': 'ok', 'node-2': 'ok' }),
+        ('check versions', { 'node-1': 'ignored', 'node-2': 'ok' }),
+        ('kubeadm upgrade', { 'node-1': 'unreachable', 'node-2': 'failed', 'node-3': 'ok' }),
+        ('restart kubelet', { 'node-3': 'failed' }) ])
+    events.append(dict(op=op, event='hop-failed', version=Plan[1], returncode=4))
+    for t, e in enumerate(events):
+        e['time'] = 1000.0 + t
+    return events
+
+
+def write_journal(path, events):
+    with open(str(path), 'w') as f:
+        for e in events:
+            f.write(json.dumps(e, sort_keys=True) + '\n')
+
+
+def test_operation_replay(mc):
+    op = mc.Operation(interrupted_upgrade())
+    assert (op.id, op.action, op.target, op.plan) == ('op-1', 'upgrade', Plan[-1], Plan)
+    assert not op.finished
+    assert op.completed_hops == Plan[:1]
+    assert op.is_ready(Plan[0])
+    assert not op.is_ready(Plan[1])
+
+
+def test_failure_is_the_first_failed_task_of_the_last_attempt(mc):
+    op = mc.Operation(interrupted_upgrade())
+    # ignored errors don't count and unreachable hosts do
+    assert op.failure(Plan[1]) == ('kubeadm upgrade', [ 'node-1', 'node-2' ])
+    assert op.failure(Plan[0]) == (None, [])
+    assert op.failure(Plan[2]) == (None, [])
+
+
+def test_resumable_operation(mc, tmp_path):
+    journal = mc.OperationJournal(str(tmp_path / 'journal'))
+    with pytest.raises(RuntimeError):
+        journal.resumable_operation('upgrade', Plan[-1])
+    write_journal(journal.path, interrupted_upgrade())
+    assert journal.resumable_operation('upgrade', Plan[-1]).id == 'op-1'
+    with pytest.raises(RuntimeError):
+        journal.resumable_operation('upgrade', Plan[1])
+    with pytest.raises(RuntimeError):
+        journal.resumable_operation('deploy', Plan[-1])
+    journal.record('op-1', 'end')
+    with pytest.raises(RuntimeError):
+        journal.resumable_operation('upgrade', Plan[-1])
+
+
+def test_begin_abandons_the_unfinished_operation(mc, tmp_path):
+    journal = mc.OperationJournal(str(tmp_path / 'journal'))
+    write_journal(journal.path, interrupted_upgrade())
+    op_id = journal.begin('deploy', '2.14.0', [ '2.14.0' ])
+    assert op_id != 'op-1'
+    assert [ (e['op'], e['event']) for e in journal.events()[-2:] ] == [ ('op-1', 'abandoned'), (op_id, 'begin') ]
+    assert journal.last_operation().id == op_id
+    with pytest.raises(RuntimeError):
+        journal.resumable_operation('upgrade', Plan[-1])
+    # a finished operation isn't abandoned
+    journal.record(op_id, 'end')
+    journal.begin('deploy', '2.14.0', [ '2.14.0' ])
+    assert sum(1 for e in journal.events() if e['event'] == 'abandoned') == 1
+
+
+class FakeKubesprayRepo(object):
+
+    def __init__(self, path):
+        self.path = str(path)
+        self.ansible_playbook = 'ansible-playbook'
+        self.checkouts = []
+
+
+    def checkout(self, ks_version):
+        self.checkouts.append(ks_version)
+
+
+    def update_requirements(self, force=False):
+        pass
+
+
+class FakeAnsible(object):
+    """
+    Stands in for ansible-playbook:  records the journal events of the
+    callback and fails at the given task of the given versions.
+    """
+
+    def __init__(self, failures=None):
+        self.failures = dict(failures or {})
+        self.runs = []
+
+
+    def __call__(self, cmd, env=None):
+        context = json.loads(env['MANAGE_CLUSTER_JOURNAL_CONTEXT'])
+        start_at_task = cmd[cmd.index('--start-at-task') + 1] if '--start-at-task' in cmd else None
+        self.runs.append((context['version'], start_at_task))
+        failed_task = self.failures.pop(context['version'], None)
+        tasks = [ (t, { 'node-1': 'failed' if t == failed_task else 'ok' })
+                  for t in ('download', 'kubeadm upgrade', 'restart kubelet') ]
+        if failed_task:
+            tasks = tasks[:[ t for t, _ in tasks ].index(failed_task) + 1]
+        with open(env['MANAGE_CLUSTER_JOURNAL'], 'a') as f:
+            for e in callback_events(context['op'], context['version'], context['playbook'], tasks):
+                e['time'] = 1000.0
+                f.write(json.dumps(e, sort_keys=True) + '\n')
+        if failed_task:
+            raise subprocess.CalledProcessError(2, cmd)
+
+
+@pytest.fixture
+def deployment(mc, tmp_path, hosts_ini):
+    hosts_ini(instances=6, masters=1)
+    with open(str(tmp_path / mc.KsVersionStampFilename), 'w') as f:
+        f.write('2.10.4 deploy\n')
+    return mc.Deployment(str(tmp_path), str(tmp_path / 'hosts.ini'), ansible_config=False)
+
+
+def test_upgrade_resumes_at_the_failed_task(mc, monkeypatch, tmp_path, deployment):
+    write_journal(deployment.journal.path, interrupted_upgrade())
+    ansible = FakeAnsible()
+    monkeypatch.setattr(mc.subprocess, 'check_call', ansible)
+    ks_repo = FakeKubesprayRepo(tmp_path)
+    deployment.upgrade(Plan[-1], ks_repo, resume=True)
+    # the completed hop is skipped and only the failed one starts at its failed task
+    assert ks_repo.checkouts == Plan[1:]
+    assert ansible.runs == [ (Plan[1], 'kubeadm upgrade'), (Plan[2], None) ]
+    op = deployment.journal.last_operation()
+    assert op.id == 'op-1'
+    assert op.finished
+    assert op.completed_hops == Plan
+
+
+def test_interrupted_upgrade_is_resumed(mc, monkeypatch, tmp_path, deployment):
+    ansible = FakeAnsible({ '2.12.5': 'kubeadm upgrade' })
+    monkeypatch.setattr(mc.subprocess, 'check_call', ansible)
+    ks_repo = FakeKubesprayRepo(tmp_path)
+    with pytest.raises(subprocess.CalledProcessError):
+        deployment.upgrade('2.14.0', ks_repo)
+    plan = deployment.journal.last_operation().plan
+    failed = plan.index('2.12.5')
+    assert ks_repo.checkouts == plan[:failed + 1]
+
+    ks_repo = FakeKubesprayRepo(tmp_path)
+    ansible.runs = []
+    mc.Deployment(deployment.path, deployment.inventory, ansible_config=False).upgrade('2.14.0', ks_repo, resume=True)
+    assert ks_repo.checkouts == plan[failed:]
+    assert ansible.runs == [ ('2.12.5', 'kubeadm upgrade') ] + [ (v, None) for v in plan[failed + 1:] ]
+    assert deployment.journal.last_operation().finished
+
+
+def test_deploy_resumes_at_the_failed_task(mc, monkeypatch, tmp_path, deployment):
+    ansible = FakeAnsible({ '2.14.0': 'restart kubelet' })
+    monkeypatch.setattr(mc.subprocess, 'check_call', ansible)
+    with pytest.raises(subprocess.CalledProcessError):
+        deployment.deploy(FakeKubesprayRepo(tmp_path), '2.14.0')
+    with pytest.raises(RuntimeError):
+        deployment.upgrade('2.14.0', FakeKubesprayRepo(tmp_path), resume=True)
+    deployment.deploy(FakeKubesprayRepo(tmp_path), '2.14.0', resume=True)
+    assert ansible.runs == [ ('2.14.0', None), ('2.14.0', 'restart kubelet') ]
+    assert deployment.journal.last_operation().finished
@@ -0,0 +1,159 @@
+# Copyright 2018-2020 CRS4 (http://www.crs4.it/)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+import sys
+import time
+
+import pytest
+
+Master = 'bench-k8s-master-1'
+Node = 'bench-k8s-node-no-floating-ip-1'
+PublicNode = 'bench-k8s-node-1'
+
+
+@pytest.fixture
+def inventory(mc, hosts_ini):
+    # a master, a bastion, a node with a floating IP and private ones
+    inventory = mc.InventoryFile(hosts_ini(instances=8, masters=1, fip_ratio=0.3))
+    assert inventory.behind_bastion(Node) and not inventory.behind_bastion(PublicNode)
+    return inventory
+
+
+@pytest.fixture
+def checks(mc, monkeypatch):
+    """
+    Stubs the ssh check of the hosts:  returns the dict of the problems of
+    each host (an error, or the values of the HostCheck fields), and the list
+    of the hosts checked.
+    """
+    problems = {}
+    checked = []
+
+    async def check_host(self, semaphore, inventory, host, ssh_config):
+        checked.append(host)
+        result = mc.HostCheck(host, inventory.address(host))
+        result.latency = 0.01
+        result.sudo, result.python3, result.free_mb = True, True, 10000
+        for field, value in problems.get(host, {}).items():
+            setattr(result, field, value)
+        return result
+
+    monkeypatch.setattr(mc.Preflight, '_check_host', check_host)
+    return problems, checked
+
+
+def test_all_hosts_ready(mc, inventory, checks):
+    problems, checked = checks
+    assert mc.Preflight('fail').check(inventory) == []
+    # the bastion first, on its own
+    assert checked[0] == 'bastion'
+    assert sorted(checked) == sorted(inventory.hosts)
+
+
+def test_failed_workers_are_excluded(mc, inventory, checks, capsys):
+    problems, _ = checks
+    problems[Node] = { 'error': 'Connection refused' }
+    problems[PublicNode] = { 'free_mb': 10 }
+    assert sorted(mc.Preflight('exclude').check(inventory)) == [ PublicNode, Node ]
+    out = capsys.readouterr().out
+    assert 'Connection refused' in out
+    assert '10 MB free on /' in out
+    with pytest.raises(mc.PreflightFailed):
+        mc.Preflight('fail').check(inventory)
+
+
+@pytest.mark.parametrize('problem', [ { 'sudo': False }, { 'python3': False }, { 'error': 'timed out after 10s' } ])
+def test_critical_hosts_cant_be_excluded(mc, inventory, checks, problem):
+    problems, _ = checks
+    problems[Master] = problem
+    problems[Node] = { 'error': 'Connection refused' }
+    with pytest.raises(mc.PreflightFailed) as e:
+        mc.Preflight('exclude').check(inventory)
+    assert "{} which can't be excluded".format(Master) in str(e.value)
+
+
+def test_unreachable_bastion(mc, inventory, checks, capsys):
+    problems, checked = checks
+    problems['bastion'] = { 'error': 'timed out after 10s' }
+    with pytest.raises(mc.PreflightFailed):
+        mc.Preflight('exclude').check(inventory)
+    # the hosts behind the bastion aren't even tried
+    assert Node not in checked
+    assert Master in checked and PublicNode in checked
+    assert 'bastion unreachable' in capsys.readouterr().out
+
+
+def test_preflight_off(mc, inventory, checks):
+    problems, checked = checks
+    problems[Master] = { 'error': 'Connection refused' }
+    assert mc.Preflight('off').check(inventory) == []
+    assert checked == []
+
+
+def test_deployment_excludes_the_failed_hosts(mc, hosts_ini, tmp_path, checks):
+    problems, _ = checks
+    problems[Node] = { 'error': 'Connection refused' }
+    hosts_ini(instances=8, masters=1, fip_ratio=0.3)
+    deployment = mc.Deployment(str(tmp_path), str(tmp_path / 'hosts.ini'), preflight=mc.Preflight('exclude'))
+    assert deployment._preflight_check() == [ '--limit', '!' + Node ]
+    assert mc.Deployment(str(tmp_path), str(tmp_path / 'hosts.ini'))._preflight_check() == []
+
+
+# Answers like the remote script, as told by fake-ssh.json for each user@address
+FakeSsh = """#!{python}
+import json, os, sys, time
+with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fake-ssh.json')) as f:
+    host = json.load(f)[sys.argv[-2]]
+time.sleep(host.get('sleep', 0))
+sys.stdout.write(host.get('out', ''))
+sys.stderr.write(host.get('err', ''))
+sys.exit(host.get('returncode', 0))
+"""
+
+
+@pytest.fixture
+def fake_ssh(tmp_path, monkeypatch):
+    bin_dir = tmp_path / 'bin'
+    bin_dir.mkdir()
+    (bin_dir / 'ssh').write_text(FakeSsh.format(python=sys.executable))
+    os.chmod(str(bin_dir / 'ssh'), 0o755)
+    monkeypatch.setenv('PATH', '{}:{}'.format(bin_dir, os.environ['PATH']))
+
+    def script(hosts):
+        (bin_dir / 'fake-ssh.json').write_text(json.dumps(hosts))
+    return script
+
+
+def test_ssh_check(mc, hosts_ini, fake_ssh):
+    inventory = mc.InventoryFile(hosts_ini(instances=4, masters=1, fip_ratio=1))
+    target = lambda h: '{}@{}'.format(inventory.user(h), inventory.address(h))
+    fake_ssh({
+        target('bastion'): { 'out': 'sudo=1\npython3=1\nfree_mb=5000\n' },
+        target(Master): { 'out': 'python3=1\nfree_mb=100\n' },
+        target(PublicNode): { 'err': 'debug\nssh: connect to host: Connection refused\n', 'returncode': 255 },
+        target('bench-k8s-node-2'): { 'sleep': 5 },
+    })
+    start = time.time()
+    with pytest.raises(mc.PreflightFailed):
+        mc.Preflight('exclude', timeout=1, min_free_mb=1024).check(inventory)
+    assert time.time() - start < 4
+
+    results = { r.host: r for r in mc.run_coroutine(mc.Preflight(timeout=1)._check_all(inventory, None)) }
+    assert results['bastion'].problems(1024) == []
+    assert results['bastion'].free_mb == 5000
+    assert results[Master].problems(1024) == [ 'no passwordless sudo', '100 MB free on /' ]
+    assert results[PublicNode].problems(1024) == [ 'ssh: connect to host: Connection refused' ]
+    assert results['bench-k8s-node-2'].problems(1024) == [ 'timed out after 1s' ]
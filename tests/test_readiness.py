@@ -0,0 +1,127 @@
+# Copyright 2018-2020 CRS4 (http://www.crs4.it/)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import base64
+import os
+
+import pytest
+import yaml
+
+from fake_kube_api import FakeKubeApi
+
+
+@pytest.fixture
+def api():
+    server = FakeKubeApi(('127.0.0.1', 0)).start()
+    yield server
+    server.stop()
+
+
+class FakeClock(object):
+    """
+    Time that only advances when the gate sleeps.
+    """
+
+    def __init__(self, on_sleep=None):
+        self.now = 0.0
+        self.sleeps = []
+        self._on_sleep = on_sleep
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+        if self._on_sleep:
+            self._on_sleep(self)
+
+
+def test_ready_cluster_passes_at_once(mc, api):
+    clock = FakeClock()
+    gate = mc.ReadinessGate(mc.HttpApiClient(api.url), clock=clock, sleep=clock.sleep)
+    assert gate.wait() == 0
+    assert clock.sleeps == []
+    assert '/healthz' in api.requests
+    assert '/api/v1/nodes' in api.requests
+    assert '/apis/apps/v1/namespaces/kube-system/daemonsets' in api.requests
+
+
+def test_not_ready_then_ready(mc, api):
+    api.cluster.set_ready(False)
+
+    def converge(clock):
+        # the cluster converges while the gate is waiting for the third time
+        if len(clock.sleeps) == 3:
+            api.cluster.set_ready(True)
+
+    clock = FakeClock(converge)
+    gate = mc.ReadinessGate(mc.HttpApiClient(api.url), clock=clock, sleep=clock.sleep)
+    assert gate.wait() == 5 + 10 + 20
+    assert clock.sleeps == [ 5, 10, 20 ]
+
+
+def test_not_ready_reports_what_is_pending(mc, api):
+    api.cluster.nodes['node2'] = False
+    api.cluster.deployments['coredns'][1] = 1
+    gate = mc.ReadinessGate(mc.HttpApiClient(api.url))
+    failures = gate._failures()
+    assert failures == [ "nodes: 1 of 3 nodes not ready: node2",
+                         "kube-system: Rollout pending in kube-system: deployment/coredns" ]
+
+
+def test_unhealthy_api_server_skips_the_other_probes(mc, api):
+    api.cluster.set_ready(False)
+    gate = mc.ReadinessGate(mc.HttpApiClient(api.url))
+    failures = gate._failures()
+    assert len(failures) == 1 and failures[0].startswith('apiserver:')
+    assert api.requests == [ '/healthz' ]
+
+
+def test_timeout_with_backoff(mc, api):
+    api.cluster.set_ready(False)
+    clock = FakeClock()
+    gate = mc.ReadinessGate(mc.HttpApiClient(api.url), deadline=200, clock=clock, sleep=clock.sleep)
+    with pytest.raises(mc.ReadinessTimeout) as e:
+        gate.wait()
+    # exponential backoff capped at max_delay, the last sleep cut to the deadline
+    assert clock.sleeps == [ 5, 10, 20, 40, 60, 60, 5 ]
+    assert clock.now == 200
+    assert 'apiserver' in str(e.value)
+
+
+def test_unreachable_server_is_not_ready(mc, api):
+    url = api.url
+    api.stop()
+    clock = FakeClock()
+    gate = mc.ReadinessGate(mc.HttpApiClient(url, timeout=1), deadline=10, clock=clock, sleep=clock.sleep)
+    with pytest.raises(mc.ReadinessTimeout):
+        gate.wait()
+
+
+def test_kubeconfig_credentials_removed_on_close(mc, api, tmp_path):
+    kubeconfig = tmp_path / 'kubeconfig'
+    kubeconfig.write_text(yaml.safe_dump({
+        'current-context': 'admin@test',
+        'contexts': [ { 'name': 'admin@test', 'context': { 'cluster': 'test', 'user': 'admin' } } ],
+        'clusters': [ { 'name': 'test', 'cluster': { 'server': api.url } } ],
+        'users': [ { 'name': 'admin', 'user': {
+            'client-key-data': base64.b64encode(b'not a real key').decode() } } ],
+    }))
+    with mc.HttpApiClient.from_kubeconfig(str(kubeconfig)) as client:
+        tmp_dir = client._tmp_dir.name
+        key_file = os.path.join(tmp_dir, 'client-key')
+        assert os.stat(key_file).st_mode & 0o777 == 0o600
+        assert client.get('/healthz') == 'ok'
+    assert not os.path.exists(tmp_dir)
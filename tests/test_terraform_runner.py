@@ -0,0 +1,204 @@
+# Copyright 2018-2020 CRS4 (http://www.crs4.it/)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+import sys
+
+import pytest
+
+import terraform_runner
+
+# Prints the lines of the next attempt in the scenario and exits with its code.
+# The arguments of every call are appended to calls.jsonl
+FakeTerraform = """#!{python}
+import json, os, sys
+directory = os.path.dirname(os.path.abspath(__file__))
+calls = os.path.join(directory, 'calls.jsonl')
+attempt = sum(1 for _ in open(calls)) if os.path.exists(calls) else 0
+with open(calls, 'a') as f:
+    f.write(json.dumps(sys.argv[1:]) + '\\n')
+with open(os.path.join(directory, 'scenario.json')) as f:
+    scenario = json.load(f)
+lines, returncode = scenario[min(attempt, len(scenario) - 1)]
+for line in lines:
+    print(line)
+sys.exit(returncode)
+"""
+
+Created = [
+    "module.compute.openstack_compute_instance_v2.k8s_master.0: Creation complete after 1m5s (ID: 1)",
+    "\x1b[0m\x1b[1mmodule.compute.openstack_compute_instance_v2.k8s_node.0: Creation complete after 45s (ID: 2)\x1b[0m",
+    "module.network.openstack_networking_router_v2.k8s: Creation complete after 10s (ID: 3)",
+]
+Throttled = [ "Error: Error applying plan:", "",
+              "* module.compute.openstack_compute_instance_v2.k8s_node[1]: "
+              "Error creating OpenStack server: Request forbidden: 429 Too Many Requests" ]
+OverQuota = [ "Error: Error applying plan:", "",
+              "* module.compute.openstack_compute_instance_v2.k8s_node[1]: "
+              "Quota exceeded for cores: Requested 4, but already used 96 of 100 cores" ]
+
+
+class FakeTerraformDir(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.executable = str(path / 'terraform')
+        with open(self.executable, 'w') as f:
+            f.write(FakeTerraform.format(python=sys.executable))
+        os.chmod(self.executable, 0o755)
+        self.history = str(path / 'history.json')
+
+
+    def script(self, *attempts):
+        with open(str(self.path / 'scenario.json'), 'w') as f:
+            json.dump(attempts, f)
+
+
+    def calls(self):
+        with open(str(self.path / 'calls.jsonl')) as f:
+            return [ json.loads(line) for line in f ]
+
+
+    def parallelisms(self):
+        return [ int(call[1].split('=')[1]) for call in self.calls() ]
+
+
+    def main(self, *args):
+        with pytest.raises(SystemExit) as e:
+            terraform_runner.main([ '--terraform', self.executable, '--history', self.history,
+                                    '--retry-delay', '0' ] + list(args))
+        return e.value.code
+
+
+    def runs(self):
+        return terraform_runner.RunHistory(self.history).runs()
+
+
+@pytest.fixture
+def terraform(tmp_path):
+    return FakeTerraformDir(tmp_path)
+
+
+def test_throttled_runs_are_retried_with_halved_parallelism(terraform):
+    terraform.script((Created[:1] + Throttled, 1), (Throttled, 1), (Created[1:], 0))
+    assert terraform.main('--parallelism', '16', 'apply', '--', '-auto-approve') == 0
+    assert terraform.parallelisms() == [ 16, 8, 4 ]
+    assert terraform.calls()[0] == [ 'apply', '-parallelism=16', '-auto-approve' ]
+    run = terraform.runs()[-1]
+    assert run['attempts'] == 3
+    assert run['final_parallelism'] == 4
+    assert run['throttled'] == 0
+    assert run['total_throttled'] == 2
+    assert run['resources'] == 3
+    assert run['by_type']['openstack_compute_instance_v2'] == [ 2, 65 + 45, 65 ]
+
+
+def test_retries_are_bounded(terraform):
+    terraform.script((Throttled, 1))
+    assert terraform.main('--parallelism', '16', '--max-retries', '2', 'apply') == 1
+    assert terraform.parallelisms() == [ 16, 8, 4 ]
+    run = terraform.runs()[-1]
+    assert run['attempts'] == 3
+    assert run['throttled'] == 1
+    assert run['returncode'] == 1
+
+
+def test_quota_errors_stop_at_once(terraform):
+    terraform.script((OverQuota + Throttled, 1), (Created, 0))
+    assert terraform.main('--parallelism', '16', 'apply') == 1
+    assert terraform.parallelisms() == [ 16 ]
+    assert terraform.runs()[-1]['quota_errors'] == 1
+
+
+def test_failures_that_arent_throttling_arent_retried(terraform):
+    terraform.script(([ "Error: Error applying plan:", "* invalid flavor m1.huge" ], 1), (Created, 0))
+    assert terraform.main('--parallelism', '16', 'destroy') == 1
+    assert terraform.parallelisms() == [ 16 ]
+
+
+def test_parallelism_is_sized_on_the_instances(terraform, tmp_path):
+    variables = tmp_path / 'cluster.tf'
+    variables.write_text('number_of_k8s_masters = 3\nnumber_of_k8s_nodes = "24"\n# number_of_bastions = 1\n')
+    terraform.script((Created, 0))
+    assert terraform.main('--variables', str(variables), 'apply') == 0
+    assert terraform.parallelisms() == [ 27 ]
+    assert terraform.runs()[-1]['instances'] == 27
+
+
+def runner_with_history(tmp_path, instances, *runs):
+    history = terraform_runner.RunHistory(str(tmp_path / 'history.json'))
+    for run in runs:
+        history.record(dict(action='apply', **run))
+    return terraform_runner.TerraformRunner('apply', [], instances, history)
+
+
+@pytest.mark.parametrize('instances, expected', [ (3, 10), (27, 27), (100, 40) ])
+def test_parallelism_without_history(tmp_path, instances, expected):
+    assert runner_with_history(tmp_path, instances).choose_parallelism() == expected
+
+
+def test_parallelism_after_a_throttled_run(tmp_path):
+    runner = runner_with_history(tmp_path, 30, dict(final_parallelism=16, throttled=3, total_throttled=5))
+    assert runner.choose_parallelism() == 8
+    # never under the minimum
+    runner = runner_with_history(tmp_path, 30, dict(final_parallelism=6, throttled=3, total_throttled=5))
+    assert runner.choose_parallelism() == terraform_runner.DefaultMinParallelism
+
+
+def test_parallelism_after_recovering_from_throttling(tmp_path):
+    runner = runner_with_history(tmp_path, 30, dict(final_parallelism=8, throttled=0, total_throttled=4))
+    assert runner.choose_parallelism() == 8
+
+
+def test_parallelism_after_a_clean_run(tmp_path):
+    assert runner_with_history(tmp_path, 30, dict(final_parallelism=8)).choose_parallelism() == 12
+    # up to the target of the instances
+    assert runner_with_history(tmp_path, 30, dict(final_parallelism=24)).choose_parallelism() == 30
+
+
+def test_parallelism_only_follows_the_same_action(tmp_path):
+    history = terraform_runner.RunHistory(str(tmp_path / 'history.json'))
+    history.record(dict(action='destroy', final_parallelism=16, throttled=3, total_throttled=3))
+    runner = terraform_runner.TerraformRunner('apply', [], 30, history)
+    assert runner.choose_parallelism() == 30
+
+
+@pytest.mark.parametrize('text, seconds', [ ('45s', 45), ('1m5s', 65), ('2h', 7200), ('1h2m3s', 3723) ])
+def test_parse_duration(text, seconds):
+    assert terraform_runner.parse_duration(text) == seconds
+
+
+@pytest.mark.parametrize('address, rtype', [
+    ('openstack_compute_keypair_v2.k8s', 'openstack_compute_keypair_v2'),
+    ('module.compute.openstack_compute_instance_v2.k8s_node[0]', 'openstack_compute_instance_v2'),
+    ('module.a.module.b.openstack_networking_port_v2.p.1', 'openstack_networking_port_v2'),
+    ('module.ips.data.openstack_networking_network_v2.ext', 'data.openstack_networking_network_v2'),
+])
+def test_resource_type(address, rtype):
+    assert terraform_runner.resource_type(address) == rtype
+
+
+def test_run_stats_classify_the_errors():
+    stats = terraform_runner.RunStats()
+    for line in Created + Throttled + OverQuota:
+        stats.feed(line)
+    stats.feed("* openstack_networking_floatingip_v2.fip: Expected HTTP response code [201] but got 503")
+    stats.feed("* rate limit exceeded")
+    # only error lines count
+    stats.feed("module.compute.openstack_compute_instance_v2.k8s_node.429: Still creating... (10s elapsed)")
+    assert stats.throttled == 3
+    assert stats.quota_errors == 1
+    assert stats.resources == 3
+    assert list(stats.by_type) == [ 'openstack_compute_instance_v2', 'openstack_networking_router_v2' ]
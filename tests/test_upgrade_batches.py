@@ -0,0 +1,114 @@
+# Copyright 2018-2020 CRS4 (http://www.crs4.it/)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pytest
+
+
+@pytest.mark.parametrize('spec', [ '2', '25%', '100%', ' 3 ', 7 ])
+def test_budget_specs(mc, spec):
+    assert str(mc.DisruptionBudget(spec)) == str(spec).strip()
+
+
+@pytest.mark.parametrize('spec', [ '0', '0%', '00%', '101%', '250%', '-1', '2.5', '25 %', 'a', '' ])
+def test_invalid_budget_specs_are_rejected(mc, spec):
+    with pytest.raises(ValueError):
+        mc.DisruptionBudget(spec)
+
+
+@pytest.mark.parametrize('spec, group_size, nodes', [
+    ('25%', 10, 2),     # floored
+    ('5%', 10, 1),      # never less than one node
+    ('100%', 7, 7),
+    ('1', 10, 1),
+    ('3', 2, 2),        # not more than the group
+])
+def test_budget_nodes(mc, spec, group_size, nodes):
+    assert mc.DisruptionBudget(spec).nodes(group_size) == nodes
+
+
+def batches(mc, path, default_budget=None):
+    return mc.UpgradeBatches(mc.InventoryFile(path), default_budget)
+
+
+def test_workers_and_control_plane(mc, hosts_ini):
+    b = batches(mc, hosts_ini(instances=14, masters=3))
+    assert len(b.control_plane) == 3
+    assert len(b.workers) == 10
+    assert not set(b.control_plane) & set(b.workers)
+
+
+def test_no_budget_leaves_it_to_kubespray(mc, hosts_ini):
+    b = batches(mc, hosts_ini(instances=14, masters=3))
+    assert b.batch_size is None
+    assert b.batches is None
+    assert b.extra_args() == []
+    assert "KubeSpray's default batches" in b.describe()[1]
+
+
+def test_default_budget(mc, hosts_ini):
+    b = batches(mc, hosts_ini(instances=14, masters=3), '30%')
+    assert b.batch_size == 3
+    assert b.batches == 4
+    assert b.extra_args() == [ '-e', 'serial=3' ]
+
+
+def test_group_budgets_take_the_minimum(mc, hosts_ini):
+    path = hosts_ini(instances=14, masters=3)
+    workers = mc.InventoryFile(path).groups['kube-node']
+    # 50% of the 4 gpu nodes is less than the default of 5
+    path = hosts_ini('[gpu]\n{}\n\n[gpu:vars]\nupgrade_max_unavailable=50%\n'.format('\n'.join(workers[:4])),
+                     instances=14, masters=3)
+    b = batches(mc, path, '5')
+    assert list(b.budgets) == [ 'default', 'gpu' ]
+    assert b.budgets['gpu'][1] == 4
+    assert b.batch_size == 2
+    assert b.batches == 5
+    # a larger group budget doesn't raise the default
+    path = hosts_ini('[kube-node:vars]\nupgrade_max_unavailable=8\n', instances=14, masters=3)
+    assert batches(mc, path, '5').batch_size == 5
+
+
+def test_budget_of_a_group_without_workers_is_ignored(mc, hosts_ini):
+    path = hosts_ini('[kube-master:vars]\nupgrade_max_unavailable=1\n', instances=14, masters=3)
+    b = batches(mc, path, '4')
+    assert list(b.budgets) == [ 'default' ]
+    assert b.batch_size == 4
+
+
+def test_all_vars_budget(mc, hosts_ini):
+    # [all:vars] is the last section of the generated inventory
+    b = batches(mc, hosts_ini('upgrade_max_unavailable=20%\n', instances=14, masters=3))
+    assert b.budgets['all'][1] == 10
+    assert b.batch_size == 2
+
+
+def test_invalid_group_budget_is_rejected(mc, hosts_ini):
+    with pytest.raises(ValueError):
+        batches(mc, hosts_ini('upgrade_max_unavailable=0%\n', instances=14, masters=3))
+
+
+def test_etcd_workers_are_upgraded_one_at_a_time(mc, hosts_ini):
+    path = hosts_ini(instances=14, masters=3)
+    with open(path) as f:
+        text = f.read()
+    worker = mc.InventoryFile(path).groups['kube-node'][0]
+    with open(path, 'w') as f:
+        f.write(text.replace('[etcd]\n', '[etcd]\n{}\n'.format(worker)))
+    b = batches(mc, path, '50%')
+    assert b.etcd_workers == [ worker ]
+    assert b.batch_size == 1
+    assert b.extra_args() == [ '-e', 'serial=1' ]
+    assert worker in b.describe()[-1]
+    # without budgets it's still left to KubeSpray
+    assert batches(mc, path).extra_args() == []
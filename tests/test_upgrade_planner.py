@@ -0,0 +1,50 @@
+# Copyright 2018-2020 CRS4 (http://www.crs4.it/)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pytest
+
+
+def test_plan_goes_through_mandatory_stop(mc):
+    path = mc.UpgradePlanner().plan('2.8.4', '2.14.0')
+    assert '2.9.0' in path
+    assert path[0] == '2.9.0'
+    assert path[-1] == '2.14.0'
+    assert path == [ '2.9.0', '2.10.0', '2.11.2', '2.12.5', '2.14.0' ]
+
+
+def test_plan_only_makes_allowed_hops(mc):
+    planner = mc.UpgradePlanner()
+    path = [ '2.8.4' ] + planner.plan('2.8.4', '2.14.0')
+    for base, target in zip(path, path[1:]):
+        assert planner.hop_allowed(base, target)
+    # would skip the mandatory stop 2.9.0
+    assert not planner.hop_allowed('2.8.4', '2.10.0')
+
+
+@pytest.mark.parametrize('base, target', [ ('2.10.0', '2.10.4'), ('2.12.1', '2.12.5'), ('2.11.1', '2.11.2') ])
+def test_patch_only_upgrade_is_a_single_step(mc, base, target):
+    assert mc.UpgradePlanner().plan(base, target) == [ target ]
+
+
+def test_sequential_plan_walks_the_table(mc):
+    assert mc.UpgradePlanner().plan('2.10.0', '2.11.0', sequential=True) == [ '2.10.3', '2.10.4', '2.11.0' ]
+
+
+def test_plan_to_the_same_version_is_empty(mc):
+    assert mc.UpgradePlanner().plan('2.12.5', '2.12.5') == []
+
+
+def test_downgrade_is_rejected(mc):
+    with pytest.raises(ValueError):
+        mc.UpgradePlanner().plan('2.14.0', '2.12.5')